@@ -1,129 +1,1943 @@
-from flask import Flask, request, jsonify, render_template, Response, send_from_directory
-import sqlite3, random, os
+from flask import Flask, request, jsonify, render_template, Response, send_from_directory, g
+import sqlite3, random, os, threading, time, json, hashlib, bisect, secrets, csv, io, re, tempfile, gzip
+from collections import deque, OrderedDict
+from datetime import datetime
 from contextlib import contextmanager
+import click
 
 app = Flask(__name__, static_folder='pics', static_url_path='/static/pics')
-app.config['DATABASE'] = 'ticket.db'
+app.config['DATABASE'] = os.environ.get('TICKET_DB', 'ticket.db')                 # 数据库文件路径
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 8))                # 每个 worker 保留的空闲连接数
+app.config['DB_BUSY_TIMEOUT_MS'] = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 3000))   # 等待写锁的时间
+app.config['DB_CACHE_KB'] = int(os.environ.get('DB_CACHE_KB', 16384))               # 每个连接的页缓存
+app.config['DB_MMAP_BYTES'] = int(os.environ.get('DB_MMAP_BYTES', 256 * 1024 * 1024))
+app.config['DB_SYNCHRONOUS'] = os.environ.get('DB_SYNCHRONOUS', 'NORMAL')           # NORMAL：WAL 下提交不 fsync；FULL：每次提交 fsync
+app.config['TICKET_PREFIX'] = os.environ.get('TICKET_PREFIX', 'NO.251221')            # 票号前缀（按场次配置）
+app.config['ROSTER_CHECK_INTERVAL'] = float(os.environ.get('ROSTER_CHECK_INTERVAL', 1.0))  # 检查学号库是否被其它 worker 修改的间隔（秒）
+app.config['CONTROL_CHECK_INTERVAL'] = float(os.environ.get('CONTROL_CHECK_INTERVAL', 0.5))  # 检查窗口/密钥/集合开关是否被其它 worker 修改的间隔（秒）
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') != '0'           # 请求/SQL 耗时统计（/admin/api/metrics）
+app.config['IMPORT_CHUNK_SIZE'] = int(os.environ.get('IMPORT_CHUNK_SIZE', 5000))       # 批量导入每个事务写入的行数
+app.config['CHECKIN_INDEX'] = os.environ.get('CHECKIN_INDEX', '')                      # 关闭取票窗口时生成的入场核验索引（空则不生成，见 checkin.py）
+
+
+# ------------ 请求指标（Prometheus 文本格式） ------------
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics, self.name, self.labels = metrics, name, labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, self.labels, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """
+    进程内的计数器和耗时直方图，/admin/api/metrics 以 Prometheus 文本格式输出
+
+    - 标签用 ((名, 值), ...) 元组表示，只使用路由模板、查询名、结果消息等有限取值
+    - METRICS_ENABLED=0 时 inc / observe 直接返回，timer 返回共享的空计时器
+    - 每个 worker 各自统计，输出中带 worker 标签（进程号）区分
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    # 名称 -> (类型, 说明)
+    HELP = {
+        'ticket_http_requests_total': ('counter', '按路由、方法、状态码统计的请求数'),
+        'ticket_http_request_duration_seconds': ('histogram', '请求处理耗时'),
+        'ticket_db_acquire_seconds': ('histogram', '从连接池取得连接的耗时'),
+        'ticket_db_query_seconds': ('histogram', '领票路径上各步骤（查询 / 事务）的耗时'),
+        'ticket_claim_outcomes_total': ('counter', '领票接口按状态码和返回消息统计的结果'),
+        'ticket_claim_queue_outcomes_total': ('counter', '排队模式下写入线程处理的领票结果'),
+        'ticket_claim_busy_retries_total': ('counter', '领票事务遇到数据库被锁后的重试次数'),
+        'ticket_rate_limited_total': ('counter', '领票请求被限流（429）的次数，按限流键（ip / student）统计'),
+        'ticket_rate_limit_evictions_total': ('counter', '限流状态超过 RATE_LIMIT_MAX_KEYS 时淘汰的键数'),
+        'ticket_rejection_cache_total': ('counter', '学号 / 姓名校验失败结果缓存的命中（hit）与未命中（miss）次数'),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}      # (name, labels) -> 值
+        self._histograms = {}    # (name, labels) -> [各桶计数..., +Inf 计数, 总和]
+
+    @property
+    def enabled(self):
+        return app.config['METRICS_ENABLED']
+
+    def inc(self, name, labels=(), value=1):
+        if not app.config['METRICS_ENABLED']:
+            return
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        if not app.config['METRICS_ENABLED']:
+            return
+        key = (name, labels)
+        i = bisect.bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            hist[i] += 1
+            hist[-1] += seconds
+
+    def timer(self, name, **labels):
+        """with metrics.timer('ticket_db_query_seconds', query='ip_check'): ..."""
+        if not app.config['METRICS_ENABLED']:
+            return _NULL_TIMER
+        return _Timer(self, name, tuple(labels.items()))
+
+    def count(self, name, labels=()):
+        """计数器的值，或直方图的观测次数"""
+        with self._lock:
+            if (name, labels) in self._counters:
+                return self._counters[(name, labels)]
+            hist = self._histograms.get((name, labels))
+            return sum(hist[:-1]) if hist else 0
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(hist) for key, hist in self._histograms.items()}
+        worker = (('worker', os.getpid()),)
+        lines = ['# HELP ticket_metrics_enabled 是否正在统计指标',
+                 '# TYPE ticket_metrics_enabled gauge',
+                 f'ticket_metrics_enabled{self._format_labels(worker)} {int(bool(self.enabled))}']
+        names = sorted({name for name, _ in counters} | {name for name, _ in histograms})
+        for name in names:
+            kind, text = self.HELP.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (n, labels), value in sorted(counters.items(), key=lambda kv: kv[0][1]):
+                if n == name:
+                    lines.append(f'{name}{self._format_labels(worker + labels)} {value}')
+            for (n, labels), hist in sorted(histograms.items(), key=lambda kv: kv[0][1]):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ('+Inf',), hist[:-1]):
+                    cumulative += count
+                    le = (('le', bound if bound == '+Inf' else repr(bound)),)
+                    lines.append(f'{name}_bucket{self._format_labels(worker + labels + le)} {cumulative}')
+                lines.append(f'{name}_sum{self._format_labels(worker + labels)} {hist[-1]:.6f}')
+                lines.append(f'{name}_count{self._format_labels(worker + labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+# ------------ SQLite 数据库连接池 ------------
+class ConnectionPool:
+    """
+    每个 worker 进程一个连接池，跨请求复用连接
+
+    - 新连接只在创建时设置一次 PRAGMA：WAL 日志（读写互不阻塞）、
+      synchronous（DB_SYNCHRONOUS，默认 NORMAL）、busy_timeout、更大的页缓存和 mmap I/O
+    - 空闲超过 HEALTH_CHECK_IDLE 秒或上次使用出错的连接，取出前先 SELECT 1 检查
+    - 池中空闲连接不足时直接新建，归还时超过 size 的部分关闭，不会阻塞请求
+    """
+
+    HEALTH_CHECK_IDLE = 30
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._idle = []          # [(conn, 归还时间), ...]
+        self._suspect = set()    # 出过错、下次取出前需要检查的连接
+        self._stats = {'created': 0, 'reused': 0, 'closed': 0, 'discarded': 0,
+                       'in_use': 0, 'peak_in_use': 0}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000,
+                               check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(f"PRAGMA synchronous = {app.config['DB_SYNCHRONOUS']}")
+        conn.execute(f"PRAGMA busy_timeout = {app.config['DB_BUSY_TIMEOUT_MS']}")
+        conn.execute(f"PRAGMA cache_size = -{app.config['DB_CACHE_KB']}")
+        conn.execute(f"PRAGMA mmap_size = {app.config['DB_MMAP_BYTES']}")
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+
+    def _healthy(self, conn):
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, returned_at = self._idle.pop()
+                suspect = conn in self._suspect
+                self._suspect.discard(conn)
+            if (suspect or time.monotonic() - returned_at > self.HEALTH_CHECK_IDLE) and not self._healthy(conn):
+                self._close(conn, 'discarded')
+                continue
+            with self._lock:
+                self._stats['reused'] += 1
+                self._checked_out()
+            return conn
+        conn = self._connect()
+        with self._lock:
+            self._stats['created'] += 1
+            self._checked_out()
+        return conn
+
+    def _checked_out(self):
+        self._stats['in_use'] += 1
+        self._stats['peak_in_use'] = max(self._stats['peak_in_use'], self._stats['in_use'])
+
+    def release(self, conn, failed=False):
+        """归还连接：未提交的事务一律回滚（与原先 close 时丢弃的行为一致）"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            failed = True
+        with self._lock:
+            self._stats['in_use'] -= 1
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic()))
+                if failed:
+                    self._suspect.add(conn)
+                return
+        self._close(conn, 'closed')
+
+    def _close(self, conn, reason):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._stats[reason] += 1
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._suspect.clear()
+        for conn, _ in idle:
+            self._close(conn, 'closed')
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, idle=len(self._idle), size=self.size,
+                        database=self.path, pid=self.pid)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """当前 worker 的连接池；数据库路径变化或 fork 之后重新创建"""
+    global _pool
+    pool = _pool
+    if pool is None or pool.path != app.config['DATABASE'] or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = _pool
+            if pool is None or pool.path != app.config['DATABASE'] or pool.pid != os.getpid():
+                if pool is not None and pool.pid == os.getpid():
+                    pool.close_all()
+                pool = _pool = ConnectionPool(app.config['DATABASE'], app.config['DB_POOL_SIZE'])
+    return pool
 
 
-# ------------ SQLite 数据库连接 ------------
 @contextmanager
 def get_db():
-    """获取数据库连接"""
-    conn = sqlite3.connect(app.config['DATABASE'])
-    conn.row_factory = sqlite3.Row
+    """从连接池获取数据库连接，用完归还"""
+    pool = get_pool()
+    with metrics.timer('ticket_db_acquire_seconds'):
+        conn = pool.acquire()
+    failed = False
     try:
         yield conn
+    except sqlite3.Error:
+        failed = True
+        raise
     finally:
-        conn.close()
+        pool.release(conn, failed)
 
 
-def init_db():
-    """初始化数据库表结构（如果不存在）"""
-    with get_db() as conn:
+# ------------ 座位池（内存分配器） ------------
+app.config['SEAT_POLICY'] = os.environ.get('SEAT_POLICY', 'random')          # 单人选座：random 随机；front 从前排往后；center 从中间往外
+app.config['GROUP_CLAIM_MAX'] = int(os.environ.get('GROUP_CLAIM_MAX', 0))     # 连座领票最多人数（含本人），0 / 1 表示不开放
+
+SEAT_POOL_SAMPLE_TRIES = 8   # 拒绝采样的最多尝试次数，之后退回线性选择
+SEAT_POLICIES = ('random', 'front', 'center')
+if app.config['SEAT_POLICY'] not in SEAT_POLICIES:
+    # 启动时就报错：否则每次领票都在选座时出错（500）
+    raise ValueError(f"SEAT_POLICY 只能是 {' / '.join(SEAT_POLICIES)}，当前为 {app.config['SEAT_POLICY']!r}")
+
+
+def _nearest_bit(bits, target):
+    """bits（非 0）中离 target 最近的置位下标"""
+    target = max(0, int(round(target)))
+    low = bits & ((2 << target) - 1)
+    high = bits >> target
+    best = low.bit_length() - 1 if low else None
+    if high:
+        up = target + (high & -high).bit_length() - 1
+        if best is None or up - target < target - best:
+            best = up
+    return best
+
+
+class SeatPool:
+    """
+    按 group_id 维护空闲座位列表，替代 ORDER BY RANDOM() 的全表扫描排序
+
+    - 每个集合的列表在重建时打乱一次，之后从尾部 pop，O(1)
+    - 多个集合同时开放时在并集中均匀随机：先做拒绝采样（随机选集合，按 剩余数 / 最大列表长度 的概率接受），
+      开放几十上百个小集合时每次仍是 O(1)；连续落空（多数集合已空）再按剩余数量加权线性选择
+    - 有排号、列号的座位另按排维护空闲位图（第 col_num 位为 1 表示空闲），按位置选座只看各排位图，O(排数)：
+      front 从前排往后、center 从中间排往外，排内取最靠中间的列；连座取同一排连续 k 个空位
+    - 按位置取走的座位仍留在随机列表里，记入 _taken，随机取到时跳过（惰性删除）
+    - 池只是"候选"：真正的占用以数据库的条件 UPDATE 为准（同时核对集合和排列号），
+      其它 worker 已占用或已被改到别处的座位会在写回时失败并被丢弃
+    - 座位的增删和集合 / 位置的修改由触发器递增 data_versions 中的 seats 版本号，
+      与 ControlState 相同每 CONTROL_CHECK_INTERVAL 秒最多查一次，版本变化时重建（其它 worker 导入座位后不会一直用旧布局）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._free = {}      # group_id -> [(seat_id, pos, row_num, col_num, group_id), ...]
+        self._cap = 0        # 各列表长度的上界（拒绝采样用）
+        self._rows = {}      # group_id -> {row_num: 空闲列位图}
+        self._grid = {}      # group_id -> {(row_num, col_num): seat}，只含位置唯一的空闲座位
+        self._layout = {}    # group_id -> (中间排, 中间列, {'front' / 'center': 排的遍历顺序})
+        self._taken = set()  # 按位置取走、但还留在随机列表里的 seat_id
+        self._loaded = False
+        self._refilled = None  # 上次 refill 重建时的 (集合, 总数, 已占用)
+        self._version = None   # 重建时 data_versions 中 seats 的版本号
+        self._checked_at = 0.0
+
+    def rebuild(self, conn):
+        """从 seats 表重新加载所有空闲座位和各排的空闲位图"""
         cursor = conn.cursor()
+        version = self._seat_version(cursor)
+        cursor.execute('SELECT seat_id, pos, row_num, col_num, group_id, occupied FROM seats')
+        free, positions = {}, {}
+        for row in cursor.fetchall():
+            seat = (row['seat_id'], row['pos'], row['row_num'], row['col_num'], row['group_id'])
+            if not row['occupied']:
+                free.setdefault(seat[4], []).append(seat)
+            if (seat[2] or 0) > 0 and (seat[3] or 0) > 0:
+                # 同一集合里排列号重复的座位无法按位置区分，只参与随机分配
+                key = (seat[4], seat[2], seat[3])
+                positions[key] = None if key in positions else (False if row['occupied'] else seat)
+        for seats in free.values():
+            random.shuffle(seats)
+
+        rows, grid, row_sets, bounds = {}, {}, {}, {}
+        for (g, r, c), seat in positions.items():
+            row_sets.setdefault(g, set()).add(r)
+            b = bounds.setdefault(g, [r, r, c, c])
+            b[0], b[1], b[2], b[3] = min(b[0], r), max(b[1], r), min(b[2], c), max(b[3], c)
+            if seat:
+                grid.setdefault(g, {})[(r, c)] = seat
+                group_rows = rows.setdefault(g, {})
+                group_rows[r] = group_rows.get(r, 0) | (1 << c)
+        layout = {}
+        for g, (r0, r1, c0, c1) in bounds.items():
+            center_row, center_col = (r0 + r1) / 2, (c0 + c1) / 2
+            front = sorted(row_sets[g])
+            layout[g] = (center_row, center_col,
+                         {'front': front, 'center': sorted(front, key=lambda r: (abs(r - center_row), r))})
+        with self._lock:
+            self._free = free
+            self._cap = max(map(len, free.values()), default=0)
+            self._rows, self._grid, self._layout = rows, grid, layout
+            self._taken = set()
+            self._loaded = True
+            self._refilled = None
+            self._version = version
+            self._checked_at = time.monotonic()
+
+    @staticmethod
+    def _seat_version(cursor):
+        cursor.execute("SELECT version FROM data_versions WHERE name = 'seats'")
+        row = cursor.fetchone()
+        return row['version'] if row else 0
+
+    def _ensure_current(self, conn):
+        """未加载、已失效或其它 worker 修改了座位布局时重建"""
+        if self._loaded:
+            now = time.monotonic()
+            if now - self._checked_at < app.config['CONTROL_CHECK_INTERVAL']:
+                return
+            if self._seat_version(conn.cursor()) == self._version:
+                self._checked_at = now
+                return
+        self.rebuild(conn)
+
+    def invalidate(self):
+        """标记为失效，下次分配前从数据库重建（管理员修改座位后调用）"""
+        with self._lock:
+            self._loaded = False
+            self._refilled = None
+
+    def refill(self, conn, groups):
+        """
+        池中这些集合取不到座位时调用，返回是否从数据库重建了
+
+        先查 seat_counters：这些集合已经没有空位，或计数与上次重建时相同（重建过也没找到，如连座没有连续空位），
+        就不再重建——领完之后的请求只读计数表几行，不在写锁内读整张 seats 表
+        """
+        row = conn.execute(f'''
+            SELECT IFNULL(SUM(total), 0) AS total, IFNULL(SUM(occupied), 0) AS occupied
+            FROM seat_counters WHERE group_id IN ({', '.join('?' * len(groups))})
+        ''', list(groups)).fetchone()
+        state = (tuple(groups), row['total'], row['occupied'])
+        if row['total'] <= row['occupied'] or state == self._refilled:
+            return False
+        self.rebuild(conn)
+        self._refilled = state
+        return True
+
+    def pop(self, conn, groups, policy='random'):
+        """从指定集合中取出一个空闲座位（policy 见 SEAT_POLICIES），没有则返回 None"""
+        self._ensure_current(conn)
+        with self._lock:
+            if policy != 'random':
+                found = self._find(groups, policy, 1)
+                if found:
+                    return self._take(*found, 1)[0]
+                # 位图里没有了：没有排列号的座位仍按随机分配
+            while True:
+                seat = self._pop_random(groups)
+                if seat is None or seat[0] not in self._taken:
+                    break
+                self._taken.discard(seat[0])
+            if seat is not None:
+                self._mark(seat, False)
+            return seat
+
+    def pop_block(self, conn, groups, k, policy='random'):
+        """取出同一集合同一排连续 k 个空闲座位（按列号从小到大），没有则返回 None"""
+        self._ensure_current(conn)
+        with self._lock:
+            found = self._find(groups, policy, k)
+            return self._take(*found, k) if found else None
+
+    def release(self, seat):
+        """写库失败时把座位放回池中（放到随机位置以保持随机性）"""
+        with self._lock:
+            self._mark(seat, True)
+            if seat[0] in self._taken:
+                # 随机列表里还留着这个座位，取消惰性删除即可
+                self._taken.discard(seat[0])
+                return
+            seats = self._free.setdefault(seat[4], [])
+            seats.append(seat)
+            self._cap = max(self._cap, len(seats))
+            i = random.randrange(len(seats))
+            seats[i], seats[-1] = seats[-1], seats[i]
+
+    # 以下方法调用时已持有 _lock
+    def _pop_random(self, groups):
+        if len(groups) > 1 and self._cap:
+            for _ in range(SEAT_POOL_SAMPLE_TRIES):
+                seats = self._free.get(groups[random.randrange(len(groups))])
+                if seats and random.randrange(self._cap) < len(seats):
+                    return seats.pop()
+        lists = [self._free.get(g) for g in groups]
+        lists = [seats for seats in lists if seats]
+        if not lists:
+            return None
+        pick = random.randrange(sum(len(seats) for seats in lists))
+        for seats in lists:
+            if pick < len(seats):
+                return seats.pop()
+            pick -= len(seats)
+
+    def _mark(self, seat, free):
+        """更新座位在位图中的空闲位（不在位图中的座位忽略）"""
+        seat_id, _, r, c, g = seat
+        if self._grid.get(g, {}).get((r, c)) != seat:
+            return
+        if free:
+            self._rows[g][r] |= 1 << c
+        else:
+            self._rows[g][r] &= ~(1 << c)
+
+    def _find(self, groups, policy, k):
+        """按策略找 k 个连续空位，返回 (group_id, row_num, 起始列)；没有返回 None"""
+        offset = (k - 1) / 2
+        candidates, best, best_key = [], None, None
+        for g in groups:
+            rows = self._rows.get(g)
+            if not rows:
+                continue
+            center_row, center_col, orders = self._layout[g]
+            for r in orders['front' if policy == 'random' else policy]:
+                bits = runs = rows[r] if r in rows else 0
+                for i in range(1, k):
+                    runs &= bits >> i
+                if not runs:
+                    continue
+                if policy == 'random':
+                    candidates.append((g, r, runs))
+                    continue
+                start = _nearest_bit(runs, center_col - offset)
+                key = (r if policy == 'front' else abs(r - center_row), abs(start + offset - center_col))
+                if best_key is None or key < best_key:
+                    best, best_key = (g, r, start), key
+                break    # 按遍历顺序第一个有空位的排就是该集合的最优排
+        if policy == 'random' and candidates:
+            g, r, runs = random.choice(candidates)
+            starts = [i for i in range(runs.bit_length()) if runs >> i & 1]
+            return g, r, random.choice(starts)
+        return best
+
+    def _take(self, g, r, start, k):
+        seats = [self._grid[g][(r, start + i)] for i in range(k)]
+        for seat in seats:
+            self._mark(seat, False)
+            self._taken.add(seat[0])
+        return seats
+
+
+seat_pool = SeatPool()
+
+
+# ------------ 按版本号失效的进程内缓存 ------------
+class VersionedCache:
+    """
+    进程内缓存基类：数据来自数据库，data_versions 表中对应的版本号变化时重新加载
+
+    - 本进程修改数据后调用 invalidate()，下次访问立即重新加载
+    - 其它 worker（或外部脚本）的修改由触发器递增版本号，
+      每 interval_key 对应的配置秒数内最多查一次版本号，因此最多滞后这么久
+    - 子类设置 version_name / interval_key 并实现 load(cursor)
+    """
+
+    version_name = None
+    interval_key = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+    @property
+    def version(self):
+        """当前缓存值对应的版本号（未加载或已失效为 None）"""
+        return self._version
+
+    def peek(self):
+        """距上次检查版本号不超过 interval_key 秒时返回缓存值，否则返回 None；不查库"""
+        if self._version is not None and time.monotonic() - self._checked_at < app.config[self.interval_key]:
+            return self._value
+        return None
+
+    def load(self, cursor):
+        raise NotImplementedError
+
+    def get(self, conn):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < app.config[self.interval_key]:
+            return self._value
+        cursor = conn.cursor()
+        cursor.execute('SELECT version FROM data_versions WHERE name = ?', (self.version_name,))
+        row = cursor.fetchone()
+        version = row['version'] if row else 0
+        if version != self._version:
+            value = self.load(cursor)
+            with self._lock:
+                self._value = value
+                self._version = version
+        self._checked_at = now
+        return self._value
+
+
+# ------------ 学号姓名校验索引 ------------
+def normalize_name(name):
+    """姓名比较规则：去首尾空白、不区分大小写"""
+    return (name or '').strip().lower()
+
+
+class RosterIndex(VersionedCache):
+    """
+    valid_ids 的内存索引：student_id -> (姓名, 规范化姓名)，领票校验不再查库
+
+    规范化姓名与原姓名相同时共用同一个字符串对象，5 万人名单约几 MB。
+    学号库修改后（api_add_validid / api_delete_validid 或外部脚本）自动重建。
+    """
+
+    version_name = 'valid_ids'
+    interval_key = 'ROSTER_CHECK_INTERVAL'
+
+    def invalidate(self):
+        super().invalidate()
+        rejection_cache.clear()
+
+    def load(self, cursor):
+        rejection_cache.clear()
+        cursor.execute('SELECT student_id, student_name FROM valid_ids')
+        entries = {}
+        for row in cursor.fetchall():
+            name = row['student_name'] or ''
+            norm = normalize_name(name)
+            entries[row['student_id']] = (name, name if norm == name else norm)
+        return entries
+
+    def lookup(self, conn, student_id):
+        """返回 (姓名, 规范化姓名)，学号不存在返回 None"""
+        return self.get(conn).get(student_id)
+
+    def __len__(self):
+        return len(self._value or ())
+
+
+roster_index = RosterIndex()
+
+
+# ------------ 校验失败结果缓存 ------------
+app.config['REJECTION_CACHE_SIZE'] = int(os.environ.get('REJECTION_CACHE_SIZE', 10000))    # 最多缓存的 (学号, 姓名) 失败结果数，0 关闭
+app.config['REJECTION_CACHE_TTL'] = float(os.environ.get('REJECTION_CACHE_TTL', 60))       # 失败结果最长保留秒数
+
+
+class RejectionCache:
+    """
+    最近校验失败的 (学号, 规范化姓名) -> 失败消息（"学号不合法" / "姓名与学号不匹配"），LRU + TTL
+
+    - 同一个人反复提交同样的错误学号 / 姓名时，ticket() 在取数据库连接之前直接返回，不再走完整流程
+    - 每条记录带上生成它时的学号库版本号，版本变化（本 worker 改学号库，或其它 worker 的修改被 RosterIndex 发现）
+      时整体清空；版本号不一致的记录不会被使用
+    - 命中 / 未命中次数见指标 ticket_rejection_cache_total
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()    # key -> (消息, 学号库版本号, 过期时间)
+
+    def get(self, key, version):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] != version or entry[2] <= now):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        metrics.inc('ticket_rejection_cache_total', (('result', 'miss' if entry is None else 'hit'),))
+        return None if entry is None else entry[0]
+
+    def put(self, key, msg, version):
+        size = app.config['REJECTION_CACHE_SIZE']
+        if size <= 0 or version is None:
+            return
+        with self._lock:
+            self._entries[key] = (msg, version, time.monotonic() + app.config['REJECTION_CACHE_TTL'])
+            self._entries.move_to_end(key)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+rejection_cache = RejectionCache()
+
+
+# ------------ 控制开关缓存 ------------
+class ControlState(VersionedCache):
+    """
+    取票窗口、本地密钥开关、开放的座位集合：每场活动只变几次，领票时不再每次查库
+
+    管理员的三个开关接口修改后本进程立即失效，其它 worker 最多滞后 CONTROL_CHECK_INTERVAL 秒。
+    预约开放的集合缓存为 (时间戳, group_id)，到点后由 current_open_groups() 计入，不需要写库。
+    """
+
+    version_name = 'control'
+    interval_key = 'CONTROL_CHECK_INTERVAL'
+
+    def load(self, cursor):
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS seats (
-                seat_id INTEGER PRIMARY KEY,
-                pos TEXT NOT NULL,
-                occupied BOOLEAN NOT NULL DEFAULT 0,
-                student_id TEXT
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                student_id TEXT PRIMARY KEY,
-                seat_id INTEGER NOT NULL,
-                FOREIGN KEY (seat_id) REFERENCES seats(seat_id)
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS valid_ids (
-                student_id TEXT PRIMARY KEY
-            )
-        ''')
-        # 新增 IP 地址领票记录表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS ip_ticket_log (
-                ip_address TEXT PRIMARY KEY,
-                student_id TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        # 新增取票窗口状态表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS ticket_status (
-                id INTEGER PRIMARY KEY CHECK (id = 1),
-                is_open BOOLEAN DEFAULT 0
-            )
-        ''')
-        # 如果 ticket_status 表为空，插入默认状态（关闭）
-        cursor.execute('SELECT COUNT(*) as cnt FROM ticket_status')
-        if cursor.fetchone()['cnt'] == 0:
-            cursor.execute('INSERT INTO ticket_status (id, is_open) VALUES (1, 0)')
-        
-        # 新增座位集合状态表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS seat_groups (
-                id INTEGER PRIMARY KEY CHECK (id IN (1, 2)),
-                group_id INTEGER,
-                is_open BOOLEAN DEFAULT 0
-            )
-        ''')
-        # 如果 seat_groups 表为空，插入默认状态（两个集合都关闭）
-        cursor.execute('SELECT COUNT(*) as cnt FROM seat_groups')
-        if cursor.fetchone()['cnt'] == 0:
-            cursor.execute('INSERT INTO seat_groups (id, group_id, is_open) VALUES (1, 1, 0)')
-            cursor.execute('INSERT INTO seat_groups (id, group_id, is_open) VALUES (2, 2, 0)')
-        
-        # 为 seats 表添加 group_id 列（如果不存在）
-        cursor.execute("PRAGMA table_info(seats)")
-        cols = [row[1] for row in cursor.fetchall()]
-        if 'group_id' not in cols:
-            cursor.execute('ALTER TABLE seats ADD COLUMN group_id INTEGER DEFAULT 1')
-        
-        # 为 seats 表添加 row_num 列（如果不存在）
-        cursor.execute("PRAGMA table_info(seats)")
-        cols = [row[1] for row in cursor.fetchall()]
-        if 'row_num' not in cols:
-            cursor.execute('ALTER TABLE seats ADD COLUMN row_num INTEGER DEFAULT 0')
-        
-        # 为 seats 表添加 col_num 列（如果不存在）
-        cursor.execute("PRAGMA table_info(seats)")
-        cols = [row[1] for row in cursor.fetchall()]
-        if 'col_num' not in cols:
-            cursor.execute('ALTER TABLE seats ADD COLUMN col_num INTEGER DEFAULT 0')
-        
-        # 新增本地密钥开关表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS local_key_switch (
-                id INTEGER PRIMARY KEY CHECK (id = 1),
-                is_open BOOLEAN DEFAULT 0
-            )
+            SELECT (SELECT is_open FROM ticket_status WHERE id = 1) AS ticket_open,
+                   (SELECT is_open FROM local_key_switch WHERE id = 1) AS key_open
         ''')
-        # 如果 local_key_switch 表为空，插入默认状态（关闭）
-        cursor.execute('SELECT COUNT(*) as cnt FROM local_key_switch')
-        if cursor.fetchone()['cnt'] == 0:
-            cursor.execute('INSERT INTO local_key_switch (id, is_open) VALUES (1, 0)')
-        
-        # 新增说明信息表
+        row = cursor.fetchone()
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS info_section (
-                id INTEGER PRIMARY KEY CHECK (id = 1),
-                content TEXT DEFAULT ''
-            )
+            SELECT group_id, is_open, open_at FROM seat_groups
+            WHERE is_open = 1 OR open_at IS NOT NULL ORDER BY group_id
         ''')
-        # 如果 info_section 表为空，插入默认内容
-        cursor.execute('SELECT COUNT(*) as cnt FROM info_section')
-        if cursor.fetchone()['cnt'] == 0:
-            default_content = '''欢迎参加"智启新元，AI创未来"迎新晚会！请按照以下说明进行领票：
+        open_groups, scheduled = [], []
+        for r in cursor.fetchall():
+            at = open_at_timestamp(r['open_at'])
+            if r['is_open']:
+                open_groups.append(r['group_id'])
+            elif at is not None:
+                scheduled.append((at, r['group_id']))
+        return {
+            'ticket_open': bool(row['ticket_open']),
+            'key_open': bool(row['key_open']),
+            'open_groups': tuple(open_groups),
+            'scheduled': tuple(sorted(scheduled)),
+            'due_groups': {}     # 已到点的预约个数 -> 当前开放集合，current_open_groups 按需填充
+        }
+
+
+control_state = ControlState()
+
+
+def current_open_groups(control, now=None):
+    """当前可分配的集合：已开放的 + 预约开放时间已到的"""
+    scheduled = control['scheduled']
+    now = time.time() if now is None else now
+    if not scheduled or scheduled[0][0] > now:
+        return control['open_groups']
+    due = bisect.bisect_right(scheduled, (now, float('inf')))
+    groups = control['due_groups'].get(due)
+    if groups is None:
+        groups = control['due_groups'][due] = control['open_groups'] + tuple(g for _, g in scheduled[:due])
+    return groups
+
+
+# ------------ 原子领票事务 ------------
+CLAIM_MAX_RETRIES = 5        # 数据库被锁（SQLITE_BUSY）时的最大重试次数
+CLAIM_BACKOFF_BASE = 0.02    # 退避基数（秒），每次翻倍并加随机抖动
+CLAIM_BACKOFF_MAX = 0.5      # 单次退避上限（秒）
+
+
+class ClaimBusy(Exception):
+    """多次重试后数据库仍然被锁"""
+
+
+def _is_busy_error(e):
+    msg = str(e).lower()
+    return 'locked' in msg or 'busy' in msg
+
+
+def claim_seat(conn, student_id, student_name, client_ip, open_groups):
+    """
+    原子领票：在一个 BEGIN IMMEDIATE 事务内完成重复检查、IP 检查、
+    座位占用（条件 UPDATE + 行数检查）以及 users / ip_ticket_log 写入
+
+    返回 (outcome, value)：
+      ('ok', (seat, ticket_seq))          分配成功，seat 为座位池元组
+      ('exists', (seat_id, ticket_seq))   该学号已有座位（并发重复提交）
+      ('ip_limited', None)                该 IP 已为其他学号领过票
+      ('sold_out', None)                  开放集合中已无空位
+    数据库被锁时回滚并指数退避重试，超过 CLAIM_MAX_RETRIES 次抛出 ClaimBusy
+    """
+    return _retry_busy(_claim_once, conn, student_id, student_name, client_ip, open_groups)
+
+
+def _retry_busy(fn, *args):
+    for attempt in range(CLAIM_MAX_RETRIES + 1):
+        try:
+            return fn(*args)
+        except sqlite3.OperationalError as e:
+            if not _is_busy_error(e):
+                raise
+            metrics.inc('ticket_claim_busy_retries_total')
+            if attempt == CLAIM_MAX_RETRIES:
+                break
+            delay = min(CLAIM_BACKOFF_MAX, CLAIM_BACKOFF_BASE * (2 ** attempt))
+            time.sleep(delay * random.uniform(0.5, 1.0))
+    raise ClaimBusy()
+
+
+def _claim_once(conn, student_id, student_name, client_ip, open_groups):
+    cursor = conn.cursor()
+    # IMMEDIATE：事务开始即拿写锁，之后的检查和写入不会与其它 worker 交错（耗时即等锁时间）
+    with metrics.timer('ticket_db_query_seconds', query='claim_lock_wait'):
+        cursor.execute('BEGIN IMMEDIATE')
+    result = None
+    try:
+        outcome, result = _claim_steps(conn, cursor, student_id, student_name, client_ip, open_groups)
+        if outcome != 'ok':
+            conn.rollback()
+            return outcome, result
+        with metrics.timer('ticket_db_query_seconds', query='claim_commit'):
+            conn.commit()
+        return outcome, result
+    except Exception:
+        # 回滚后座位在库中仍是空闲的，放回池中（_claim_steps 内部出错时已自行放回）
+        conn.rollback()
+        if result is not None:
+            seat_pool.release(result[0])
+        raise
+
+
+def _claim_steps(conn, cursor, student_id, student_name, client_ip, open_groups):
+    """领票事务的主体：调用方已持有写锁并负责提交 / 回滚，只有返回 'ok' 时才有写入"""
+    cursor.execute('SELECT seat_id, ticket_seq FROM users WHERE student_id = ?', (student_id,))
+    row = cursor.fetchone()
+    if row:
+        return 'exists', (row['seat_id'], row['ticket_seq'])
+
+    cursor.execute('SELECT 1 FROM ip_ticket_log WHERE ip_address = ? AND student_id != ?',
+                   (client_ip, student_id))
+    if cursor.fetchone():
+        return 'ip_limited', None
+
+    seat = None
+    try:
+        # 池中的座位可能已被其它 worker 占用：条件 UPDATE 失败就丢弃，继续取下一个；
+        # 池取空时按计数表判断是否需要从数据库重建（最多一次），仍取不到才算领完
+        reloaded = False
+        while True:
+            seat = seat_pool.pop(conn, open_groups, app.config['SEAT_POLICY'])
+            if seat is None:
+                if reloaded or not seat_pool.refill(conn, open_groups):
+                    return 'sold_out', None
+                reloaded = True
+                continue
+            cursor.execute('UPDATE seats SET occupied = 1, student_id = ? WHERE seat_id = ? AND occupied = 0 AND group_id = ?',
+                           (student_id, seat[0], seat[4]))
+            if cursor.rowcount == 1:
+                break
+            seat = None
+
+        # 票号：持写锁时从序列行取下一个号，与 users 行一起提交，并发下不会重复
+        cursor.execute('UPDATE ticket_sequence SET last_seq = last_seq + 1 WHERE id = 1')
+        cursor.execute('SELECT last_seq FROM ticket_sequence WHERE id = 1')
+        ticket_seq = cursor.fetchone()['last_seq']
+        cursor.execute('INSERT INTO users (student_id, seat_id, student_name, pos, ticket_seq) VALUES (?, ?, ?, ?, ?)',
+                       (student_id, seat[0], student_name, seat[1], ticket_seq))
+        cursor.execute('INSERT INTO ip_ticket_log (ip_address, student_id) VALUES (?, ?)',
+                       (client_ip, student_id))
+        return 'ok', (seat, ticket_seq)
+    except Exception:
+        # 本次的修改会被回滚，座位在库中仍是空闲的，放回池中
+        if seat is not None:
+            seat_pool.release(seat)
+        raise
+
+
+def claim_batch(conn, jobs, before_commit=None):
+    """
+    在一个事务内依次处理多个领票请求（写入线程批量领票用）
+
+    jobs 中每项需有 student_id / student_name / client_ip / open_groups 属性，
+    返回与之一一对应的 (outcome, value)，含义同 claim_seat；单个请求出错时
+    只回滚它自己的 SAVEPOINT，结果为 ('error', 异常)，不影响同批其它请求。
+    before_commit(cursor, results) 在提交前调用，可把结果与座位一起写入。
+    数据库被锁时整批回滚并退避重试，超过 CLAIM_MAX_RETRIES 次抛出 ClaimBusy
+    """
+    return _retry_busy(_claim_batch_once, conn, jobs, before_commit)
+
+
+def _claim_batch_once(conn, jobs, before_commit):
+    cursor = conn.cursor()
+    with metrics.timer('ticket_db_query_seconds', query='claim_lock_wait'):
+        cursor.execute('BEGIN IMMEDIATE')
+    results = []
+    try:
+        for job in jobs:
+            cursor.execute('SAVEPOINT claim')
+            try:
+                outcome, result = _claim_steps(conn, cursor, job.student_id, job.student_name,
+                                               job.client_ip, job.open_groups)
+            except Exception as e:
+                cursor.execute('ROLLBACK TO claim')
+                outcome, result = 'error', e
+            cursor.execute('RELEASE claim')
+            results.append((outcome, result))
+        if before_commit is not None:
+            before_commit(cursor, results)
+        with metrics.timer('ticket_db_query_seconds', query='claim_commit'):
+            conn.commit()
+        return results
+    except Exception:
+        conn.rollback()
+        for outcome, result in results:
+            if outcome == 'ok':
+                seat_pool.release(result[0])
+        raise
+
+
+# ------------ 公开状态快照缓存 ------------
+app.config['STATUS_CACHE_TTL'] = float(os.environ.get('STATUS_CACHE_TTL', 1.0))            # 快照最长有效期（秒）
+app.config['STATUS_CACHE_MIN_INTERVAL'] = float(os.environ.get('STATUS_CACHE_MIN_INTERVAL', 0.2))  # 领票触发重建的最小间隔
+
+
+def build_status_snapshot(conn):
+    """首页需要的全部状态：剩余座位、取票窗口、本地密钥开关、座位集合、说明信息"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT (SELECT is_open FROM ticket_status WHERE id = 1) AS ticket_open,
+               (SELECT is_open FROM local_key_switch WHERE id = 1) AS key_open,
+               (SELECT content FROM info_section WHERE id = 1) AS info,
+               (SELECT IFNULL(SUM(total), 0) FROM seat_counters) AS total,
+               (SELECT IFNULL(SUM(occupied), 0) FROM seat_counters) AS occupied
+    ''')
+    flags = cursor.fetchone()
+    return {
+        'available': flags['total'] - flags['occupied'],
+        'total': flags['total'],
+        'ticket_status': int(flags['ticket_open'] or 0),
+        'local_key_switch': int(flags['key_open'] or 0),
+        'seat_groups': read_seat_groups(cursor),
+        'info_section': flags['info'] or ''
+    }
+
+
+class StatusCache:
+    """
+    /api/status 的进程内缓存，保存序列化好的快照和它的 ETag
+
+    - 管理员修改状态后本进程立即失效（invalidate）
+    - 领票成功只标记过期（mark_dirty），距上次生成不足 STATUS_CACHE_MIN_INTERVAL 秒时继续使用，
+      避免抢票高峰每次领票都触发重建
+    - 其它 worker 的修改最多滞后 STATUS_CACHE_TTL 秒
+    - ETag 取自内容哈希，各 worker 内容相同则 ETag 相同
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._body = None
+        self._etag = None
+        self._built_at = 0.0
+        self._expires = 0.0
+        self._generation = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._expires = 0.0
+            self._generation += 1
+
+    def mark_dirty(self):
+        with self._lock:
+            self._expires = min(self._expires, self._built_at + app.config['STATUS_CACHE_MIN_INTERVAL'])
+            self._generation += 1
+
+    def peek(self):
+        """快照未过期时返回 (body, etag)，否则返回 None；不查库（异步入口据此决定是否放到线程池）"""
+        with self._lock:
+            if self._body is not None and time.monotonic() < self._expires:
+                return self._body, self._etag
+        return None
+
+    def get(self):
+        """返回 (body, etag)；同一时刻只有一个线程重建，其余线程先用旧快照"""
+        with self._lock:
+            if self._body is not None and time.monotonic() < self._expires:
+                return self._body, self._etag
+            generation = self._generation
+        if not self._build_lock.acquire(blocking=self._body is None):
+            return self._body, self._etag
+        try:
+            with get_db() as conn:
+                snapshot = build_status_snapshot(conn)
+            body = json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            etag = hashlib.sha1(body).hexdigest()[:16]
+            now = time.monotonic()
+            with self._lock:
+                self._body, self._etag, self._built_at = body, etag, now
+                # 生成期间又有修改：本次结果只临时使用，下次请求重新生成
+                if generation == self._generation:
+                    self._expires = now + app.config['STATUS_CACHE_TTL']
+            return body, etag
+        finally:
+            self._build_lock.release()
+
+
+status_cache = StatusCache()
+
+
+# ------------ 状态推送（SSE） ------------
+app.config['STATUS_STREAM_ENABLED'] = os.environ.get('STATUS_STREAM_ENABLED', '0') == '1'     # 开启 /api/stream/status（需要异步 / 多线程 worker）
+app.config['STATUS_STREAM_MAX_RATE'] = float(os.environ.get('STATUS_STREAM_MAX_RATE', 2.0))    # 每秒最多推送次数
+app.config['STATUS_STREAM_HEARTBEAT'] = float(os.environ.get('STATUS_STREAM_HEARTBEAT', 15.0))  # 无变化时的心跳间隔（秒）
+
+
+class StatusPublisher:
+    """
+    /api/stream/status 的推送源：每个 worker 一个后台线程从 status_cache 取快照，
+    内容（ETag）变化时唤醒所有订阅连接
+
+    - 每秒最多检查 STATUS_STREAM_MAX_RATE 次，期间的多次变化合并为一次推送
+    - 查库次数与连接数无关；没有订阅者时线程休眠，不查询
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._body = None
+        self._etag = None
+        self._seq = 0            # 每发布一次新快照加 1
+        self._subscribers = 0
+        self._thread = None
+        self._pid = None
+
+    def subscribe(self):
+        with self._cond:
+            self._subscribers += 1
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='status-publisher', daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def unsubscribe(self):
+        with self._cond:
+            self._subscribers -= 1
+
+    def subscribers(self):
+        return self._subscribers
+
+    def wait(self, seen_seq, timeout):
+        """等待 seen_seq 之后的新快照，返回 (seq, body, etag)；超时返回原 seq"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq != seen_seq, timeout)
+            return self._seq, self._body, self._etag
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._subscribers > 0)
+            try:
+                body, etag = status_cache.get()
+            except Exception:
+                body = None
+            if body is not None and etag != self._etag:
+                with self._cond:
+                    self._body, self._etag = body, etag
+                    self._seq += 1
+                    self._cond.notify_all()
+            time.sleep(1 / app.config['STATUS_STREAM_MAX_RATE'])
+
+
+status_publisher = StatusPublisher()
+
+
+def claim_group(conn, members, client_ip, open_groups):
+    """
+    连座领票：members 为 [(student_id, 姓名), ...]（第一个是提交人），在一个 BEGIN IMMEDIATE 事务内
+    为所有人分配同一集合同一排相邻的座位，要么全部成功要么都不写入；IP 只记录在提交人名下
+
+    返回 (outcome, value)：
+      ('ok', [(student_id, 姓名, seat, ticket_seq), ...])   与 members 顺序一致，座位按列号从小到大
+      ('exists', [student_id, ...])                          这些学号已领过票
+      ('ip_limited', None)                                   该 IP 已为其他学号领过票
+      ('no_block', None)                                     开放集合中没有足够的相邻空位
+    数据库被锁时回滚并指数退避重试，超过 CLAIM_MAX_RETRIES 次抛出 ClaimBusy
+    """
+    return _retry_busy(_claim_group_once, conn, members, client_ip, open_groups)
+
+
+def _claim_group_once(conn, members, client_ip, open_groups):
+    cursor = conn.cursor()
+    with metrics.timer('ticket_db_query_seconds', query='claim_lock_wait'):
+        cursor.execute('BEGIN IMMEDIATE')
+    ids = [student_id for student_id, _ in members]
+    block = None
+    try:
+        cursor.execute(f"SELECT student_id FROM users WHERE student_id IN ({', '.join('?' * len(ids))})", ids)
+        claimed = sorted(row['student_id'] for row in cursor.fetchall())
+        if claimed:
+            conn.rollback()
+            return 'exists', claimed
+        cursor.execute('SELECT student_id FROM ip_ticket_log WHERE ip_address = ?', (client_ip,))
+        row = cursor.fetchone()
+        if row and row['student_id'] not in ids:
+            conn.rollback()
+            return 'ip_limited', None
+
+        # 与单人领票相同：池中的连座可能有座位已被其它 worker 占用，撤销这一块的占用再找下一块；
+        # 找不到时按计数表判断是否需要从数据库重建（最多一次）
+        reloaded = False
+        while True:
+            block = seat_pool.pop_block(conn, open_groups, len(members), app.config['SEAT_POLICY'])
+            if block is None:
+                if reloaded or not seat_pool.refill(conn, open_groups):
+                    conn.rollback()
+                    return 'no_block', None
+                reloaded = True
+                continue
+            cursor.execute('SAVEPOINT block')
+            lost = None
+            for seat, student_id in zip(block, ids):
+                # 排列号也要核对：池里的旧布局可能已把这几个座位改到了不相邻的位置
+                cursor.execute('''UPDATE seats SET occupied = 1, student_id = ?
+                                  WHERE seat_id = ? AND occupied = 0 AND group_id = ? AND row_num = ? AND col_num = ?''',
+                               (student_id, seat[0], seat[4], seat[2], seat[3]))
+                if cursor.rowcount != 1:
+                    lost = seat
+                    break
+            if lost is None:
+                cursor.execute('RELEASE block')
+                break
+            cursor.execute('ROLLBACK TO block')
+            cursor.execute('RELEASE block')
+            for seat in block:
+                if seat is not lost:
+                    seat_pool.release(seat)
+            block = None
+
+        tickets = []
+        for (student_id, student_name), seat in zip(members, block):
+            cursor.execute('UPDATE ticket_sequence SET last_seq = last_seq + 1 WHERE id = 1')
+            cursor.execute('SELECT last_seq FROM ticket_sequence WHERE id = 1')
+            ticket_seq = cursor.fetchone()['last_seq']
+            cursor.execute('INSERT INTO users (student_id, seat_id, student_name, pos, ticket_seq) VALUES (?, ?, ?, ?, ?)',
+                           (student_id, seat[0], student_name, seat[1], ticket_seq))
+            tickets.append((student_id, student_name, seat, ticket_seq))
+        cursor.execute('INSERT OR IGNORE INTO ip_ticket_log (ip_address, student_id) VALUES (?, ?)',
+                       (client_ip, ids[0]))
+        with metrics.timer('ticket_db_query_seconds', query='claim_commit'):
+            conn.commit()
+        return 'ok', tickets
+    except Exception:
+        conn.rollback()
+        for seat in block or ():
+            seat_pool.release(seat)
+        raise
+
+
+def format_ticket_no(ticket_seq):
+    """票号 = 场次前缀 + 至少三位序号，例如 NO.251221045"""
+    return f"{app.config['TICKET_PREFIX']}{ticket_seq:03d}"
+
+
+def existing_ticket_body(cursor, seat_id, ticket_seq):
+    """已领取过的学号：返回原有座位和票号（票号在领票时已写入 users.ticket_seq）"""
+    cursor.execute('''
+        SELECT pos, row_num, col_num FROM seats WHERE seat_id = ?
+    ''', (seat_id,))
+    seat = cursor.fetchone()
+    return {
+        "status": "ok",
+        "msg": "你已领取过",
+        "seat": seat_id,
+        "pos": seat['pos'],
+        "row_num": seat['row_num'],
+        "col_num": seat['col_num'],
+        "ticket_no": format_ticket_no(ticket_seq)
+    }
+
+
+def claim_outcome_body(cursor, outcome, result):
+    """把 claim_seat / claim_batch 的结果转换为 (状态码, 响应内容)"""
+    if outcome == 'ok':
+        seat, ticket_seq = result
+        seat_id, pos, row_num, col_num, _ = seat
+        return 200, {
+            "status": "ok",
+            "msg": "领取成功",
+            "seat": seat_id,
+            "pos": pos,
+            "row_num": row_num,
+            "col_num": col_num,
+            "ticket_no": format_ticket_no(ticket_seq)
+        }
+    if outcome == 'exists':
+        return 200, existing_ticket_body(cursor, *result)
+    if outcome == 'ip_limited':
+        return 400, {"status": "fail", "msg": "你只能领取一张票"}
+    if outcome == 'sold_out':
+        return 400, {"status": "fail", "msg": "票已领完"}
+    return 500, {"status": "fail", "msg": str(result)}
+
+
+def group_outcome_body(outcome, result):
+    """
+    把 claim_group 的结果转换为 (状态码, 响应内容)；成功时顶层字段为提交人的票，group 为全部成员的票
+
+    msg 只用固定文案（会作为指标标签），涉及的学号放在 detail / claimed 中
+    """
+    if outcome == 'ok':
+        tickets = [{
+            "student_id": student_id,
+            "student_name": student_name,
+            "seat": seat[0],
+            "pos": seat[1],
+            "row_num": seat[2],
+            "col_num": seat[3],
+            "ticket_no": format_ticket_no(ticket_seq)
+        } for student_id, student_name, seat, ticket_seq in result]
+        body = {"status": "ok", "msg": "领取成功"}
+        body.update((k, tickets[0][k]) for k in ("seat", "pos", "row_num", "col_num", "ticket_no"))
+        body["group"] = tickets
+        return 200, body
+    if outcome == 'exists':
+        return 400, {"status": "fail", "msg": "以下学号已领过票", "detail": '、'.join(result), "claimed": result}
+    if outcome == 'ip_limited':
+        return 400, {"status": "fail", "msg": "你只能领取一张票"}
+    if outcome == 'no_block':
+        return 400, {"status": "fail", "msg": "没有足够的相邻座位，请减少人数或分别领取"}
+    return 500, {"status": "fail", "msg": str(result)}
+
+
+# ------------ 排队领票模式 ------------
+app.config['CLAIM_MODE'] = os.environ.get('CLAIM_MODE', 'sync')                      # sync：请求内直接领票；queue：入队后轮询结果
+app.config['CLAIM_QUEUE_MAX'] = int(os.environ.get('CLAIM_QUEUE_MAX', 5000))          # 每个 worker 排队上限，超过返回 503
+app.config['CLAIM_BATCH_SIZE'] = int(os.environ.get('CLAIM_BATCH_SIZE', 64))          # 写入线程每个事务处理的请求数
+app.config['CLAIM_RESULT_TIMEOUT'] = int(os.environ.get('CLAIM_RESULT_TIMEOUT', 120))  # 凭证超过这么多秒仍无结果视为失效
+app.config['CLAIM_RESULT_TTL'] = int(os.environ.get('CLAIM_RESULT_TTL', 600))          # 领票结果保留秒数，过期后凭证查不到结果
+CLAIM_RESULT_PRUNE_INTERVAL = 60    # 写入线程每隔这么多秒清理一次过期结果
+
+
+def new_claim_token():
+    """排队凭证：毫秒时间戳（十六进制）+ 随机串，查询时据此判断是否过期"""
+    return f'{int(time.time() * 1000):x}-{secrets.token_hex(8)}'
+
+
+def claim_token_time(token):
+    """凭证的签发时间（秒），格式不对抛出 ValueError"""
+    stamp, _, rand = token.partition('-')
+    if len(rand) != 16:
+        raise ValueError(token)
+    int(rand, 16)
+    return int(stamp, 16) / 1000
+
+
+class ClaimJob:
+    __slots__ = ('token', 'student_id', 'student_name', 'client_ip', 'open_groups',
+                 'outcome', 'result', 'error', 'done')
+
+    def __init__(self, student_id, student_name, client_ip, open_groups, token=None):
+        self.token = token
+        self.student_id = student_id
+        self.student_name = student_name
+        self.client_ip = client_ip
+        self.open_groups = open_groups
+        self.outcome = self.result = self.error = None
+        self.done = threading.Event()
+
+
+class ClaimWriter:
+    """
+    领票写入线程基类：请求线程把 ClaimJob 放入队列，每个 worker 一个写入线程按到达顺序取出，
+    每次最多 CLAIM_BATCH_SIZE 个交给 claim_batch 在一个事务内处理
+
+    子类可覆盖：_window()（取到第一个请求后再等多久凑批）、_store()（提交前写入额外数据）、
+    _failed_batch()（整批失败时的处理，返回 True 表示已放回队列）、_finish()（通知等待方）
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._jobs = deque()
+        self._thread = None
+        self._pid = None
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def _window(self):
+        return 0.0
+
+    def _enqueue(self, job):
+        # 调用方需持有 self._cond
+        self._jobs.append(job)
+        self._ensure_writer()
+        self._cond.notify()
+
+    def _ensure_writer(self):
+        # fork 之后线程不会被继承，每个 worker 进程各自启动写入线程
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+            self._thread.start()
+
+    def _take_batch(self):
+        size = app.config['CLAIM_BATCH_SIZE']
+        with self._cond:
+            while not self._jobs:
+                self._cond.wait()
+            window = self._window()
+            if window > 0 and len(self._jobs) < size:
+                self._cond.wait_for(lambda: len(self._jobs) >= size, timeout=window)
+            return [self._jobs.popleft() for _ in range(min(len(self._jobs), size))]
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                with get_db() as conn:
+                    results = claim_batch(conn, batch,
+                                          before_commit=lambda cursor, results: self._store(cursor, batch, results))
+            except Exception as e:
+                if self._failed_batch(batch, e):
+                    continue
+                for job in batch:
+                    job.error = e
+            else:
+                for job, (outcome, result) in zip(batch, results):
+                    job.outcome, job.result = outcome, result
+                if any(outcome == 'ok' for outcome, _ in results):
+                    status_cache.mark_dirty()
+            self._finish(batch)
+
+    def _store(self, cursor, batch, results):
+        pass
+
+    def _failed_batch(self, batch, error):
+        return False
+
+    def _finish(self, batch):
+        for job in batch:
+            job.done.set()
+
+
+class ClaimQueue(ClaimWriter):
+    """
+    排队模式（CLAIM_MODE=queue）：请求通过校验后入队并立即拿到凭证，不在请求内等待写锁
+
+    - 只在本 worker 内先进先出：各 worker 的写入线程按拿到写锁的先后交替，不保证跨 worker 的到达顺序
+    - 写入线程的结果与座位一起提交到 claim_results 表，
+      任何 worker 都能通过 /ticket/result/<token> 查到；本 worker 的请求可以等待事件，不必轮询数据库
+    - 结果只保留 CLAIM_RESULT_TTL 秒：写入线程定期删除 claim_results 中过期的行，_failed 也随之清理
+    - 同一学号在本 worker 排队期间重复提交，返回同一个凭证
+    - 写锁多次获取失败时整批放回队首，稍后重试，不会丢失或打乱顺序
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._by_student = {}    # 本 worker 尚未处理完的请求
+        self._by_token = {}
+        self._failed = {}        # token -> (状态码, 响应内容, 失败时间)：整批失败、结果未能写入数据库的请求
+        self._pruned_at = 0.0
+
+    def submit(self, student_id, student_name, client_ip, open_groups):
+        """入队，返回 (job, 前面排队的人数)；队列已满返回 (None, None)"""
+        with self._cond:
+            job = self._by_student.get(student_id)
+            if job is not None:
+                return job, len(self._jobs)
+            if len(self._jobs) >= app.config['CLAIM_QUEUE_MAX']:
+                return None, None
+            job = ClaimJob(student_id, student_name, client_ip, open_groups, token=new_claim_token())
+            position = len(self._jobs)
+            self._by_student[student_id] = job
+            self._by_token[job.token] = job
+            self._enqueue(job)
+            return job, position
+
+    def wait(self, token, timeout):
+        """等待本 worker 中的请求处理完成；不是本 worker 的请求则只是休眠 timeout 秒"""
+        job = self._by_token.get(token)
+        if job is not None:
+            job.done.wait(timeout)
+        else:
+            time.sleep(timeout)
+
+    def failed(self, token):
+        """整批失败的请求返回 (状态码, 响应内容)，否则返回 None"""
+        failed = self._failed.get(token)
+        if failed is None or time.time() - failed[2] > app.config['CLAIM_RESULT_TTL']:
+            return None
+        return failed[:2]
+
+    def _prune_failed(self, now):
+        # 只有写入线程修改 _failed；请求线程只读，整体替换不会读到一半的字典
+        expire = now - app.config['CLAIM_RESULT_TTL']
+        if any(failed_at < expire for _, _, failed_at in self._failed.values()):
+            self._failed = {token: failed for token, failed in self._failed.items() if failed[2] >= expire}
+
+    def _store(self, cursor, batch, results):
+        now = time.time()
+        if now - self._pruned_at >= CLAIM_RESULT_PRUNE_INTERVAL:
+            cursor.execute('DELETE FROM claim_results WHERE finished_at < ?', (now - app.config['CLAIM_RESULT_TTL'],))
+            self._prune_failed(now)
+            self._pruned_at = now
+        rows = []
+        for job, (outcome, result) in zip(batch, results):
+            code, body = claim_outcome_body(cursor, outcome, result)
+            msg = body['msg'] if code < 500 else 'internal error'
+            metrics.inc('ticket_claim_queue_outcomes_total', (('status', code), ('msg', msg)))
+            rows.append((job.token, job.student_id, code, json.dumps(body, ensure_ascii=False), now))
+        cursor.executemany('''
+            INSERT INTO claim_results (token, student_id, status_code, body, finished_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', rows)
+
+    def _failed_batch(self, batch, error):
+        if isinstance(error, ClaimBusy):
+            with self._cond:
+                self._jobs.extendleft(reversed(batch))
+            time.sleep(CLAIM_BACKOFF_MAX)
+            return True
+        now = time.time()
+        self._prune_failed(now)
+        for job in batch:
+            self._failed[job.token] = (500, {"status": "fail", "msg": "领票失败，请稍后重试", "detail": str(error)}, now)
+        return False
+
+    def _finish(self, batch):
+        with self._cond:
+            for job in batch:
+                if self._by_student.get(job.student_id) is job:
+                    del self._by_student[job.student_id]
+                self._by_token.pop(job.token, None)
+        super()._finish(batch)
+
+
+claim_queue = ClaimQueue()
+
+
+# ------------ 组提交（同步模式） ------------
+app.config['CLAIM_COMMIT_WINDOW_MS'] = float(os.environ.get('CLAIM_COMMIT_WINDOW_MS', 0))  # 大于 0 时启用组提交，凑批等待的毫秒数
+
+
+class GroupCommitWriter(ClaimWriter):
+    """
+    同步模式的组提交：请求线程把领票交给写入线程并等待结果，
+    CLAIM_COMMIT_WINDOW_MS 毫秒内到达的请求（以及上一批提交期间到达的请求）在同一个事务里提交，
+    多张票只需一次提交；每个请求拿到自己的结果，单个请求出错只回滚它自己的 SAVEPOINT
+    """
+
+    def _window(self):
+        return app.config['CLAIM_COMMIT_WINDOW_MS'] / 1000
+
+    def claim(self, student_id, student_name, client_ip, open_groups):
+        """返回值与 claim_seat 相同；整批多次被锁时抛出 ClaimBusy，单个请求出错时抛出对应异常"""
+        job = ClaimJob(student_id, student_name, client_ip, open_groups)
+        with self._cond:
+            self._enqueue(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        if job.outcome == 'error':
+            raise job.result
+        return job.outcome, job.result
+
+
+group_commit = GroupCommitWriter()
+
+
+# ------------ 座位计数（替代 COUNT(*) 扫描） ------------
+# seat_counters 按集合保存总数和已占用数，user_counter 保存已领票人数。
+# 所有对 seats / users 的增删改（领票、管理员操作、脚本）都由触发器同步，读接口只需查几行。
+# group_id 为 NULL 的座位计入 0 号集合（INTEGER PRIMARY KEY 不能存 NULL）。
+COUNTER_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS seat_counters (
+        group_id INTEGER PRIMARY KEY,
+        total INTEGER NOT NULL DEFAULT 0,
+        occupied INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS user_counter (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        cnt INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_seats_count_insert AFTER INSERT ON seats
+    BEGIN
+        INSERT OR IGNORE INTO seat_counters (group_id) VALUES (IFNULL(NEW.group_id, 0));
+        UPDATE seat_counters SET total = total + 1, occupied = occupied + (NEW.occupied != 0)
+        WHERE group_id = IFNULL(NEW.group_id, 0);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_seats_count_delete AFTER DELETE ON seats
+    BEGIN
+        UPDATE seat_counters SET total = total - 1, occupied = occupied - (OLD.occupied != 0)
+        WHERE group_id = IFNULL(OLD.group_id, 0);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_seats_count_update AFTER UPDATE OF occupied, group_id ON seats
+    WHEN (OLD.occupied != 0) != (NEW.occupied != 0) OR OLD.group_id IS NOT NEW.group_id
+    BEGIN
+        INSERT OR IGNORE INTO seat_counters (group_id) VALUES (IFNULL(NEW.group_id, 0));
+        UPDATE seat_counters SET total = total - 1, occupied = occupied - (OLD.occupied != 0)
+        WHERE group_id = IFNULL(OLD.group_id, 0);
+        UPDATE seat_counters SET total = total + 1, occupied = occupied + (NEW.occupied != 0)
+        WHERE group_id = IFNULL(NEW.group_id, 0);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_users_count_insert AFTER INSERT ON users
+    BEGIN
+        UPDATE user_counter SET cnt = cnt + 1 WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_users_count_delete AFTER DELETE ON users
+    BEGIN
+        UPDATE user_counter SET cnt = cnt - 1 WHERE id = 1;
+    END
+    ''',
+]
+
+# 票号序列：领票事务内显式取号；管理员接口等其它途径插入的 users 行（ticket_seq 为空）由触发器补号
+TICKET_SEQ_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS ticket_sequence (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        last_seq INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_users_ticket_seq ON users(ticket_seq)',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_users_ticket_seq AFTER INSERT ON users
+    WHEN NEW.ticket_seq IS NULL
+    BEGIN
+        UPDATE ticket_sequence SET last_seq = last_seq + 1 WHERE id = 1;
+        UPDATE users SET ticket_seq = (SELECT last_seq FROM ticket_sequence WHERE id = 1)
+        WHERE rowid = NEW.rowid;
+    END
+    ''',
+]
+
+# 数据版本号：表被修改时由触发器递增，各 worker 的内存缓存据此判断是否需要重新加载
+DATA_VERSION_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS data_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    "INSERT OR IGNORE INTO data_versions (name, version) VALUES ('valid_ids', 0)",
+    "INSERT OR IGNORE INTO data_versions (name, version) VALUES ('control', 0)",
+] + [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()} AFTER {event} ON {table}
+    BEGIN
+        UPDATE data_versions SET version = version + 1 WHERE name = '{name}';
+    END
+    '''
+    for table, name in (('valid_ids', 'valid_ids'), ('ticket_status', 'control'),
+                        ('local_key_switch', 'control'), ('seat_groups', 'control'))
+    for event in ('INSERT', 'UPDATE', 'DELETE')
+]
+
+# 座位布局版本号：增删座位或修改集合 / 位置时递增，各 worker 的座位池据此重建（领票只改 occupied，不触发）
+SEAT_VERSION_SCHEMA = [
+    "INSERT OR IGNORE INTO data_versions (name, version) VALUES ('seats', 0)",
+] + [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_seats_version_{name} AFTER {event} ON seats
+    BEGIN
+        UPDATE data_versions SET version = version + 1 WHERE name = 'seats';
+    END
+    '''
+    for name, event in (('insert', 'INSERT'), ('delete', 'DELETE'),
+                        ('update', 'UPDATE OF group_id, row_num, col_num, pos'))
+]
+
+# 排队模式的领票结果：与座位在同一事务写入，任何 worker 都能按凭证查询
+CLAIM_RESULT_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS claim_results (
+        token TEXT PRIMARY KEY,
+        student_id TEXT NOT NULL,
+        status_code INTEGER NOT NULL,
+        body TEXT NOT NULL,
+        finished_at REAL NOT NULL
+    )
+    ''',
+]
+
+_COUNT_SEATS_SQL = '''
+    SELECT IFNULL(group_id, 0) AS group_id, COUNT(*) AS total, SUM(occupied != 0) AS occupied
+    FROM seats GROUP BY IFNULL(group_id, 0)
+'''
+
+
+def rebuild_counters(cursor):
+    """从 seats / users 全量重新计算计数（初始化和一致性修复时使用）"""
+    cursor.execute('DELETE FROM seat_counters')
+    cursor.execute('INSERT INTO seat_counters (group_id, total, occupied) ' + _COUNT_SEATS_SQL)
+    cursor.execute('INSERT OR REPLACE INTO user_counter (id, cnt) VALUES (1, (SELECT COUNT(*) FROM users))')
+
+
+def check_counters(cursor):
+    """对比计数表与实际数据，返回不一致项的描述列表（为空表示一致）"""
+    cursor.execute(_COUNT_SEATS_SQL)
+    actual = {row['group_id']: (row['total'], row['occupied']) for row in cursor.fetchall()}
+    stored = read_seat_counters(cursor)
+    problems = []
+    for group_id in sorted(set(actual) | set(stored)):
+        if actual.get(group_id, (0, 0)) != stored.get(group_id, (0, 0)):
+            problems.append(f'集合 {group_id}：计数 (总数, 已占用) = {stored.get(group_id, (0, 0))}，'
+                            f'实际 = {actual.get(group_id, (0, 0))}')
+    cursor.execute('SELECT COUNT(*) AS cnt FROM users')
+    users = cursor.fetchone()['cnt']
+    counted = read_user_count(cursor)
+    if counted != users:
+        problems.append(f'用户数：计数 = {counted}，实际 = {users}')
+    return problems
+
+
+def read_seat_counters(cursor):
+    """{group_id: (total, occupied)}"""
+    cursor.execute('SELECT group_id, total, occupied FROM seat_counters')
+    return {row['group_id']: (row['total'], row['occupied']) for row in cursor.fetchall()}
+
+
+OPEN_AT_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M')
+
+
+def parse_open_at(value):
+    """预约开放时间（服务器本地时间）规范化为 'YYYY-MM-DD HH:MM:SS'；空值表示不预约，格式不对抛 ValueError"""
+    if value is None or str(value).strip() == '':
+        return None
+    text = str(value).strip()
+    for fmt in OPEN_AT_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            continue
+    raise ValueError(f'open_at 格式应为 YYYY-MM-DD HH:MM[:SS]：{text}')
+
+
+def open_at_timestamp(open_at):
+    """库中的预约时间 -> Unix 时间戳；为空或无法解析（例如外部工具写入）返回 None"""
+    try:
+        return datetime.strptime(open_at, '%Y-%m-%d %H:%M:%S').timestamp() if open_at else None
+    except (TypeError, ValueError):
+        return None
+
+
+def read_seat_groups(cursor, now=None):
+    """
+    各座位集合的名称、开关和余量，按 group_id 排序；一次查询（seat_groups 连接 seat_counters）
+
+    is_open 为当前是否可分配（已开放，或预约时间已到），open_at 为预约时间（未预约为 None）
+    """
+    now = time.time() if now is None else now
+    cursor.execute('''
+        SELECT g.group_id, g.name, g.is_open, g.open_at,
+               IFNULL(c.total, 0) AS total, IFNULL(c.occupied, 0) AS occupied
+        FROM seat_groups g LEFT JOIN seat_counters c ON c.group_id = g.group_id
+        ORDER BY g.group_id
+    ''')
+    groups = []
+    for row in cursor.fetchall():
+        at = open_at_timestamp(row['open_at'])
+        groups.append({
+            'group_id': row['group_id'],
+            'name': row['name'] or f"集合 {row['group_id']}",
+            'is_open': int(bool(row['is_open']) or (at is not None and at <= now)),
+            'open_at': row['open_at'],
+            'total': row['total'],
+            'available': row['total'] - row['occupied'],
+            'occupied': row['occupied']
+        })
+    return groups
+
+
+def ensure_seat_groups(cursor):
+    """座位里出现的每个 group_id 都在 seat_groups 中有一行（新集合默认关闭），返回新增的行数"""
+    cursor.execute('''
+        INSERT OR IGNORE INTO seat_groups (group_id, is_open)
+        SELECT group_id, 0 FROM seats WHERE group_id IS NOT NULL GROUP BY group_id
+    ''')
+    return cursor.rowcount
+
+
+def read_user_count(cursor):
+    cursor.execute('SELECT cnt FROM user_counter WHERE id = 1')
+    row = cursor.fetchone()
+    return row['cnt'] if row else 0
+
+
+# ------------ 数据库迁移 ------------
+# 每个迁移是一个函数，按顺序编号（从 1 开始），执行到的编号记在 PRAGMA user_version 中，每个迁移只执行一次。
+# 1~9 是引入编号之前 init_db 每次启动都要做的各步：user_version 为 0 的旧库可能已经有其中任意一部分，
+# 因此这几步都可以重复执行（IF NOT EXISTS / 缺列才加）。新的迁移追加在 MIGRATIONS 末尾，已发布的不要再改。
+MIGRATION_BUSY_TIMEOUT_MS = 60000   # 多个 worker 同时启动时，等待正在执行迁移的 worker 的最长时间
+
+
+def _add_columns(cursor, table, columns):
+    """缺少的列才添加：columns 为 [(列名, 定义)]，返回新加的列名"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    existing = {row[1] for row in cursor.fetchall()}
+    added = []
+    for name, decl in columns:
+        if name not in existing:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {decl}')
+            added.append(name)
+    return added
+
+
+def _migrate_base_tables(cursor):
+    """基础表：座位、用户、学号库、IP 领票记录、取票窗口、本地密钥开关、说明信息"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS seats (
+            seat_id INTEGER PRIMARY KEY,
+            pos TEXT NOT NULL,
+            occupied BOOLEAN NOT NULL DEFAULT 0,
+            student_id TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            student_id TEXT PRIMARY KEY,
+            seat_id INTEGER NOT NULL,
+            FOREIGN KEY (seat_id) REFERENCES seats(seat_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS valid_ids (
+            student_id TEXT PRIMARY KEY
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ip_ticket_log (
+            ip_address TEXT PRIMARY KEY,
+            student_id TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # 单行状态表（id 只能为 1）：没有记录时插入默认值
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ticket_status (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            is_open BOOLEAN DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO ticket_status (id, is_open) VALUES (1, 0)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS local_key_switch (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            is_open BOOLEAN DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO local_key_switch (id, is_open) VALUES (1, 0)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS info_section (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            content TEXT DEFAULT ''
+        )
+    ''')
+    default_content = '''欢迎参加"智启新元，AI创未来"迎新晚会！请按照以下说明进行领票：
 1.领票通道开放时间：XX日XX时。线上共开放135个座位，领完即止。
 2.每个设备限领一张票，同学们凭票入场。
 3.没有抢到票的同学不用气馁，剩下的票可通过服务点扫码线下领票，依旧先到先得。
 线下领票时间地点：'''
-            cursor.execute('INSERT INTO info_section (id, content) VALUES (1, ?)', (default_content,))
-        
-        conn.commit()
+    cursor.execute('INSERT OR IGNORE INTO info_section (id, content) VALUES (1, ?)', (default_content,))
+
+
+def _migrate_seat_layout(cursor):
+    """seats 增加集合编号和排 / 列号"""
+    _add_columns(cursor, 'seats', [('group_id', 'INTEGER DEFAULT 1'),
+                                   ('row_num', 'INTEGER DEFAULT 0'),
+                                   ('col_num', 'INTEGER DEFAULT 0')])
+
+
+def _migrate_names(cursor):
+    """users 增加姓名和座位位置（领票时写入），valid_ids 增加姓名（姓名校验）"""
+    _add_columns(cursor, 'users', [('student_name', 'TEXT'), ('pos', 'TEXT')])
+    _add_columns(cursor, 'valid_ids', [('student_name', 'TEXT')])
+
+
+def _migrate_seat_groups(cursor):
+    """座位集合状态表：集合数量不限，可命名、可预约开放时间"""
+    # 旧版 seat_groups 限定只有 1、2 两个集合（CHECK 约束无法 ALTER）：重建表，保留原有开关
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'seat_groups'")
+    row = cursor.fetchone()
+    if row and 'CHECK' in row['sql']:
+        cursor.execute('ALTER TABLE seat_groups RENAME TO seat_groups_old')
+    else:
+        row = None
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS seat_groups (
+            id INTEGER PRIMARY KEY,
+            group_id INTEGER NOT NULL UNIQUE,
+            name TEXT,
+            is_open BOOLEAN DEFAULT 0,
+            open_at TEXT
+        )
+    ''')
+    if row:
+        cursor.execute('''
+            INSERT OR IGNORE INTO seat_groups (id, group_id, is_open)
+            SELECT id, group_id, is_open FROM seat_groups_old WHERE group_id IS NOT NULL
+        ''')
+        cursor.execute('DROP TABLE seat_groups_old')
+    # 空表时插入默认的两个集合（都关闭）
+    cursor.execute('SELECT 1 FROM seat_groups LIMIT 1')
+    if cursor.fetchone() is None:
+        cursor.execute('INSERT INTO seat_groups (id, group_id, is_open) VALUES (1, 1, 0)')
+        cursor.execute('INSERT INTO seat_groups (id, group_id, is_open) VALUES (2, 2, 0)')
+    # 座位里用到的集合都要有开关行，否则永远无法开放
+    ensure_seat_groups(cursor)
+
+
+def _migrate_counters(cursor):
+    """座位 / 用户计数表（由触发器随 seats、users 的变化在同一事务内更新）"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'seat_counters'")
+    counters_exist = cursor.fetchone() is not None
+    for sql in COUNTER_SCHEMA:
+        cursor.execute(sql)
+    if not counters_exist:
+        rebuild_counters(cursor)
+
+
+def _migrate_ticket_sequence(cursor):
+    """票号序列：只增不减，删除用户后票号也不会复用"""
+    if _add_columns(cursor, 'users', [('ticket_seq', 'INTEGER')]):
+        # 已有用户沿用旧算法的票号：按插入顺序（rowid）编号
+        cursor.execute('''
+            UPDATE users SET ticket_seq =
+                (SELECT COUNT(*) FROM users u2 WHERE u2.rowid <= users.rowid)
+        ''')
+    for sql in TICKET_SEQ_SCHEMA:
+        cursor.execute(sql)
+    cursor.execute('''
+        INSERT OR IGNORE INTO ticket_sequence (id, last_seq)
+        VALUES (1, (SELECT IFNULL(MAX(ticket_seq), 0) FROM users))
+    ''')
+
+
+def _migrate_data_versions(cursor):
+    """数据版本表（内存缓存跨 worker 失效用）"""
+    for sql in DATA_VERSION_SCHEMA:
+        cursor.execute(sql)
+
+
+def _migrate_claim_results(cursor):
+    """排队领票结果表"""
+    for sql in CLAIM_RESULT_SCHEMA:
+        cursor.execute(sql)
+
+
+def _migrate_indexes(cursor):
+    """名单导出、集合统计、选座用的索引"""
+    # 名单导出按座位排序时直接走索引（按票号排序走 TICKET_SEQ_SCHEMA 的唯一索引）
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_seat_id ON users (seat_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_seats_layout ON seats (group_id, row_num, col_num)')
+    # 按集合统计 / 取空闲座位 / 按集合和占用状态筛选时只读索引
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_seats_group_occupied ON seats (group_id, occupied)')
+
+
+def _migrate_ip_log_student_index(cursor):
+    """ip_ticket_log 按学号的索引（管理员删除 / 修改用户时按学号清理领票记录）"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ip_ticket_log_student_id ON ip_ticket_log (student_id)')
+
+
+def _migrate_seat_version(cursor):
+    """seats 的布局版本号（座位池跨 worker 失效用）"""
+    for sql in SEAT_VERSION_SCHEMA:
+        cursor.execute(sql)
+
+
+MIGRATIONS = [
+    _migrate_base_tables,
+    _migrate_seat_layout,
+    _migrate_names,
+    _migrate_seat_groups,
+    _migrate_counters,
+    _migrate_ticket_sequence,
+    _migrate_data_versions,
+    _migrate_claim_results,
+    _migrate_indexes,
+    _migrate_ip_log_student_index,
+    _migrate_seat_version,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn):
+    """库中记录的迁移编号（PRAGMA user_version，新库为 0）"""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def pending_migrations(version):
+    """编号 version 之后的迁移：[(编号, 说明)]"""
+    return [(number, migration.__doc__.strip())
+            for number, migration in enumerate(MIGRATIONS[version:], version + 1)]
+
+
+def migrate_db(conn):
+    """
+    执行尚未执行的迁移，返回执行了的 [(编号, 说明)]；库已是最新时只查一次 PRAGMA user_version
+
+    待执行的迁移和新的 user_version 在同一个 BEGIN IMMEDIATE 事务里提交：多个 worker 同时启动时只有一个执行，
+    其它的拿到写锁后重新读到新版本直接返回；中途出错整体回滚，下次启动重试。
+    库的版本比程序新（回滚到旧版程序）时不做任何修改。
+    """
+    if schema_version(conn) >= SCHEMA_VERSION:
+        return []
+    conn.execute(f'PRAGMA busy_timeout = {MIGRATION_BUSY_TIMEOUT_MS}')
+    try:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            pending = pending_migrations(schema_version(conn))
+            for number, _ in pending:
+                MIGRATIONS[number - 1](cursor)
+            if pending:
+                cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    finally:
+        conn.execute(f"PRAGMA busy_timeout = {app.config['DB_BUSY_TIMEOUT_MS']}")
+    return pending
+
+
+def init_db():
+    """把数据库迁移到最新版本（新库从头建表），返回执行了的迁移"""
+    with get_db() as conn:
+        return migrate_db(conn)
+
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+def ensure_schema():
+    """每个 worker 处理第一个请求前执行一次 init_db，之后只判断一个标志"""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            init_db()
+            _schema_ready = True
+
+
+@app.before_request
+def ensure_schema_before_request():
+    ensure_schema()
 
 
 # ---------- 响应头优化：添加浏览器缓存 ----------
@@ -139,6 +1953,34 @@ def add_cache_headers(response):
     
     return response
 
+# ---------- 请求计时与结果统计 ----------
+@app.before_request
+def start_request_timer():
+    if app.config['METRICS_ENABLED']:
+        g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """按路由模板记录请求数和耗时；领票接口额外按返回消息统计结果"""
+    started = g.get('request_started')
+    if started is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else '<unmatched>'
+    metrics.observe('ticket_http_request_duration_seconds', (('route', route), ('method', request.method)),
+                    time.perf_counter() - started)
+    metrics.inc('ticket_http_requests_total',
+                (('route', route), ('method', request.method), ('status', response.status_code)))
+    if request.endpoint == 'ticket' and response.is_json:
+        body = response.get_json(silent=True) or {}
+        msg = body.get('msg') or body.get('status')
+        if response.status_code == 500:
+            # 500 的消息是异常文本，只区分锁错误和其它错误，避免标签取值无限增长
+            msg = 'database is locked' if _is_busy_error(Exception(msg)) else 'internal error'
+        metrics.inc('ticket_claim_outcomes_total', (('status', response.status_code), ('msg', msg)))
+    return response
+
+
 # ---------- 简单 HTTP Basic Auth 装饰器 ----------
 def check_auth():
     auth = request.authorization
@@ -188,15 +2030,292 @@ def get_client_ip():
     # 默认使用 remote_addr
     return request.remote_addr
 
+# ------------ 静态资源与预渲染页面 ------------
+app.config['ASSET_DIR'] = os.environ.get('ASSET_DIR', 'static_build')            # build_assets.py 的输出目录（没有 manifest.json 时使用 pics/ 原图）
+app.config['PRERENDER_PAGES'] = os.environ.get('PRERENDER_PAGES', '1') != '0'    # 首页 / 票据页渲染一次后缓存压缩好的字节
+
+ASSET_URL_PREFIX = '/static/build/'
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# 预渲染页面引用的图片 URL 带哈希，页面本身每次向服务器确认（命中 ETag 返回 304）
+PAGE_CACHE_CONTROL = 'no-cache'
+# Content-Encoding -> build_assets.py 生成的预压缩文件后缀
+PRECOMPRESSED_EXTS = (('br', '.br'), ('gzip', '.gz'))
+
+
+class StaticBody:
+    """内容固定的响应：各 Content-Encoding 下的字节和强 ETag"""
+
+    __slots__ = ('variants', 'etags', 'content_type', 'cache_control', 'vary')
+
+    def __init__(self, variants, content_type, cache_control, vary=()):
+        self.variants = variants
+        digest = hashlib.sha256(variants['identity']).hexdigest()[:16]
+        # 同一内容不同编码的字节不同，强 ETag 也要不同
+        self.etags = {encoding: digest if encoding == 'identity' else f'{digest}-{encoding}'
+                      for encoding in variants}
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.vary = tuple(vary) + (('Accept-Encoding',) if len(variants) > 1 else ())
+
+
+def compress_variants(body):
+    """{编码: 字节}：gzip 用标准库，安装了 brotli 时再加 br；只保留比原文变小的"""
+    variants = {'identity': body, 'gzip': gzip.compress(body, 9, mtime=0)}
+    try:
+        import brotli
+        variants['br'] = brotli.compress(body, quality=11)
+    except ImportError:
+        pass
+    return {encoding: data for encoding, data in variants.items()
+            if encoding == 'identity' or len(data) < len(body)}
+
+
+def send_static_body(static):
+    """按 Accept-Encoding 选预压缩的字节返回；If-None-Match 命中时返回 304"""
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in static.variants and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    etag = static.etags[encoding]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(static.variants[encoding], content_type=static.content_type)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = static.cache_control
+    if static.vary:
+        response.headers['Vary'] = ', '.join(static.vary)
+    return response
+
+
+class StaticAssets:
+    """
+    build_assets.py 生成的带哈希图片：第一次用到时读入清单和文件内容（几百 KB），之后直接从内存返回
+
+    没有 manifest.json 时 url() 回退到 /static/pics/原文件名，页面与构建前完全相同。
+    替换图片并重新构建后需要重启 worker（预渲染页面里的 URL 也要跟着更新）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._urls = None       # 原文件名 -> URL
+        self._files = {}        # 带哈希文件名 -> (StaticBody, WebP 的 StaticBody 或 None)
+
+    def _load(self):
+        with self._lock:
+            if self._urls is not None:
+                return
+            urls, files = {}, {}
+            directory = app.config['ASSET_DIR']
+            try:
+                with open(os.path.join(directory, 'manifest.json'), encoding='utf-8') as f:
+                    manifest = json.load(f)
+            except FileNotFoundError:
+                manifest = {'assets': {}}
+            for name, entry in manifest['assets'].items():
+                webp = None
+                if entry.get('webp'):
+                    webp = StaticBody({'identity': self._read(directory, entry['webp'])}, 'image/webp',
+                                      ASSET_CACHE_CONTROL, vary=('Accept',))
+                variants = {'identity': self._read(directory, entry['file'])}
+                for encoding, ext in PRECOMPRESSED_EXTS:
+                    if os.path.exists(os.path.join(directory, entry['file'] + ext)):
+                        variants[encoding] = self._read(directory, entry['file'] + ext)
+                files[entry['file']] = (StaticBody(variants, entry['content_type'], ASSET_CACHE_CONTROL,
+                                                   vary=('Accept',) if webp else ()), webp)
+                urls[name] = ASSET_URL_PREFIX + entry['file']
+            self._files = files
+            self._urls = urls
+
+    @staticmethod
+    def _read(directory, filename):
+        with open(os.path.join(directory, filename), 'rb') as f:
+            return f.read()
+
+    def url(self, name):
+        """模板中的 asset_url('poster.jpg')"""
+        if self._urls is None:
+            self._load()
+        return self._urls.get(name) or '/static/pics/' + name
+
+    def lookup(self, filename):
+        if self._urls is None:
+            self._load()
+        return self._files.get(filename)
+
+    def invalidate(self):
+        with self._lock:
+            self._urls, self._files = None, {}
+
+
+static_assets = StaticAssets()
+app.jinja_env.globals['asset_url'] = static_assets.url
+
+
+@app.route(ASSET_URL_PREFIX + '<filename>')
+def built_asset(filename):
+    """带哈希的图片：永久缓存；浏览器声明支持 WebP 时在同一 URL 返回 WebP"""
+    found = static_assets.lookup(filename)
+    if found is None:
+        return Response('Not Found', 404)
+    static, webp = found
+    # 只认明确写出的 image/webp，*/* 不代表支持（旧版 iOS Safari）
+    if webp is not None and 'image/webp' in request.headers.get('Accept', ''):
+        static = webp
+    return send_static_body(static)
+
+
+class PrerenderedPages:
+    """
+    首页 / 票据页不依赖请求内容，按 (模板, 参数) 渲染一次，缓存原文和预压缩后的字节
+
+    参数来自启动时的配置，修改模板或配置后重启 worker 生效
+    """
+
+    def __init__(self):
+        self._pages = {}
+
+    def get(self, template, **context):
+        key = (template, tuple(sorted(context.items())))
+        page = self._pages.get(key)
+        if page is None:
+            body = render_template(template, **context).encode('utf-8')
+            page = self._pages[key] = StaticBody(compress_variants(body), 'text/html; charset=utf-8',
+                                                 PAGE_CACHE_CONTROL)
+        return page
+
+    def clear(self):
+        self._pages = {}
+
+
+prerendered_pages = PrerenderedPages()
+
+
+def render_page(template, **context):
+    if not app.config['PRERENDER_PAGES']:
+        return render_template(template, **context)
+    return send_static_body(prerendered_pages.get(template, **context))
+
+
 # ------------ 首页（扫码跳转） ------------
 @app.route("/")
 def home():
-    return render_template("index.html")
+    return render_page("index.html", status_stream=app.config['STATUS_STREAM_ENABLED'],
+                       group_claim_max=app.config['GROUP_CLAIM_MAX'])
 
 # ------------ 票据页面 ------------
 @app.route("/ticket")
 def ticket_page():
-    return render_template("ticket.html")
+    return render_page("ticket.html")
+
+# ------------ 领票限流 ------------
+app.config['RATE_LIMIT_IP_BURST'] = float(os.environ.get('RATE_LIMIT_IP_BURST', 20))          # 每个 IP 最多连续提交的次数
+app.config['RATE_LIMIT_IP_RATE'] = float(os.environ.get('RATE_LIMIT_IP_RATE', 1.0))           # 每个 IP 每秒恢复的次数（0 关闭）
+app.config['RATE_LIMIT_STUDENT_BURST'] = float(os.environ.get('RATE_LIMIT_STUDENT_BURST', 5))  # 同一 IP 对同一学号最多连续提交的次数
+app.config['RATE_LIMIT_STUDENT_RATE'] = float(os.environ.get('RATE_LIMIT_STUDENT_RATE', 0.2))  # 同一 IP 对同一学号每秒恢复的次数（0 关闭）
+app.config['RATE_LIMIT_MAX_KEYS'] = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 50000))         # 每个限流器最多记录的键数
+
+
+class TokenBucketLimiter:
+    """
+    令牌桶限流（每个 worker 进程内）：每个键最多攒 burst 个令牌，每秒恢复 rate 个，每次请求消耗 1 个
+
+    - 状态只有 键 -> (令牌数, 上次更新时间)，按最近访问排序；超过 RATE_LIMIT_MAX_KEYS 时淘汰最久没有访问的键，
+      正在频繁提交的客户端总在队尾，不会被淘汰；被淘汰的键再出现时按满桶处理
+    - 只在内存中计算，不查库；被拒绝的请求不占用数据库连接
+    - 多个 worker 各自计数，同一客户端的请求分散到 N 个 worker 时，实际上限约为 N 倍
+    """
+
+    def __init__(self, name, burst_key, rate_key):
+        self.name = name
+        self.burst_key = burst_key
+        self.rate_key = rate_key
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def hit(self, key, now=None):
+        """消耗一个令牌：放行返回 0，否则返回还需等待的秒数"""
+        rate, burst = app.config[self.rate_key], app.config[self.burst_key]
+        if rate <= 0 or burst <= 0:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        evicted = 0
+        with self._lock:
+            state = self._buckets.pop(key, None)
+            tokens = burst if state is None else min(burst, state[0] + (now - state[1]) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > app.config['RATE_LIMIT_MAX_KEYS']:
+                self._buckets.popitem(last=False)
+                evicted += 1
+        if evicted:
+            metrics.inc('ticket_rate_limit_evictions_total', (('key', self.name),), evicted)
+        if wait:
+            metrics.inc('ticket_rate_limited_total', (('key', self.name),))
+        return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+ip_limiter = TokenBucketLimiter('ip', 'RATE_LIMIT_IP_BURST', 'RATE_LIMIT_IP_RATE')
+student_limiter = TokenBucketLimiter('student', 'RATE_LIMIT_STUDENT_BURST', 'RATE_LIMIT_STUDENT_RATE')
+
+
+def rate_limit_response(client_ip, student_id):
+    """
+    按 IP、(IP, 学号) 依次限流；超限返回 429 响应（带 Retry-After），否则返回 None
+
+    学号桶按 (IP, 学号) 计数而不是只按学号：否则知道别人学号的人换着 IP 提交就能让本人一直被拒绝
+    """
+    wait = ip_limiter.hit(client_ip)
+    if not wait and student_id:
+        wait = student_limiter.hit((client_ip, student_id))
+    if not wait:
+        return None
+    response = jsonify({"status": "fail", "msg": "请求过于频繁，请稍后再试"})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, int(wait + 0.999)))
+    return response
+
+
+def local_key_error(local_key):
+    """本地密钥开关打开时校验密钥：返回错误消息，通过返回 None"""
+    if not local_key:
+        # 没有输入密钥
+        return "请前往线下扫码获取密钥"
+    if local_key != os.environ.get("LOCAL_PASS", "123456"):
+        # 密钥输入错误
+        return "请输入正确的密钥"
+    return None
+
+
+def cached_rejection(student_id, student_name, local_key):
+    """
+    学号 / 姓名在缓存中有失败记录时返回失败消息，否则返回 None
+
+    只在开关状态和学号库都是新鲜缓存、且前面的检查（窗口开放、密钥）都会通过时使用，
+    保证返回的内容与完整流程相同；其余情况交给完整流程
+    """
+    if not student_id or not student_name:
+        return None
+    control = control_state.peek()
+    version = roster_index.version
+    if control is None or version is None or roster_index.peek() is None:
+        return None
+    if not control['ticket_open'] or (control['key_open'] and local_key_error(local_key)):
+        return None
+    return rejection_cache.get((student_id, normalize_name(student_name)), version)
+
 
 # ------------ 领取票 ------------
 @app.route("/ticket", methods=["POST"])
@@ -204,21 +2323,30 @@ def ticket():
     student_id = request.form.get("student_id", "").strip()
     student_name = request.form.get("student_name", "").strip()
     local_key = request.form.get("local_key", "").strip()
+    # 连座同伴（可选）：companion_id / companion_name 各一组，按顺序对应
+    companion_ids = [v.strip() for v in request.form.getlist("companion_id")]
+    companion_names = [v.strip() for v in request.form.getlist("companion_name")]
     client_ip = get_client_ip()  # 获取真实客户端 IP 地址（支持nginx反代）
 
+    # --- 限流：在取数据库连接之前按 IP / 学号拒绝刷接口的客户端 ---
+    limited = rate_limit_response(client_ip, student_id)
+    if limited is not None:
+        return limited
+
+    # --- 刚校验失败过的同一学号 / 姓名：不取数据库连接，直接返回上次的结果 ---
+    rejected = cached_rejection(student_id, student_name, local_key)
+    if rejected:
+        return jsonify({"status": "fail", "msg": rejected}), 400
+
     try:
         with get_db() as conn:
             cursor = conn.cursor()
             
-            # 获取当前取票窗口状态
-            cursor.execute('SELECT is_open FROM ticket_status WHERE id = 1')
-            status_row = cursor.fetchone()
-            is_open = bool(status_row['is_open']) if status_row else False
-            
-            # 获取本地密钥开关状态
-            cursor.execute('SELECT is_open FROM local_key_switch WHERE id = 1')
-            key_switch_row = cursor.fetchone()
-            key_switch_open = bool(key_switch_row['is_open']) if key_switch_row else False
+            # 获取取票窗口、本地密钥开关和开放集合（进程内缓存，按版本号失效）
+            with metrics.timer('ticket_db_query_seconds', query='control_state'):
+                control = control_state.get(conn)
+            is_open = control['ticket_open']
+            key_switch_open = control['key_open']
             
             # 特殊密钥：当学号为 xuanlan40 且姓名为空时，跳转到管理员页面（无论取票窗口状态）
             if student_id == "xuanlan40" and not student_name:
@@ -232,26 +2360,45 @@ def ticket():
 
                 # --- 检查本地密钥开关（如果打开，需要验证密钥） ---
                 if key_switch_open:
-                    local_pass = os.environ.get("LOCAL_PASS", "123456")
-                    if not local_key:
-                        # 没有输入密钥
-                        return jsonify({"status": "fail", "msg": "请前往线下扫码获取密钥"}), 400
-                    elif local_key != local_pass:
-                        # 密钥输入错误
-                        return jsonify({"status": "fail", "msg": "请输入正确的密钥"}), 400
+                    key_error = local_key_error(local_key)
+                    if key_error:
+                        return jsonify({"status": "fail", "msg": key_error}), 400
                 
-                # --- 检查学号是否存在并且姓名匹配（不区分大小写） ---
-                cursor.execute('SELECT student_name FROM valid_ids WHERE student_id = ?', (student_id,))
-                row = cursor.fetchone()
-                if not row:
+                # --- 检查学号是否存在并且姓名匹配（不区分大小写，走内存索引） ---
+                # 先取版本号再查：查询期间学号库被重新加载时，这次的失败结果不会被缓存使用
+                roster_version = roster_index.version
+                with metrics.timer('ticket_db_query_seconds', query='roster_lookup'):
+                    entry = roster_index.lookup(conn, student_id)
+                if not entry:
+                    rejection_cache.put((student_id, normalize_name(student_name)), "学号不合法", roster_version)
                     return jsonify({"status": "fail", "msg": "学号不合法"}), 400
-                db_name = row['student_name'] or ''
-                if db_name.strip().lower() != student_name.strip().lower():
+                db_name, db_norm = entry
+                if db_norm != normalize_name(student_name):
+                    rejection_cache.put((student_id, normalize_name(student_name)), "姓名与学号不匹配", roster_version)
                     return jsonify({"status": "fail", "msg": "姓名与学号不匹配"}), 400
-                
+
+                # --- 连座：同伴逐个校验学号和姓名 ---
+                members = [(student_id, db_name)]
+                if companion_ids:
+                    group_max = app.config['GROUP_CLAIM_MAX']
+                    if group_max <= 1:
+                        return jsonify({"status": "fail", "msg": "未开放连座领票"}), 400
+                    if len(companion_ids) + 1 > group_max:
+                        return jsonify({"status": "fail", "msg": f"连座最多 {group_max} 人"}), 400
+                    if len(companion_names) != len(companion_ids) or not all(companion_ids) or not all(companion_names):
+                        return jsonify({"status": "fail", "msg": "需要提供同伴的姓名和学号"}), 400
+                    for companion_id, companion_name in zip(companion_ids, companion_names):
+                        if any(companion_id == member_id for member_id, _ in members):
+                            return jsonify({"status": "fail", "msg": "同伴学号重复", "detail": companion_id}), 400
+                        entry = roster_index.lookup(conn, companion_id)
+                        if not entry:
+                            return jsonify({"status": "fail", "msg": "同伴学号不合法", "detail": companion_id}), 400
+                        if entry[1] != normalize_name(companion_name):
+                            return jsonify({"status": "fail", "msg": "同伴姓名与学号不匹配", "detail": companion_id}), 400
+                        members.append((companion_id, entry[0]))
+
                 # --- 检查座位集合是否有可用的开放集合 ---
-                cursor.execute('SELECT group_id FROM seat_groups WHERE is_open = 1')
-                open_groups = [row['group_id'] for row in cursor.fetchall()]
+                open_groups = current_open_groups(control)
                 if not open_groups:
                     return jsonify({"status": "fail", "msg": "未到取票时间，请耐心等待"}), 400
             else:
@@ -264,8 +2411,9 @@ def ticket():
                     return jsonify({"status": "fail", "msg": "需要提供学号"}), 400
             
             # --- 检查 IP 地址领票限制 ---
-            cursor.execute('SELECT student_id FROM ip_ticket_log WHERE ip_address = ?', (client_ip,))
-            ip_ticket = cursor.fetchone()
+            with metrics.timer('ticket_db_query_seconds', query='ip_check'):
+                cursor.execute('SELECT student_id FROM ip_ticket_log WHERE ip_address = ?', (client_ip,))
+                ip_ticket = cursor.fetchone()
             
             # 如果该 IP 已领过票
             if ip_ticket:
@@ -275,86 +2423,94 @@ def ticket():
                     return jsonify({"status": "fail", "msg": "你只能领取一张票"}), 400
                 # 如果学号相同，继续执行（允许查询自己的座位）
             
+            # --- 连座：同一事务内为所有人分配同一排相邻的座位（不经过排队 / 组提交） ---
+            if len(members) > 1:
+                try:
+                    with metrics.timer('ticket_db_query_seconds', query='claim_group_txn'):
+                        outcome, result = claim_group(conn, members, client_ip, open_groups)
+                except ClaimBusy:
+                    return jsonify({"status": "fail", "msg": "系统繁忙，请稍后重试"}), 503
+                if outcome == 'ok':
+                    status_cache.mark_dirty()
+                code, body = group_outcome_body(outcome, result)
+                return jsonify(body), code
+
             # --- 已领取过 ---
-            cursor.execute('''
-                SELECT seat_id FROM users WHERE student_id = ?
-            ''', (student_id,))
-            existing_user = cursor.fetchone()
-            if existing_user:
-                seat_id = existing_user['seat_id']
-                # 直接从seats表查询所有必要信息
-                cursor.execute('''
-                    SELECT pos, row_num, col_num FROM seats WHERE seat_id = ?
-                ''', (seat_id,))
-                seat = cursor.fetchone()
-                # 计算票号：根据student_id在users表中是第几行（按插入顺序）
+            with metrics.timer('ticket_db_query_seconds', query='existing_user'):
                 cursor.execute('''
-                    SELECT COUNT(*) as cnt FROM users WHERE rowid <= 
-                    (SELECT rowid FROM users WHERE student_id = ?)
+                    SELECT seat_id, ticket_seq FROM users WHERE student_id = ?
                 ''', (student_id,))
-                ticket_seq = cursor.fetchone()['cnt']
-                ticket_no = f"NO.251221{ticket_seq:03d}"
+                existing_user = cursor.fetchone()
+            if existing_user:
+                return jsonify(existing_ticket_body(cursor, existing_user['seat_id'], existing_user['ticket_seq']))
+
+            # --- 排队模式：入队后立即返回凭证，由写入线程按到达顺序分批领票 ---
+            if app.config['CLAIM_MODE'] == 'queue':
+                job, position = claim_queue.submit(student_id, db_name, client_ip, open_groups)
+                if job is None:
+                    return jsonify({"status": "fail", "msg": "系统繁忙，请稍后重试"}), 503
                 return jsonify({
-                    "status": "ok",
-                    "msg": "你已领取过",
-                    "seat": seat_id,
-                    "pos": seat['pos'],
-                    "row_num": seat['row_num'],
-                    "col_num": seat['col_num'],
-                    "ticket_no": ticket_no
-                })
-            
-            # --- 分配可用座位（仅限开放集合范围内） ---
-            if is_open:
-                # 在开放的集合范围内随机分配
-                cursor.execute('SELECT group_id FROM seat_groups WHERE is_open = 1')
-                open_groups = [row['group_id'] for row in cursor.fetchall()]
-                if open_groups:
-                    placeholders = ','.join('?' * len(open_groups))
-                    cursor.execute(f'SELECT seat_id, pos, row_num, col_num FROM seats WHERE occupied = 0 AND group_id IN ({placeholders}) ORDER BY RANDOM() LIMIT 1', open_groups)
-                else:
-                    cursor.execute('SELECT seat_id, pos, row_num, col_num FROM seats WHERE occupied = 0 ORDER BY RANDOM() LIMIT 1')
-            else:
-                cursor.execute('SELECT seat_id, pos, row_num, col_num FROM seats WHERE occupied = 0 ORDER BY RANDOM() LIMIT 1')
-            
-            available = cursor.fetchone()
-            if not available:
-                return jsonify({"status": "fail", "msg": "票已领完"}), 400
-            
-            seat_id = available['seat_id']
-            pos = available['pos']
-            row_num = available['row_num']
-            col_num = available['col_num']
-            
-            # --- 获取学生姓名 ---
-            cursor.execute('SELECT student_name FROM valid_ids WHERE student_id = ?', (student_id,))
-            name_row = cursor.fetchone()
-            student_name_db = name_row['student_name'] if name_row else ''
-            
-            # --- 更新座位表和用户表 ---
-            cursor.execute('UPDATE seats SET occupied = 1, student_id = ? WHERE seat_id = ?',
-                         (student_id, seat_id))
-            cursor.execute('INSERT INTO users (student_id, seat_id, student_name, pos) VALUES (?, ?, ?, ?)',
-                         (student_id, seat_id, student_name_db, pos))
+                    "status": "queued",
+                    "msg": "排队中",
+                    "token": job.token,
+                    "position": position,
+                    "result_url": f"/ticket/result/{job.token}"
+                }), 202
             
-            # --- 记录 IP 地址领票日志 ---
-            cursor.execute('INSERT INTO ip_ticket_log (ip_address, student_id) VALUES (?, ?)',
-                         (client_ip, student_id))
-            
-            conn.commit()
-            # 计算票号：users表中的数据行数（新领票用户已插入，其行号就是此时的count）
-            cursor.execute('SELECT COUNT(*) as cnt FROM users')
-            occupied_cnt = cursor.fetchone()['cnt']
-            ticket_no = f"NO.251221{occupied_cnt:03d}"
-            return jsonify({
-                "status": "ok",
-                "msg": "领取成功",
-                "seat": seat_id,
-                "pos": pos,
-                "row_num": row_num,
-                "col_num": col_num,
-                "ticket_no": ticket_no
-            })
+            # --- 原子分配座位（仅限开放集合范围内） ---
+            try:
+                with metrics.timer('ticket_db_query_seconds', query='claim_txn'):
+                    if app.config['CLAIM_COMMIT_WINDOW_MS'] > 0:
+                        outcome, result = group_commit.claim(student_id, db_name, client_ip, open_groups)
+                    else:
+                        outcome, result = claim_seat(conn, student_id, db_name, client_ip, open_groups)
+            except ClaimBusy:
+                return jsonify({"status": "fail", "msg": "系统繁忙，请稍后重试"}), 503
+            if outcome == 'ok':
+                status_cache.mark_dirty()
+            code, body = claim_outcome_body(cursor, outcome, result)
+            return jsonify(body), code
+    except Exception as e:
+        return jsonify({"status": "fail", "msg": str(e)}), 500
+
+# ------------ 排队领票结果 ------------
+@app.route("/ticket/result/<token>", methods=["GET"])
+def ticket_result(token):
+    """
+    排队模式：按凭证查询领票结果
+
+    结果已写入时原样返回（状态码与同步模式相同）；仍在排队返回 202；
+    ?wait=N 最多等待 N 秒再返回（长轮询，上限 10 秒）
+    """
+    try:
+        issued_at = claim_token_time(token)
+    except ValueError:
+        return jsonify({"status": "fail", "msg": "凭证无效或已过期"}), 404
+    try:
+        wait = min(max(float(request.args.get("wait", 0) or 0), 0.0), 10.0)
+    except ValueError:
+        wait = 0.0
+
+    try:
+        deadline = time.monotonic() + wait
+        while True:
+            with get_db() as conn:
+                row = conn.execute('SELECT status_code, body FROM claim_results WHERE token = ?',
+                                   (token,)).fetchone()
+            if row:
+                return Response(row['body'], status=row['status_code'], mimetype='application/json')
+            failed = claim_queue.failed(token)
+            if failed:
+                return jsonify(failed[1]), failed[0]
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # 本 worker 的请求等待完成事件，其它 worker 的请求每 50 毫秒查一次库
+            claim_queue.wait(token, min(remaining, 0.05))
+
+        if time.time() - issued_at > app.config['CLAIM_RESULT_TIMEOUT']:
+            return jsonify({"status": "fail", "msg": "凭证无效或已过期"}), 404
+        return jsonify({"status": "queued", "msg": "排队中", "token": token}), 202
     except Exception as e:
         return jsonify({"status": "fail", "msg": str(e)}), 500
 
@@ -377,25 +2533,274 @@ def lookup():
 @app.route('/admin')
 @auth_required
 def admin_page():
-    return render_template('admin.html')
+    return render_template('admin.html', status_stream=app.config['STATUS_STREAM_ENABLED'])
+
+
+# ------------ 管理列表：游标分页 / 筛选 / 流式导出 ------------
+# 列表 -> 查询、排序键（主键，游标即上一页最后一行的键）、可用的筛选参数
+# 筛选参数 -> (类型, 列或条件)：int 等值，prefix 学号前缀（按范围走主键索引），contains 姓名包含
+LISTINGS = {
+    'seats': {
+        'sql': '''
+            SELECT s.seat_id, s.pos, s.occupied, s.student_id, v.student_name, s.group_id
+            FROM seats s
+            LEFT JOIN valid_ids v ON s.student_id = v.student_id
+        ''',
+        'key': 's.seat_id',
+        'key_type': int,
+        'filters': {
+            'occupied': ('int', 's.occupied = ?'),
+            'group_id': ('int', 's.group_id = ?'),
+            'student_id': ('prefix', 's.student_id'),
+            'name': ('contains', 'v.student_name'),
+        },
+    },
+    'users': {
+        'sql': '''
+            SELECT u.student_id, u.seat_id, u.student_name, u.pos
+            FROM users u
+            LEFT JOIN seats s ON s.seat_id = u.seat_id
+        ''',
+        'key': 'u.student_id',
+        'key_type': str,
+        'filters': {
+            'group_id': ('int', 's.group_id = ?'),
+            'student_id': ('prefix', 'u.student_id'),
+            'name': ('contains', 'u.student_name'),
+        },
+    },
+    'validids': {
+        'sql': 'SELECT v.student_id, v.student_name FROM valid_ids v',
+        'key': 'v.student_id',
+        'key_type': str,
+        'filters': {
+            'claimed': ('int', 'EXISTS (SELECT 1 FROM users u WHERE u.student_id = v.student_id) = ?'),
+            'student_id': ('prefix', 'v.student_id'),
+            'name': ('contains', 'v.student_name'),
+        },
+    },
+}
+
+LISTING_MAX_LIMIT = 1000
+LISTING_EXPORT_PAGE = 1000    # 流式导出时每次查询的行数
+
+
+def parse_listing_filters(kind, args):
+    """从查询参数中取出该列表支持的筛选条件，返回 [(条件 SQL, 参数), ...]；参数无效抛 ValueError"""
+    where = []
+    for name, (kind_, column) in LISTINGS[kind]['filters'].items():
+        value = (args.get(name) or '').strip()
+        if not value:
+            continue
+        if kind_ == 'int':
+            try:
+                where.append((column, int(value)))
+            except ValueError:
+                raise ValueError(f'{name} 必须是整数')
+        elif kind_ == 'prefix':
+            # 'abc' -> abc <= 键 < abd，可以走主键索引（LIKE 'abc%' 不行）
+            upper = value[:-1] + chr(ord(value[-1]) + 1)
+            where.append((f'{column} >= ? AND {column} < ?', (value, upper)))
+        else:
+            where.append((f'instr({column}, ?) > 0', value))
+    return where
+
+
+def list_page(conn, kind, where, after=None, limit=100):
+    """按主键顺序取 after 之后的一页，返回 (行列表, 下一页游标或 None)"""
+    spec = LISTINGS[kind]
+    clauses, params = [], []
+    for clause, value in where:
+        clauses.append(clause)
+        params.extend(value if isinstance(value, tuple) else (value,))
+    if after is not None:
+        clauses.append(f"{spec['key']} > ?")
+        params.append(after)
+    sql = spec['sql'] + (' WHERE ' + ' AND '.join(clauses) if clauses else '') + f" ORDER BY {spec['key']} LIMIT ?"
+    cursor = conn.cursor()
+    cursor.execute(sql, params + [limit + 1])
+    rows = [dict(row) for row in cursor.fetchall()]
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, rows[-1][spec['key'].split('.')[1]]
+
+
+def iter_listing(kind, where):
+    """逐页查询整个列表（每页单独取连接、单独查询，不会长时间占着读事务）"""
+    after = None
+    while True:
+        with get_db() as conn:
+            rows, after = list_page(conn, kind, where, after, LISTING_EXPORT_PAGE)
+        yield from rows
+        if after is None:
+            return
+
+
+def listing_response(kind):
+    """
+    管理列表接口的公共实现
+
+    - 带 limit：返回一页 {"items": [...], "next": 游标}，下一页传 after=游标
+    - 不带 limit：流式返回全部行，默认为 JSON 数组（与原来的返回格式相同），format=ndjson 时每行一个 JSON
+    """
+    spec = LISTINGS[kind]
+    try:
+        where = parse_listing_filters(kind, request.args)
+        after = request.args.get('after')
+        if after is not None:
+            after = spec['key_type'](after)
+        limit = request.args.get('limit')
+        if limit is not None:
+            limit = int(limit)
+            if not 1 <= limit <= LISTING_MAX_LIMIT:
+                raise ValueError(f'limit 取值范围 1-{LISTING_MAX_LIMIT}')
+    except ValueError as e:
+        return jsonify({'status': 'fail', 'msg': str(e)}), 400
+
+    try:
+        if limit is not None:
+            with get_db() as conn:
+                items, next_after = list_page(conn, kind, where, after, limit)
+            return jsonify({'items': items, 'next': next_after})
+
+        rows = iter_listing(kind, where)
+        if request.args.get('format') == 'ndjson':
+            body = (json.dumps(row, ensure_ascii=False) + '\n' for row in rows)
+            return Response(body, mimetype='application/x-ndjson')
+
+        def json_array():
+            yield '['
+            for i, row in enumerate(rows):
+                yield (',' if i else '') + json.dumps(row, ensure_ascii=False)
+            yield ']'
+        return Response(json_array(), mimetype='application/json')
+    except Exception as e:
+        return jsonify({'status': 'fail', 'msg': str(e)}), 500
+
+
+# ------------ 入场核验名单导出 ------------
+EXPORT_COLUMNS = ('票号', '学号', '姓名', '座位号', '位置', '排', '列', '集合')
+
+# sort 参数 -> ORDER BY；seat 按集合、排、列排序，便于按入口分别打印
+EXPORT_SORTS = {
+    'ticket': 'u.ticket_seq',
+    'seat': 's.group_id, s.row_num, s.col_num, s.seat_id',
+    'student': 'u.student_id',
+}
+
+EXPORT_FETCH_SIZE = 500
+
+
+def iter_assignments(sort='ticket', group_id=None):
+    """
+    逐行生成 (票号, 学号, 姓名, 座位号, 位置, 排, 列, 集合)
+
+    整个导出在同一个读事务里完成（WAL 下不阻塞领票），每次只从游标取 EXPORT_FETCH_SIZE 行，
+    导出过程中有人领票也不会出现半新半旧的名单。
+    """
+    sql = '''
+        SELECT u.ticket_seq, u.student_id, COALESCE(v.student_name, u.student_name) AS student_name,
+               u.seat_id, s.pos, s.row_num, s.col_num, s.group_id
+        FROM users u
+        JOIN seats s ON s.seat_id = u.seat_id
+        LEFT JOIN valid_ids v ON v.student_id = u.student_id
+    '''
+    params = ()
+    if group_id is not None:
+        sql += ' WHERE s.group_id = ?'
+        params = (group_id,)
+    sql += ' ORDER BY ' + EXPORT_SORTS[sort]
+    with get_db() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    ticket_no = format_ticket_no(row['ticket_seq']) if row['ticket_seq'] is not None else ''
+                    yield (ticket_no, row['student_id'], row['student_name'] or '', row['seat_id'],
+                           row['pos'] or '', row['row_num'], row['col_num'], row['group_id'])
+        finally:
+            # 客户端中途断开时尽早结束语句，连接归还连接池前不再占着读快照
+            cursor.close()
+
+
+def export_csv(rows):
+    """CSV 响应体：带 BOM（Excel 直接打开不乱码），每 EXPORT_FETCH_SIZE 行输出一次"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    buf.write('\ufeff')
+    writer.writerow(EXPORT_COLUMNS)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % EXPORT_FETCH_SIZE == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def export_xlsx(rows):
+    """
+    XLSX 响应体：openpyxl 只写模式逐行写入临时文件（行不留在内存里），
+    保存后分块读出；xlsx 是 zip 格式，只能在全部写完后开始发送
+    """
+    import openpyxl     # 只有导出时才需要，worker 启动时不加载
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('座位名单')
+    sheet.append(EXPORT_COLUMNS)
+    for row in rows:
+        sheet.append(row)
+    with tempfile.TemporaryFile() as f:
+        workbook.save(f)
+        f.seek(0)
+        while True:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
+
+
+@app.route('/admin/api/export/assignments', methods=['GET'])
+@auth_required
+def api_export_assignments():
+    """导出 学号 → 座位 → 票号 名单（需要 Basic Auth）；format=csv|xlsx，sort=ticket|seat|student，可按 group_id 筛选"""
+    fmt = request.args.get('format', 'csv')
+    sort = request.args.get('sort', 'ticket')
+    if fmt not in ('csv', 'xlsx'):
+        return jsonify({'status': 'fail', 'msg': 'format 只能是 csv 或 xlsx'}), 400
+    if sort not in EXPORT_SORTS:
+        return jsonify({'status': 'fail', 'msg': 'sort 只能是 ' + ' / '.join(EXPORT_SORTS)}), 400
+    group_id = request.args.get('group_id')
+    if group_id:
+        try:
+            group_id = int(group_id)
+        except ValueError:
+            return jsonify({'status': 'fail', 'msg': 'group_id 必须是整数'}), 400
+    else:
+        group_id = None
+
+    rows = iter_assignments(sort, group_id)
+    filename = f"assignments{'' if group_id is None else f'-group{group_id}'}-{sort}.{fmt}"
+    if fmt == 'csv':
+        body, mimetype = export_csv(rows), 'text/csv; charset=utf-8'
+    else:
+        body, mimetype = export_xlsx(rows), 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 
 # ------------ 管理 API：Seats / Users / Valid IDs / Stats ------------
 @app.route('/admin/api/seats', methods=['GET'])
 @auth_required
 def api_get_seats():
-    try:
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT s.seat_id, s.pos, s.occupied, s.student_id, v.student_name
-                FROM seats s
-                LEFT JOIN valid_ids v ON s.student_id = v.student_id
-            ''')
-            seats = [dict(row) for row in cursor.fetchall()]
-            return jsonify(seats)
-    except Exception as e:
-        return jsonify({'status': 'fail', 'msg': str(e)}), 500
+    """座位列表；limit / after 分页，occupied / group_id / student_id（前缀）/ name 筛选"""
+    return listing_response('seats')
 
 
 @app.route('/admin/api/seats', methods=['POST'])
@@ -410,6 +2815,10 @@ def api_create_seat():
         pos = data.get('pos', '')
         occupied = bool(data.get('occupied', False))
         student = data.get('student_id') if occupied else None
+        try:
+            group_id = int(data.get('group_id') or 1)
+        except (TypeError, ValueError):
+            return jsonify({'status': 'fail', 'msg': 'group_id 必须是整数'}), 400
         
         with get_db() as conn:
             cursor = conn.cursor()
@@ -419,9 +2828,10 @@ def api_create_seat():
                 return jsonify({'status': 'fail', 'msg': '座位已存在'}), 400
             
             cursor.execute('''
-                INSERT INTO seats (seat_id, pos, occupied, student_id)
-                VALUES (?, ?, ?, ?)
-            ''', (seat_id, pos, occupied, student))
+                INSERT INTO seats (seat_id, pos, occupied, student_id, group_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (seat_id, pos, occupied, student, group_id))
+            cursor.execute('INSERT OR IGNORE INTO seat_groups (group_id, is_open) VALUES (?, 0)', (group_id,))
             
             # 如果已占用，添加到 users 表并清理该学号的旧 IP 记录
             if student:
@@ -436,7 +2846,9 @@ def api_create_seat():
                 cursor.execute('DELETE FROM ip_ticket_log WHERE student_id = ?', (student,))
             
             conn.commit()
-            return jsonify({'status': 'ok', 'seat': {'seat_id': seat_id, 'pos': pos, 'occupied': occupied, 'student_id': student}})
+            seat_pool.invalidate()
+            status_cache.invalidate()
+            return jsonify({'status': 'ok', 'seat': {'seat_id': seat_id, 'pos': pos, 'occupied': occupied, 'student_id': student, 'group_id': group_id}})
     except Exception as e:
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
 
@@ -496,6 +2908,8 @@ def api_update_seat(seat_id):
                     cursor.execute('DELETE FROM ip_ticket_log WHERE student_id = ?', (old_student,))
             
             conn.commit()
+            seat_pool.invalidate()
+            status_cache.invalidate()
             return jsonify({'status': 'ok'})
     except Exception as e:
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
@@ -521,6 +2935,8 @@ def api_delete_seat(seat_id):
             
             cursor.execute('DELETE FROM seats WHERE seat_id = ?', (seat_id,))
             conn.commit()
+            seat_pool.invalidate()
+            status_cache.invalidate()
             return jsonify({'status': 'ok'})
     except Exception as e:
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
@@ -529,17 +2945,8 @@ def api_delete_seat(seat_id):
 @app.route('/admin/api/users', methods=['GET'])
 @auth_required
 def api_get_users():
-    try:
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT u.student_id, u.seat_id, u.student_name, u.pos
-                FROM users u
-            ''')
-            users = [dict(row) for row in cursor.fetchall()]
-            return jsonify(users)
-    except Exception as e:
-        return jsonify({'status': 'fail', 'msg': str(e)}), 500
+    """已领票用户列表；limit / after 分页，group_id / student_id（前缀）/ name 筛选"""
+    return listing_response('users')
 
 
 @app.route('/admin/api/users', methods=['POST'])
@@ -586,6 +2993,8 @@ def api_create_user():
             cursor.execute('INSERT INTO users (student_id, seat_id, student_name, pos) VALUES (?, ?, ?, ?)', 
                          (student, seat_id, student_name_db, pos))
             conn.commit()
+            seat_pool.invalidate()
+            status_cache.invalidate()
             return jsonify({'status': 'ok'})
     except Exception as e:
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
@@ -626,6 +3035,8 @@ def api_update_user(student_id):
             cursor.execute('UPDATE users SET seat_id = ? WHERE student_id = ?', 
                          (new_seat, student_id))
             conn.commit()
+            seat_pool.invalidate()
+            status_cache.invalidate()
             return jsonify({'status': 'ok'})
     except Exception as e:
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
@@ -652,6 +3063,8 @@ def api_delete_user(student_id):
             # 清理 IP 日志（该学号的 IP 绑定记录）
             cursor.execute('DELETE FROM ip_ticket_log WHERE student_id = ?', (student_id,))
             conn.commit()
+            seat_pool.invalidate()
+            status_cache.invalidate()
             return jsonify({'status': 'ok'})
     except Exception as e:
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
@@ -660,14 +3073,8 @@ def api_delete_user(student_id):
 @app.route('/admin/api/validids', methods=['GET'])
 @auth_required
 def api_get_validids():
-    try:
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT student_id, student_name FROM valid_ids')
-            ids = [dict(row) for row in cursor.fetchall()]
-            return jsonify(ids)
-    except Exception as e:
-        return jsonify({'status': 'fail', 'msg': str(e)}), 500
+    """有效学号列表；limit / after 分页，claimed（是否已领票）/ student_id（前缀）/ name 筛选"""
+    return listing_response('validids')
 
 
 @app.route('/admin/api/validids', methods=['POST'])
@@ -687,6 +3094,7 @@ def api_add_validid():
             
             cursor.execute('INSERT INTO valid_ids (student_id) VALUES (?)', (sid,))
             conn.commit()
+            roster_index.invalidate()
             return jsonify({'status': 'ok'})
     except Exception as e:
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
@@ -704,37 +3112,323 @@ def api_delete_validid(sid):
             
             cursor.execute('DELETE FROM valid_ids WHERE student_id = ?', (sid,))
             conn.commit()
+            roster_index.invalidate()
             return jsonify({'status': 'ok'})
     except Exception as e:
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
 
 
+# ------------ 批量导入：座位 / 学号库 ------------
+class ImportFormatError(ValueError):
+    """导入文件本身有问题（格式不支持、缺少必需的列），整个导入不执行"""
+
+
+# 字段名 -> 表头中可接受的写法（不区分大小写）
+IMPORT_HEADERS = {
+    'student_id': ('student_id', '学号'),
+    'student_name': ('student_name', 'name', '姓名'),
+    'seat_id': ('seat_id', '座位号', '座位编号', '编号'),
+    'pos': ('pos', '位置', '座位'),
+    'group_id': ('group_id', 'group', '集合', '座位集合'),
+    'row_num': ('row_num', '排'),
+    'col_num': ('col_num', '列'),
+}
+
+_POS_PATTERN = re.compile(r'(\d+)\s*排\D*?(\d+)\s*[列座号]?')
+
+
+def parse_pos(pos):
+    """'第7排 第1列' -> (7, 1)；也接受 '7排1座'、'7-1' 等只含两个数字的写法，解析不了返回 (None, None)"""
+    m = _POS_PATTERN.search(pos)
+    if m:
+        return int(m.group(1)), int(m.group(2))
+    numbers = re.findall(r'\d+', pos)
+    if len(numbers) == 2:
+        return int(numbers[0]), int(numbers[1])
+    return None, None
+
+
+def _cell_text(value):
+    """单元格 -> 去掉首尾空白的字符串；Excel 把学号存成数字时去掉 '.0'；空单元格返回 None"""
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = str(value).strip()
+    return text or None
+
+
+def read_import_rows(stream, filename, encoding='utf-8-sig', sheet=None):
+    """
+    逐行读取 CSV / XLSX，生成 (行号, {字段名: 文本或 None})
+
+    - 第一行非空行是表头，按 IMPORT_HEADERS 识别列，不认识的列忽略
+    - XLSX 用 openpyxl 只读模式逐行读取，不会把整个工作簿载入内存
+    """
+    ext = os.path.splitext(filename or '')[1].lower()
+    if ext == '.csv':
+        rows = csv.reader(io.TextIOWrapper(stream, encoding=encoding, newline=''))
+    elif ext in ('.xlsx', '.xlsm'):
+        import openpyxl     # 只有导入时才需要，worker 启动时不加载
+        workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+        if sheet and sheet not in workbook.sheetnames:
+            raise ImportFormatError(f'工作表不存在: {sheet}')
+        rows = (workbook[sheet] if sheet else workbook.active).iter_rows(values_only=True)
+    else:
+        raise ImportFormatError('只支持 .csv / .xlsx 文件')
+
+    aliases = {alias.lower(): field for field, names in IMPORT_HEADERS.items() for alias in names}
+    columns = None
+    for line, values in enumerate(rows, 1):
+        values = [_cell_text(v) for v in values]
+        if not any(values):
+            continue
+        if columns is None:
+            columns = [(i, aliases[v.lower()]) for i, v in enumerate(values) if v and v.lower() in aliases]
+            if not columns:
+                raise ImportFormatError('第 %d 行没有可识别的表头（如 学号 / 姓名 / seat_id / pos）' % line)
+            continue
+        yield line, {field: values[i] if i < len(values) else None for i, field in columns}
+
+
+def _parse_validid(record):
+    """返回 (学号, {列: 值})；值为 None 的列表示文件里没给，更新时保留原值"""
+    sid = record.get('student_id')
+    if not sid:
+        raise ValueError('缺少学号')
+    return sid, {'student_name': record.get('student_name')}
+
+
+def _parse_seat(record):
+    try:
+        seat_id = int(record.get('seat_id') or '')
+    except ValueError:
+        raise ValueError('缺少或无效的 seat_id')
+    pos = record.get('pos')
+    row_num, col_num = parse_pos(pos) if pos else (None, None)
+    values = {'pos': pos, 'row_num': row_num, 'col_num': col_num, 'group_id': None}
+    for field in ('row_num', 'col_num', 'group_id'):
+        if record.get(field):
+            try:
+                values[field] = int(float(record[field]))     # 兼容表格导出的 "3.0"
+            except (ValueError, OverflowError):               # "inf" 转 int 时是 OverflowError
+                raise ValueError(f'无效的 {field}: {record[field]}')
+    return seat_id, values
+
+
+# 导入类型 -> 表、主键、可更新的列、新行各列的默认值、行解析函数
+IMPORT_KINDS = {
+    'validids': {
+        'table': 'valid_ids',
+        'key': 'student_id',
+        'fields': ('student_name',),
+        'defaults': {'student_name': None},
+        'required': (),
+        'parse': _parse_validid,
+    },
+    'seats': {
+        'table': 'seats',
+        'key': 'seat_id',
+        'fields': ('pos', 'row_num', 'col_num', 'group_id'),
+        'defaults': {'pos': None, 'row_num': 0, 'col_num': 0, 'group_id': 1},
+        'required': ('pos',),
+        'parse': _parse_seat,
+    },
+}
+
+IMPORT_REPORT_LIMIT = 50    # 报告中最多列出的错误 / 变化条数
+
+
+def _fetch_existing(cursor, spec, keys):
+    """按主键批量查出已有的行：{主键: {列: 值}}"""
+    existing = {}
+    columns = ', '.join((spec['key'],) + spec['fields'])
+    for i in range(0, len(keys), 500):
+        part = keys[i:i + 500]
+        cursor.execute(f"SELECT {columns} FROM {spec['table']} WHERE {spec['key']} IN ({','.join('?' * len(part))})",
+                       part)
+        for row in cursor.fetchall():
+            existing[row[0]] = {f: row[f] for f in spec['fields']}
+    return existing
+
+
+def _import_chunk(conn, spec, chunk, dry_run, report):
+    """对比一批行与数据库中的现状，统计新增 / 修改 / 不变；非 dry-run 时在一个事务内 executemany 写入"""
+    cursor = conn.cursor()
+    existing = _fetch_existing(cursor, spec, [key for _, key, _ in chunk])
+    writes, moved = [], []
+    for line, key, values in chunk:
+        before = existing.get(key)
+        base = before or spec['defaults']
+        after = {f: base[f] if values[f] is None else values[f] for f in spec['fields']}
+        if before is None:
+            missing = [f for f in spec['required'] if after[f] is None]
+            if missing:
+                report['skipped'] += 1
+                if len(report['errors']) < IMPORT_REPORT_LIMIT:
+                    report['errors'].append({'line': line, 'msg': f"新增的行缺少 {'、'.join(missing)}"})
+                continue
+            action = 'inserted'
+        elif after != before:
+            action = 'updated'
+            if spec['table'] == 'seats' and after['pos'] != before['pos']:
+                moved.append((after['pos'], key))
+        else:
+            report['unchanged'] += 1
+            continue
+        report[action] += 1
+        writes.append((key,) + tuple(after[f] for f in spec['fields']))
+        if len(report['changes']) < IMPORT_REPORT_LIMIT:
+            report['changes'].append({'line': line, 'action': action, 'key': key,
+                                      'before': before, 'after': after})
+    if dry_run or not writes:
+        return
+
+    columns = (spec['key'],) + spec['fields']
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.executemany(f"""
+            INSERT INTO {spec['table']} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})
+            ON CONFLICT({spec['key']}) DO UPDATE SET {', '.join(f'{f} = excluded.{f}' for f in spec['fields'])}
+        """, writes)
+        # 已被领取的座位改了位置，票面上的位置跟着改
+        if moved:
+            cursor.executemany('UPDATE users SET pos = ? WHERE seat_id = ?', moved)
+        # 文件里出现的新集合号自动登记（默认关闭）
+        if spec['table'] == 'seats':
+            ensure_seat_groups(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def bulk_import(conn, kind, rows, dry_run=False):
+    """
+    把 read_import_rows 读出的行按主键 upsert 到 seats / valid_ids
+
+    - 每 IMPORT_CHUNK_SIZE 行一个 BEGIN IMMEDIATE 事务，每个事务持锁时间很短，导入期间仍可正常领票
+    - 单行有问题（缺主键、数字无效、与前面的行重复）只跳过该行，记入 errors
+    - 文件里没给的列（如只有学号没有姓名、没有集合列）：已有的行保留原值，新行用默认值；
+      座位的 row_num / col_num 没给时从 pos 解析
+    - dry_run=True 时只对比不写库，报告内容与实际导入相同
+    - 只新增和更新，不删除文件中没有的行
+    """
+    spec = IMPORT_KINDS[kind]
+    report = {'status': 'ok', 'kind': kind, 'dry_run': dry_run, 'rows': 0,
+              'inserted': 0, 'updated': 0, 'unchanged': 0, 'skipped': 0,
+              'errors': [], 'changes': []}
+    started = time.perf_counter()
+    seen = set()
+    chunk = []
+    try:
+        for line, record in rows:
+            report['rows'] += 1
+            try:
+                key, values = spec['parse'](record)
+                if key in seen:
+                    raise ValueError(f'与前面的行重复: {key}')
+            except ValueError as e:
+                report['skipped'] += 1
+                if len(report['errors']) < IMPORT_REPORT_LIMIT:
+                    report['errors'].append({'line': line, 'msg': str(e)})
+                continue
+            seen.add(key)
+            chunk.append((line, key, values))
+            if len(chunk) >= app.config['IMPORT_CHUNK_SIZE']:
+                _import_chunk(conn, spec, chunk, dry_run, report)
+                chunk = []
+        if chunk:
+            _import_chunk(conn, spec, chunk, dry_run, report)
+    finally:
+        if not dry_run and (report['inserted'] or report['updated']):
+            if kind == 'seats':
+                seat_pool.invalidate()
+                status_cache.invalidate()
+            else:
+                roster_index.invalidate()
+    report['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return report
+
+
+@app.route('/admin/api/import/<kind>', methods=['POST'])
+@auth_required
+def api_bulk_import(kind):
+    """批量导入座位（seats）或学号库（validids）：multipart 上传 file，dry_run=1 只返回差异"""
+    if kind not in IMPORT_KINDS:
+        return jsonify({'status': 'fail', 'msg': '未知的导入类型'}), 404
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({'status': 'fail', 'msg': '需要上传文件（字段 file）'}), 400
+    dry_run = request.values.get('dry_run', '0').lower() not in ('', '0', 'false')
+    try:
+        rows = read_import_rows(upload.stream, upload.filename,
+                                encoding=request.values.get('encoding') or 'utf-8-sig',
+                                sheet=request.values.get('sheet'))
+        with get_db() as conn:
+            return jsonify(bulk_import(conn, kind, rows, dry_run=dry_run))
+    except ImportFormatError as e:
+        return jsonify({'status': 'fail', 'msg': str(e)}), 400
+    except UnicodeDecodeError:
+        return jsonify({'status': 'fail', 'msg': '文件编码无法识别，Excel 另存的 CSV 请指定 encoding=gbk'}), 400
+    except Exception as e:
+        return jsonify({'status': 'fail', 'msg': str(e)}), 500
+
+
 @app.route('/admin/api/seat-groups', methods=['GET'])
 def api_get_seat_groups():
-    """获取两个座位集合的状态和剩余量（公开接口，学生端需要）"""
+    """获取各座位集合的状态和剩余量（公开接口，学生端需要）"""
+    try:
+        with get_db() as conn:
+            return jsonify(read_seat_groups(conn.cursor()))
+    except Exception as e:
+        return jsonify({'status': 'fail', 'msg': str(e)}), 500
+
+
+def _seat_group_fields(data):
+    """请求体中的 name / is_open / open_at -> 要写入的列；单独开关 is_open 时取消预约"""
+    fields = {}
+    if 'name' in data:
+        fields['name'] = (str(data['name']).strip() or None) if data['name'] is not None else None
+    if 'is_open' in data:
+        fields['is_open'] = int(bool(int(data['is_open'] or 0)))
+        fields['open_at'] = None
+    if 'open_at' in data:
+        fields['open_at'] = parse_open_at(data['open_at'])
+    return fields
+
+
+def _find_seat_group(cursor, group_id):
+    for group in read_seat_groups(cursor):
+        if group['group_id'] == group_id:
+            return group
+    return None
+
+
+@app.route('/admin/api/seat-groups', methods=['POST'])
+@auth_required
+def api_create_seat_group():
+    """新增座位集合：group_id（必需）、name、is_open、open_at"""
     try:
+        data = request.get_json() or {}
+        try:
+            group_id = int(data['group_id'])
+            fields = _seat_group_fields(data)
+        except KeyError:
+            return jsonify({'status': 'fail', 'msg': '需要 group_id'}), 400
+        except (TypeError, ValueError) as e:
+            return jsonify({'status': 'fail', 'msg': str(e)}), 400
         with get_db() as conn:
             cursor = conn.cursor()
-            groups_info = []
-            for group_id in [1, 2]:
-                cursor.execute('SELECT is_open FROM seat_groups WHERE group_id = ?', (group_id,))
-                group_row = cursor.fetchone()
-                is_open = bool(group_row['is_open']) if group_row else False
-                
-                cursor.execute('SELECT COUNT(*) as total FROM seats WHERE group_id = ?', (group_id,))
-                total = cursor.fetchone()['total']
-                
-                cursor.execute('SELECT COUNT(*) as available FROM seats WHERE group_id = ? AND occupied = 0', (group_id,))
-                available = cursor.fetchone()['available']
-                
-                groups_info.append({
-                    'group_id': group_id,
-                    'is_open': int(is_open),
-                    'total': total,
-                    'available': available,
-                    'occupied': total - available
-                })
-            return jsonify(groups_info)
+            cursor.execute('SELECT 1 FROM seat_groups WHERE group_id = ?', (group_id,))
+            if cursor.fetchone():
+                return jsonify({'status': 'fail', 'msg': '集合已存在'}), 400
+            cursor.execute('INSERT INTO seat_groups (group_id, name, is_open, open_at) VALUES (?, ?, ?, ?)',
+                           (group_id, fields.get('name'), fields.get('is_open', 0), fields.get('open_at')))
+            conn.commit()
+            control_state.invalidate()
+            status_cache.invalidate()
+            return jsonify({'status': 'ok', 'group': _find_seat_group(cursor, group_id)})
     except Exception as e:
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
 
@@ -742,18 +3436,47 @@ def api_get_seat_groups():
 @app.route('/admin/api/seat-groups/<int:group_id>', methods=['POST'])
 @auth_required
 def api_set_seat_group(group_id):
-    """开放或关闭指定座位集合"""
+    """开放 / 关闭指定座位集合，或修改名称、预约开放时间（只改请求体中给出的字段）"""
     try:
-        if group_id not in [1, 2]:
-            return jsonify({'status': 'fail', 'msg': '集合 ID 必须为 1 或 2'}), 400
-        
         data = request.get_json() or {}
-        is_open = data.get('is_open', 0)
+        try:
+            fields = _seat_group_fields(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({'status': 'fail', 'msg': str(e)}), 400
+        if not fields:
+            return jsonify({'status': 'fail', 'msg': '需要 is_open、name 或 open_at'}), 400
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"UPDATE seat_groups SET {', '.join(f'{k} = ?' for k in fields)} WHERE group_id = ?",
+                           (*fields.values(), group_id))
+            if cursor.rowcount == 0:
+                return jsonify({'status': 'fail', 'msg': '集合不存在'}), 404
+            conn.commit()
+            control_state.invalidate()
+            status_cache.invalidate()
+            group = _find_seat_group(cursor, group_id)
+        return jsonify({'status': 'ok', 'group_id': group_id, 'is_open': group['is_open'], 'group': group})
+    except Exception as e:
+        return jsonify({'status': 'fail', 'msg': str(e)}), 500
+
+
+@app.route('/admin/api/seat-groups/<int:group_id>', methods=['DELETE'])
+@auth_required
+def api_delete_seat_group(group_id):
+    """删除座位集合；集合内还有座位时拒绝（先移走或删除座位）"""
+    try:
         with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute('UPDATE seat_groups SET is_open = ? WHERE group_id = ?', (int(is_open), group_id))
+            cursor.execute('SELECT 1 FROM seats WHERE group_id = ? LIMIT 1', (group_id,))
+            if cursor.fetchone():
+                return jsonify({'status': 'fail', 'msg': '集合内还有座位，不能删除'}), 400
+            cursor.execute('DELETE FROM seat_groups WHERE group_id = ?', (group_id,))
+            if cursor.rowcount == 0:
+                return jsonify({'status': 'fail', 'msg': '集合不存在'}), 404
             conn.commit()
-        return jsonify({'status': 'ok', 'group_id': group_id, 'is_open': int(is_open)})
+        control_state.invalidate()
+        status_cache.invalidate()
+        return jsonify({'status': 'ok'})
     except Exception as e:
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
 
@@ -779,10 +3502,9 @@ def api_available_seats():
     try:
         with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT COUNT(*) as cnt FROM seats WHERE occupied = 0')
-            available = cursor.fetchone()['cnt']
-            cursor.execute('SELECT COUNT(*) as cnt FROM seats')
-            total = cursor.fetchone()['cnt']
+            counters = read_seat_counters(cursor).values()
+            total = sum(total for total, _ in counters)
+            available = total - sum(occupied for _, occupied in counters)
             return jsonify({'available': available, 'total': total})
     except Exception as e:
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
@@ -813,7 +3535,36 @@ def api_set_ticket_status():
             cursor = conn.cursor()
             cursor.execute('UPDATE ticket_status SET is_open = ? WHERE id = 1', (int(is_open),))
             conn.commit()
-        return jsonify({'status': 'ok', 'is_open': int(is_open)})
+        control_state.invalidate()
+        status_cache.invalidate()
+        body = {'status': 'ok', 'is_open': int(is_open)}
+        if not int(is_open) and app.config['CHECKIN_INDEX']:
+            # 窗口已经关闭并提交：索引生成失败不影响本次操作，只返回提示，可在修复后手动重新生成
+            try:
+                body['checkin_index'] = build_checkin_index()
+            except Exception as e:
+                body['checkin_index_error'] = str(e)
+        return jsonify(body)
+    except Exception as e:
+        return jsonify({'status': 'fail', 'msg': str(e)}), 500
+
+
+def build_checkin_index():
+    """按当前 users 表重新生成入场核验索引（CHECKIN_INDEX），返回 {'path', 'tickets'}"""
+    import checkin      # 只有生成索引时才需要
+    with get_db() as conn:
+        count = checkin.build_index(conn, app.config['CHECKIN_INDEX'], app.config['TICKET_PREFIX'])
+    return {'path': app.config['CHECKIN_INDEX'], 'tickets': count}
+
+
+@app.route('/admin/api/checkin-index', methods=['POST'])
+@auth_required
+def api_build_checkin_index():
+    """手动重新生成入场核验索引（需要 Basic Auth）"""
+    if not app.config['CHECKIN_INDEX']:
+        return jsonify({'status': 'fail', 'msg': '未设置 CHECKIN_INDEX'}), 400
+    try:
+        return jsonify(dict(build_checkin_index(), status='ok'))
     except Exception as e:
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
 
@@ -843,6 +3594,8 @@ def api_set_local_key_switch():
             cursor = conn.cursor()
             cursor.execute('UPDATE local_key_switch SET is_open = ? WHERE id = 1', (int(is_open),))
             conn.commit()
+        control_state.invalidate()
+        status_cache.invalidate()
         return jsonify({'status': 'ok', 'is_open': int(is_open)})
     except Exception as e:
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
@@ -854,14 +3607,10 @@ def api_stats():
     try:
         with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT COUNT(*) as cnt FROM seats')
-            total = cursor.fetchone()['cnt']
-            
-            cursor.execute('SELECT COUNT(*) as cnt FROM seats WHERE occupied = 1')
-            allocated = cursor.fetchone()['cnt']
-            
-            cursor.execute('SELECT COUNT(*) as cnt FROM users')
-            user_count = cursor.fetchone()['cnt']
+            counters = read_seat_counters(cursor).values()
+            total = sum(total for total, _ in counters)
+            allocated = sum(occupied for _, occupied in counters)
+            user_count = read_user_count(cursor)
             
             return jsonify({
                 'total_seats': total,
@@ -873,6 +3622,20 @@ def api_stats():
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
 
 
+@app.route('/admin/api/db-pool', methods=['GET'])
+@auth_required
+def api_db_pool_stats():
+    """当前 worker 的数据库连接池统计（需要 Basic Auth）"""
+    return jsonify(get_pool().stats())
+
+
+@app.route('/admin/api/metrics', methods=['GET'])
+@auth_required
+def api_metrics():
+    """当前 worker 的请求 / SQL 耗时和领票结果统计，Prometheus 文本格式（需要 Basic Auth）"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route('/api/info-section', methods=['GET'])
 def api_get_info_section():
     """获取说明信息（公开接口，不需要认证）"""
@@ -887,6 +3650,55 @@ def api_get_info_section():
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
 
 
+@app.route('/api/status', methods=['GET'])
+def api_status():
+    """首页状态快照（公开接口）：一次请求返回剩余座位、窗口状态、密钥开关、座位集合和说明信息，支持 ETag"""
+    try:
+        body, etag = status_cache.get()
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+    except Exception as e:
+        return jsonify({'status': 'fail', 'msg': str(e)}), 500
+
+
+@app.route('/api/stream/status', methods=['GET'])
+def api_stream_status():
+    """
+    状态推送（Server-Sent Events，公开接口）：内容与 /api/status 相同，变化时推送 status 事件
+
+    事件 id 为快照 ETag，断线重连时带上 Last-Event-ID，内容未变就不重复推送；
+    无变化时每 STATUS_STREAM_HEARTBEAT 秒发一行注释保持连接
+    """
+    if not app.config['STATUS_STREAM_ENABLED']:
+        return jsonify({'status': 'fail', 'msg': '未开启状态推送'}), 404
+    last_event_id = request.headers.get('Last-Event-ID')
+    heartbeat = app.config['STATUS_STREAM_HEARTBEAT']
+
+    def stream():
+        status_publisher.subscribe()
+        try:
+            yield 'retry: 3000\n\n'
+            seen, sent = 0, last_event_id
+            while True:
+                seq, body, etag = status_publisher.wait(seen, heartbeat)
+                if seq == seen:
+                    yield ': ping\n\n'
+                    continue
+                seen = seq
+                if etag != sent:
+                    sent = etag
+                    yield f'id: {etag}\nevent: status\ndata: {body.decode("utf-8")}\n\n'
+        finally:
+            status_publisher.unsubscribe()
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'     # 关闭 nginx 缓冲，事件立即送达
+    return response
+
+
 @app.route('/admin/api/info-section', methods=['GET'])
 @auth_required
 def api_get_info_section_admin():
@@ -913,11 +3725,79 @@ def api_set_info_section():
             cursor = conn.cursor()
             cursor.execute('UPDATE info_section SET content = ? WHERE id = 1', (content,))
             conn.commit()
+        status_cache.invalidate()
         return jsonify({'status': 'ok', 'content': content})
     except Exception as e:
         return jsonify({'status': 'fail', 'msg': str(e)}), 500
 
 
-if __name__ == "__main__":
+@app.cli.command('migrate')
+@click.option('--check', is_flag=True, help='只检查，不执行；有待执行的迁移时退出码为 1')
+def migrate_command(check):
+    """执行尚未执行的数据库迁移（部署前运行，worker 启动时就只需查一次版本号）"""
+    with get_db() as conn:
+        version = schema_version(conn)
+        if check:
+            pending = pending_migrations(version)
+            click.echo(f'数据库版本 {version}，程序版本 {SCHEMA_VERSION}')
+            for number, title in pending:
+                click.echo(f'  待执行 {number}: {title}')
+            raise SystemExit(1 if pending else 0)
+        applied = migrate_db(conn)
+    for number, title in applied:
+        click.echo(f'  {number}: {title}')
+    if applied:
+        click.echo(f'已执行 {len(applied)} 个迁移，数据库版本 {version} -> {SCHEMA_VERSION}')
+    else:
+        click.echo(f'数据库已是最新（版本 {version}）')
+
+
+@app.cli.command('rebuild-counters')
+@click.option('--check', is_flag=True, help='只检查，不修复；不一致时退出码为 1')
+def rebuild_counters_command(check):
+    """检查座位/用户计数表与实际数据是否一致，并从头重建"""
     init_db()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        problems = check_counters(cursor)
+        for p in problems:
+            click.echo(p)
+        if check:
+            click.echo('计数不一致' if problems else '计数一致')
+            raise SystemExit(1 if problems else 0)
+        rebuild_counters(cursor)
+        conn.commit()
+    click.echo(f'已重建计数（修复 {len(problems)} 处不一致）')
+
+
+@app.cli.command('import')
+@click.argument('kind', type=click.Choice(sorted(IMPORT_KINDS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='只对比并输出差异，不写库')
+@click.option('--encoding', default='utf-8-sig', show_default=True, help='CSV 编码（Excel 另存的 CSV 常为 gbk）')
+@click.option('--sheet', default=None, help='XLSX 工作表名（默认活动工作表）')
+def import_command(kind, path, dry_run, encoding, sheet):
+    """从 CSV / XLSX 批量导入座位（seats）或学号库（validids）"""
+    init_db()
+    try:
+        with open(path, 'rb') as f, get_db() as conn:
+            report = bulk_import(conn, kind, read_import_rows(f, path, encoding, sheet), dry_run=dry_run)
+    except ImportFormatError as e:
+        raise click.ClickException(str(e))
+    except UnicodeDecodeError:
+        raise click.ClickException(f'文件不是 {encoding} 编码，Excel 另存的 CSV 请加 --encoding gbk')
+    for change in report['changes']:
+        click.echo(f"  第 {change['line']} 行 {change['action']} {change['key']}: "
+                   f"{change['before']} -> {change['after']}")
+    for error in report['errors']:
+        click.echo(f"  第 {error['line']} 行跳过: {error['msg']}")
+    click.echo(f"{'预览' if dry_run else '导入'}完成：{report['rows']} 行，新增 {report['inserted']}，"
+               f"修改 {report['updated']}，不变 {report['unchanged']}，跳过 {report['skipped']}，"
+               f"耗时 {report['elapsed_ms'] / 1000:.2f}s")
+
+
+if __name__ == "__main__":
+    ensure_schema()
+    with get_db() as conn:
+        seat_pool.rebuild(conn)
     app.run(host="0.0.0.0", port=5000)
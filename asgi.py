@@ -0,0 +1,351 @@
+"""
+ASGI 入口：与 app.py 相同的路由和响应，适合大量慢速 / 长连接客户端
+
+    pip install uvicorn
+    uvicorn asgi:app --workers 4 --host 0.0.0.0 --port 5000
+
+- GET /api/status 直接由状态快照缓存生成（与 WSGI 下相同的快照），不占用线程
+- /api/stream/status（SSE）和 /ticket/result/<token>（长轮询）在事件循环里等待，
+  所有 SSE 连接共用一个后台线程
+- 其余请求（页面、领票、管理接口，包括其它只读接口）读完请求体后交给 Flask，
+  在最多 ASGI_THREADS 个线程的线程池里执行，返回内容与 WSGI 完全相同
+- 领票写入默认走组提交写入线程（每个 worker 单个串行写入者，线程池里的多个领票请求合并提交），
+  不再由各线程分别 BEGIN IMMEDIATE 争抢写锁；环境变量 CLAIM_COMMIT_WINDOW_MS 可改窗口，设为 0 关闭
+
+慢速客户端只占用事件循环中的一个连接，不会占住处理请求的线程。
+"""
+import asyncio
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from werkzeug.http import parse_etags
+
+import app as core
+
+flask_app = core.app
+flask_app.config['ASGI_THREADS'] = int(os.environ.get('ASGI_THREADS', 16))      # 执行 Flask 视图和查库的线程数
+ASGI_COMMIT_WINDOW_MS = 1.0     # 未设置 CLAIM_COMMIT_WINDOW_MS 时的组提交窗口（毫秒）
+if 'CLAIM_COMMIT_WINDOW_MS' not in os.environ:
+    flask_app.config['CLAIM_COMMIT_WINDOW_MS'] = ASGI_COMMIT_WINDOW_MS
+
+
+def json_body(obj):
+    """与 jsonify(obj) 完全相同的响应体"""
+    with flask_app.app_context():
+        return flask_app.json.response(obj).get_data()
+
+
+# ------------ SSE 扇出 ------------
+class StatusFanout:
+    """
+    事件循环内的状态推送：一个专用线程等待 status_publisher 的新快照，再唤醒本进程所有 SSE 连接；
+    没有连接时线程退出等待，不再订阅
+    """
+
+    def __init__(self):
+        self.seq = 0
+        self.body = None
+        self.etag = None
+        self._clients = 0
+        self._task = None
+        self._cond = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='status-fanout')
+
+    def join(self):
+        self._clients += 1
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def leave(self):
+        self._clients -= 1
+
+    async def wait(self, seen, timeout):
+        """等待 seen 之后的新快照，超时返回 False"""
+        async with self._cond:
+            try:
+                await asyncio.wait_for(self._cond.wait_for(lambda: self.seq != seen), timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        core.status_publisher.subscribe()
+        try:
+            seen = 0
+            while self._clients > 0:
+                seen, body, etag = await loop.run_in_executor(self._executor, core.status_publisher.wait, seen, 1.0)
+                if body is not None and etag != self.etag:
+                    async with self._cond:
+                        self.body, self.etag = body, etag
+                        self.seq += 1
+                        self._cond.notify_all()
+        finally:
+            core.status_publisher.unsubscribe()
+
+
+# ------------ WSGI 桥接 ------------
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def run_wsgi(environ):
+    """
+    在线程池中执行 Flask，返回 (状态码, 响应头, 响应体)
+
+    流式响应（没有 Content-Length，如名单导出）不在这里读完，响应体返回 WSGI 迭代器，由调用方逐块读取
+    """
+    started = {}
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+        return chunks.append
+
+    result = flask_app(environ, start_response)
+    if not chunks and all(k != b'content-length' for k, _ in started['headers']):
+        return started['status'], started['headers'], result
+    try:
+        for chunk in result:
+            chunks.append(chunk)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return started['status'], started['headers'], b''.join(chunks)
+
+
+async def read_body(receive):
+    body = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(body)
+
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+# ------------ ASGI 应用 ------------
+class TicketASGI:
+    def __init__(self):
+        self._pool = None
+        self._pid = None
+        self.fanout = None
+
+    def _executor(self):
+        if self._pool is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pool = ThreadPoolExecutor(max_workers=flask_app.config['ASGI_THREADS'],
+                                            thread_name_prefix='asgi-db')
+            self.fanout = StatusFanout()
+        return self._pool
+
+    async def run(self, fn, *args):
+        """在有上限的线程池中执行阻塞调用（查库、Flask 视图）"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor(), fn, *args)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    self._executor()
+                    # /api/status 等不经过 Flask，启动时先执行迁移（库已是最新时只查一次版本号）
+                    await self.run(core.ensure_schema)
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        method, path = scope['method'], scope['path']
+        if method == 'GET':
+            if path == '/api/status':
+                return await self.status(scope, send)
+            if path == '/api/stream/status' and flask_app.config['STATUS_STREAM_ENABLED']:
+                return await self.stream_status(scope, receive, send)
+            if path.startswith('/ticket/result/') and '/' not in path[len('/ticket/result/'):]:
+                return await self.ticket_result(scope, send, path[len('/ticket/result/'):])
+        await self.call_wsgi(scope, receive, send)
+
+    # ---------- 响应辅助 ----------
+    @staticmethod
+    async def respond(send, status, body, headers=()):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-length', str(len(body)).encode())] + list(headers)})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def respond_json(self, send, status, obj):
+        await self.respond(send, status, json_body(obj), [(b'content-type', b'application/json')])
+
+    @staticmethod
+    def record(route, method, status, started):
+        core.metrics.observe('ticket_http_request_duration_seconds', (('route', route), ('method', method)),
+                             time.perf_counter() - started)
+        core.metrics.inc('ticket_http_requests_total', (('route', route), ('method', method), ('status', status)))
+
+    async def snapshot(self):
+        return core.status_cache.peek() or await self.run(core.status_cache.get)
+
+    # ---------- 路由 ----------
+    async def status(self, scope, send):
+        started = time.perf_counter()
+        try:
+            body, etag = await self.snapshot()
+        except Exception as e:
+            await self.respond_json(send, 500, {'status': 'fail', 'msg': str(e)})
+            return self.record('/api/status', 'GET', 500, started)
+        headers = [(b'etag', f'"{etag}"'.encode()), (b'cache-control', b'no-cache')]
+        if_none_match = dict(scope['headers']).get(b'if-none-match')
+        if if_none_match and parse_etags(if_none_match.decode('latin-1')).contains_weak(etag):
+            await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return self.record('/api/status', 'GET', 304, started)
+        await self.respond(send, 200, body, [(b'content-type', b'application/json')] + headers)
+        self.record('/api/status', 'GET', 200, started)
+
+    async def stream_status(self, scope, receive, send):
+        started = time.perf_counter()
+        self._executor()
+        fanout = self.fanout
+        last_event_id = dict(scope['headers']).get(b'last-event-id', b'').decode('latin-1') or None
+        heartbeat = flask_app.config['STATUS_STREAM_HEARTBEAT']
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        self.record('/api/stream/status', 'GET', 200, started)
+
+        async def pump():
+            await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+            seen, sent = 0, last_event_id
+            while True:
+                if not await fanout.wait(seen, heartbeat):
+                    await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+                    continue
+                seen = fanout.seq
+                if fanout.etag != sent:
+                    sent = fanout.etag
+                    event = b'id: %s\nevent: status\ndata: %s\n\n' % (sent.encode(), fanout.body)
+                    await send({'type': 'http.response.body', 'body': event, 'more_body': True})
+
+        fanout.join()
+        tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(wait_disconnect(receive))]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            fanout.leave()
+            for task in tasks:
+                task.cancel()
+
+    async def ticket_result(self, scope, send, token):
+        started = time.perf_counter()
+        route = '/ticket/result/<token>'
+        try:
+            issued_at = core.claim_token_time(token)
+        except ValueError:
+            await self.respond_json(send, 404, {"status": "fail", "msg": "凭证无效或已过期"})
+            return self.record(route, 'GET', 404, started)
+        try:
+            wait = float(parse_qs(scope['query_string'].decode('latin-1')).get('wait', ['0'])[0] or 0)
+        except ValueError:
+            wait = 0.0
+        wait = min(max(wait, 0.0), 10.0)
+
+        try:
+            deadline = time.monotonic() + wait
+            while True:
+                row = await self.run(self._fetch_result, token)
+                if row:
+                    await self.respond(send, row[0], row[1].encode('utf-8'), [(b'content-type', b'application/json')])
+                    return self.record(route, 'GET', row[0], started)
+                failed = core.claim_queue.failed(token)
+                if failed:
+                    await self.respond_json(send, failed[0], failed[1])
+                    return self.record(route, 'GET', failed[0], started)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(min(remaining, 0.05))
+
+            if time.time() - issued_at > flask_app.config['CLAIM_RESULT_TIMEOUT']:
+                await self.respond_json(send, 404, {"status": "fail", "msg": "凭证无效或已过期"})
+                return self.record(route, 'GET', 404, started)
+            await self.respond_json(send, 202, {"status": "queued", "msg": "排队中", "token": token})
+            self.record(route, 'GET', 202, started)
+        except Exception as e:
+            await self.respond_json(send, 500, {"status": "fail", "msg": str(e)})
+            self.record(route, 'GET', 500, started)
+
+    @staticmethod
+    def _fetch_result(token):
+        with core.get_db() as conn:
+            row = conn.execute('SELECT status_code, body FROM claim_results WHERE token = ?', (token,)).fetchone()
+            return (row['status_code'], row['body']) if row else None
+
+    async def call_wsgi(self, scope, receive, send):
+        body = await read_body(receive)
+        if body is None:
+            return
+        status, headers, content = await self.run(run_wsgi, build_environ(scope, body))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        if isinstance(content, bytes):
+            await send({'type': 'http.response.body', 'body': content})
+            return
+        # 流式响应：每块都在线程池里生成（可能要查库），生成一块发送一块
+        iterator = iter(content)
+        try:
+            while True:
+                chunk = await self.run(next, iterator, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(content, 'close'):
+                await self.run(content.close)
+
+
+app = TicketASGI()
@@ -0,0 +1,276 @@
+"""
+抢票高峰基准测试：在临时数据库上模拟取票窗口开放瞬间的领票洪峰
+
+- 按参数生成座位 / 集合 / 有效学号，取票窗口与所有集合直接开放
+- 每个领票请求使用不同的 X-Forwarded-For，模拟不同学生的手机
+- 同时有若干线程持续轮询 /api/status，模拟停留在首页的学生
+- 报告吞吐量、延迟分位数（p50/p90/p99/max）、5xx 与锁错误比例，并校验分配结果正确
+
+两种目标：
+    python bench_claim.py --target flask                # Flask test client，进程内调用
+    python bench_claim.py --target gunicorn --workers 4 # 启动本地 gunicorn，走真实 HTTP
+    python bench_claim.py --mode queue                  # 排队模式：延迟按拿到最终结果计算
+
+常用参数：
+    --claims 5000 --seats 3000 --students 6000 --procs 4 --threads 32 --pollers 8
+    --json bench.json                                    # 另存一份机器可读的结果
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+from stress_claim import seed_db, verify  # noqa: E402
+
+LOCK_ERROR_MSGS = ('database is locked', '系统繁忙，请稍后重试')
+
+
+# ------------ 请求发送 ------------
+def flask_sender(db, mode):
+    """返回 send(method, path, form, headers) -> (status, json)，每个线程各自一个 test client"""
+    import app as appmod
+    appmod.app.config['DATABASE'] = db
+    appmod.app.config['CLAIM_MODE'] = mode
+    local = threading.local()
+
+    def send(method, path, form=None, headers=None):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = appmod.app.test_client()
+        r = client.open(path, method=method, data=form, headers=headers)
+        return r.status_code, r.get_json(silent=True) or {}
+    return send
+
+
+def http_sender(host, port):
+    def send(method, path, form=None, headers=None):
+        conn = http.client.HTTPConnection(host, port, timeout=60)
+        headers = dict(headers or {})
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            r = conn.getresponse()
+            raw = r.read()
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                data = {}
+            return r.status, data
+        except (OSError, http.client.HTTPException) as e:
+            return 599, {'msg': f'连接失败: {e.__class__.__name__}'}
+        finally:
+            conn.close()
+    return send
+
+
+# ------------ 单个压测进程 ------------
+def _worker(target, mode, jobs, threads, pollers, start, out):
+    send = flask_sender(target, mode) if isinstance(target, str) else http_sender(*target)
+
+    lock = threading.Lock()
+    claim_lat, poll_lat = [], []
+    outcomes, poll_codes = Counter(), Counter()
+    granted = []
+    tokens = set()
+    done = threading.Event()
+
+    def claim(chunk):
+        for sid, name, ip in chunk:
+            t = time.perf_counter()
+            code, j = send('POST', '/ticket', {'student_id': sid, 'student_name': name},
+                           {'X-Forwarded-For': ip})
+            token, url = j.get('token'), j.get('result_url')
+            while j.get('status') == 'queued':
+                code, j = send('GET', f'{url}?wait=10')
+            dt = time.perf_counter() - t
+            with lock:
+                claim_lat.append(dt)
+                outcomes[(code, j.get('msg'))] += 1
+                # 排队期间同一学号重复提交会拿到同一个凭证，结果只算一次
+                if j.get('msg') == '领取成功' and (token is None or token not in tokens):
+                    granted.append((sid, j['seat'], j['ticket_no']))
+                    tokens.add(token)
+
+    def poll(i):
+        ip = f'172.16.{i >> 8 & 255}.{i & 255}'
+        while not done.is_set():
+            t = time.perf_counter()
+            code, _ = send('GET', '/api/status', None, {'X-Forwarded-For': ip})
+            dt = time.perf_counter() - t
+            with lock:
+                poll_lat.append(dt)
+                poll_codes[code] += 1
+
+    claimers = [threading.Thread(target=claim, args=(jobs[i::threads],)) for i in range(threads)]
+    polling = [threading.Thread(target=poll, args=(i,), daemon=True) for i in range(pollers)]
+    start.wait()
+    for t in polling + claimers:
+        t.start()
+    for t in claimers:
+        t.join()
+    done.set()
+    for t in polling:
+        t.join()
+    out.put({'claim_lat': claim_lat, 'poll_lat': poll_lat, 'outcomes': list(outcomes.items()),
+             'poll_codes': list(poll_codes.items()), 'granted': granted})
+
+
+# ------------ gunicorn ------------
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(db, mode, workers, worker_class, threads):
+    port = _free_port()
+    cmd = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-k', worker_class,
+           '-b', f'127.0.0.1:{port}', '--chdir', ROOT, '--log-level', 'warning', 'app:app']
+    if worker_class == 'gthread':
+        cmd[5:5] = ['--threads', str(threads)]
+    proc = subprocess.Popen(cmd, env=dict(os.environ, TICKET_DB=db, CLAIM_MODE=mode))
+    send = http_sender('127.0.0.1', port)
+    for _ in range(100):
+        if proc.poll() is not None:
+            raise SystemExit('gunicorn 启动失败（是否已 pip install gunicorn？）')
+        if send('GET', '/api/status')[0] == 200:
+            return proc, port
+        time.sleep(0.1)
+    proc.terminate()
+    raise SystemExit('gunicorn 启动超时')
+
+
+# ------------ 统计 ------------
+def percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return {'p50': pick(0.50), 'p90': pick(0.90), 'p99': pick(0.99), 'max': samples[-1] * 1000}
+
+
+def fmt_ms(p):
+    return '  '.join(f'{k}={v:.1f}ms' for k, v in p.items()) if p else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='抢票高峰基准测试')
+    parser.add_argument('--target', choices=('flask', 'gunicorn'), default='flask')
+    parser.add_argument('--mode', choices=('sync', 'queue'), default='sync', help='领票模式（CLAIM_MODE）')
+    parser.add_argument('--claims', type=int, default=5000, help='领票请求总数')
+    parser.add_argument('--seats', type=int, default=3000, help='座位数')
+    parser.add_argument('--groups', type=int, default=2, help='座位集合数（座位轮流分配到各集合）')
+    parser.add_argument('--students', type=int, default=None, help='有效学号数（默认等于 claims）')
+    parser.add_argument('--procs', type=int, default=4, help='压测进程数')
+    parser.add_argument('--threads', type=int, default=16, help='每个进程的领票线程数')
+    parser.add_argument('--pollers', type=int, default=4, help='每个进程轮询 /api/status 的线程数')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker 数')
+    parser.add_argument('--worker-class', default='sync', help='gunicorn worker 类型（sync / gthread ...）')
+    parser.add_argument('--worker-threads', type=int, default=4, help='gthread worker 的线程数')
+    parser.add_argument('--json', help='把结果另存为 JSON 文件')
+    args = parser.parse_args()
+
+    students = args.students or args.claims
+    tmpdir = tempfile.mkdtemp(prefix='bench_claim_')
+    db = os.path.join(tmpdir, 'ticket.db')
+    seed_db(db, args.seats, students, groups=args.groups)
+    jobs = [(f'S{i % students:06d}', f'学生{i % students}', f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}')
+            for i in range(args.claims)]
+
+    server = None
+    if args.target == 'gunicorn':
+        server, port = start_gunicorn(db, args.mode, args.workers, args.worker_class, args.worker_threads)
+        target = ('127.0.0.1', port)
+    else:
+        target = db
+
+    try:
+        ctx = multiprocessing.get_context('spawn')
+        start, out = ctx.Event(), ctx.Queue()
+        procs = [ctx.Process(target=_worker,
+                             args=(target, args.mode, jobs[i::args.procs], args.threads, args.pollers, start, out))
+                 for i in range(args.procs)]
+        for p in procs:
+            p.start()
+        time.sleep(1)       # 等待各进程完成 import
+        t0 = time.perf_counter()
+        start.set()
+        results = [out.get() for _ in procs]
+        elapsed = time.perf_counter() - t0
+        for p in procs:
+            p.join()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    claim_lat = [x for r in results for x in r['claim_lat']]
+    poll_lat = [x for r in results for x in r['poll_lat']]
+    outcomes, poll_codes = Counter(), Counter()
+    granted = []
+    for r in results:
+        outcomes.update(dict((tuple(k), v) for k, v in r['outcomes']))
+        poll_codes.update(dict(r['poll_codes']))
+        granted.extend(tuple(g) for g in r['granted'])
+
+    total = sum(outcomes.values())
+    errors_5xx = sum(n for (code, _), n in outcomes.items() if code >= 500)
+    lock_errors = sum(n for (_, msg), n in outcomes.items() if msg in LOCK_ERROR_MSGS)
+    problems = verify(db, granted)
+
+    report = {
+        'target': args.target,
+        'mode': args.mode,
+        'workers': args.workers if args.target == 'gunicorn' else None,
+        'claims': total,
+        'elapsed_s': elapsed,
+        'claims_per_s': total / elapsed,
+        'granted': len(granted),
+        'claim_latency_ms': percentiles(claim_lat),
+        'error_5xx_rate': errors_5xx / total if total else 0,
+        'lock_error_rate': lock_errors / total if total else 0,
+        'polls': len(poll_lat),
+        'polls_per_s': len(poll_lat) / elapsed,
+        'poll_latency_ms': percentiles(poll_lat),
+        'poll_non_200': sum(n for code, n in poll_codes.items() if code not in (200, 304)),
+        'outcomes': {f'{code} {msg}': n for (code, msg), n in outcomes.most_common()},
+        'correct': not problems,
+        'problems': problems,
+        'database': db,
+    }
+
+    print(f'目标：{args.target}，{args.mode} 模式' + (f'（{args.workers} × {args.worker_class} worker）' if server else ''))
+    print(f'领票：{total} 次，{elapsed:.2f}s，{report["claims_per_s"]:.0f} req/s，成功 {len(granted)}')
+    print(f'  延迟  {fmt_ms(report["claim_latency_ms"])}')
+    print(f'  5xx {report["error_5xx_rate"]:.2%}  锁错误 {report["lock_error_rate"]:.2%}')
+    for k, n in report['outcomes'].items():
+        print(f'    {k}: {n}')
+    print(f'轮询：{len(poll_lat)} 次，{report["polls_per_s"]:.0f} req/s，非 200/304 {report["poll_non_200"]}')
+    print(f'  延迟  {fmt_ms(report["poll_latency_ms"])}')
+    print('分配校验：' + ('通过' if not problems else '失败'))
+    for p in problems:
+        print('  - ' + p)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+提交吞吐量基准测试：对比逐个提交（claim_seat）与组提交（GroupCommitWriter）
+
+直接调用领票事务（不经过 HTTP），多个进程 × 多个线程同时领票，每种配置使用一份新的临时数据库。
+--windows 中的 0 表示当前的逐个提交路径，其余值为 CLAIM_COMMIT_WINDOW_MS（毫秒）。
+输出每秒领票数、每秒提交数（事务数）、平均每次提交包含的领票数和延迟分位数，并校验分配结果。
+
+用法：
+    python bench_commit.py                                   # 4 进程 × 16 线程，对比 0 / 2 / 5 毫秒
+    python bench_commit.py --windows 0,1,2,5,10 --synchronous FULL
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stress_claim import seed_db, verify  # noqa: E402
+
+
+def _worker(db, window_ms, synchronous, jobs, threads, start, out):
+    import app as appmod
+    appmod.app.config.update(DATABASE=db, CLAIM_COMMIT_WINDOW_MS=window_ms, DB_SYNCHRONOUS=synchronous)
+
+    lock = threading.Lock()
+    latencies, outcomes, granted = [], Counter(), []
+
+    def run(chunk):
+        for sid, name, ip in chunk:
+            t = time.perf_counter()
+            try:
+                with appmod.get_db() as conn:
+                    if window_ms > 0:
+                        outcome, result = appmod.group_commit.claim(sid, name, ip, (1, 2))
+                    else:
+                        outcome, result = appmod.claim_seat(conn, sid, name, ip, (1, 2))
+            except appmod.ClaimBusy:
+                outcome, result = 'busy', None
+            except Exception as e:
+                outcome, result = f'error: {e}', None
+            dt = time.perf_counter() - t
+            with lock:
+                latencies.append(dt)
+                outcomes[outcome] += 1
+                if outcome == 'ok':
+                    seat, ticket_seq = result
+                    granted.append((sid, seat[0], appmod.format_ticket_no(ticket_seq)))
+
+    pool = [threading.Thread(target=run, args=(jobs[i::threads],)) for i in range(threads)]
+    start.wait()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    commits = appmod.metrics.count('ticket_db_query_seconds', (('query', 'claim_commit'),))
+    out.put({'latencies': latencies, 'outcomes': dict(outcomes), 'granted': granted, 'commits': commits})
+
+
+def run_case(window_ms, args):
+    tmpdir = tempfile.mkdtemp(prefix='bench_commit_')
+    db = os.path.join(tmpdir, 'ticket.db')
+    seed_db(db, args.seats, args.claims)
+    jobs = [(f'S{i:06d}', f'学生{i}', f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}') for i in range(args.claims)]
+
+    ctx = multiprocessing.get_context('spawn')
+    start, out = ctx.Event(), ctx.Queue()
+    procs = [ctx.Process(target=_worker, args=(db, window_ms, args.synchronous, jobs[i::args.procs],
+                                                args.threads, start, out), daemon=True)
+             for i in range(args.procs)]
+    for p in procs:
+        p.start()
+    time.sleep(1)       # 等待各进程完成 import
+    t0 = time.perf_counter()
+    start.set()
+    results = [out.get() for _ in procs]
+    elapsed = time.perf_counter() - t0
+    for p in procs:
+        p.terminate()   # 组提交的写入线程不会自己退出
+
+    latencies = sorted(x for r in results for x in r['latencies'])
+    outcomes = Counter()
+    for r in results:
+        outcomes.update(r['outcomes'])
+    granted = [tuple(g) for r in results for g in r['granted']]
+    commits = sum(r['commits'] for r in results)
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return {
+        'window_ms': window_ms,
+        'claims_per_s': len(latencies) / elapsed,
+        'commits_per_s': commits / elapsed,
+        'claims_per_commit': len(granted) / commits if commits else 0,
+        'p50': pick(0.5), 'p99': pick(0.99),
+        'outcomes': outcomes,
+        'problems': verify(db, granted),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='逐个提交与组提交的吞吐量对比')
+    parser.add_argument('--windows', default='0,2,5', help='逗号分隔的 CLAIM_COMMIT_WINDOW_MS，0 为逐个提交')
+    parser.add_argument('--claims', type=int, default=4000, help='每种配置的领票次数')
+    parser.add_argument('--seats', type=int, default=4000, help='座位数')
+    parser.add_argument('--procs', type=int, default=4, help='进程数（模拟 gunicorn worker）')
+    parser.add_argument('--threads', type=int, default=16, help='每个进程的并发线程数')
+    parser.add_argument('--synchronous', default='NORMAL', choices=('OFF', 'NORMAL', 'FULL'),
+                        help='PRAGMA synchronous（FULL 时每次提交都 fsync）')
+    args = parser.parse_args()
+
+    rows = [run_case(float(w), args) for w in args.windows.split(',')]
+    print(f'{args.claims} 次领票 / {args.procs} 进程 × {args.threads} 线程，synchronous={args.synchronous}')
+    print(f'{"模式":<14}{"领票/s":>10}{"提交/s":>10}{"票/提交":>10}{"p50(ms)":>10}{"p99(ms)":>10}  结果')
+    failed = False
+    for r in rows:
+        name = '逐个提交' if r['window_ms'] == 0 else f'组提交 {r["window_ms"]:g}ms'
+        outcomes = ', '.join(f'{k} {v}' for k, v in r['outcomes'].most_common())
+        print(f'{name:<14}{r["claims_per_s"]:>10.0f}{r["commits_per_s"]:>10.0f}{r["claims_per_commit"]:>10.1f}'
+              f'{r["p50"]:>10.1f}{r["p99"]:>10.1f}  {outcomes}')
+        for p in r['problems']:
+            failed = True
+            print('  - ' + p)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
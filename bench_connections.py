@@ -0,0 +1,184 @@
+"""
+并发连接容量基准测试：对比 WSGI（gunicorn 同步 worker）与 ASGI（uvicorn asgi:app）部署
+
+模拟抢票时的大量慢速手机连接：先建立 --slow 个只发送了一半请求头就停住的连接
+（以及可选的 --sse 个状态推送长连接），然后用 --probe 个并发客户端在 --duration 秒内
+不断请求 /api/status 和 /api/available-seats，统计完成数、延迟分位数、超时和错误。
+
+用法：
+    python bench_connections.py                         # 两种部署各跑一次，每种 4 个 worker，200 个慢连接
+    python bench_connections.py --target asgi --slow 2000 --sse 1000
+    python bench_connections.py --workers 8 --wsgi-class gthread --wsgi-threads 16
+
+需要 pip install gunicorn uvicorn。
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+from stress_claim import seed_db  # noqa: E402
+
+PROBE_PATHS = ('/api/status', '/api/available-seats')
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(target, db, port, args):
+    env = dict(os.environ, TICKET_DB=db, STATUS_STREAM_ENABLED='1' if args.sse else '0')
+    if target == 'wsgi':
+        cmd = [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '-k', args.wsgi_class,
+               '-b', f'127.0.0.1:{port}', '--chdir', ROOT, '--log-level', 'warning', '--backlog', '4096']
+        if args.wsgi_class == 'gthread':
+            cmd += ['--threads', str(args.wsgi_threads)]
+        cmd.append('app:app')
+    else:
+        cmd = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--workers', str(args.workers),
+               '--host', '127.0.0.1', '--port', str(port), '--app-dir', ROOT,
+               '--log-level', 'warning', '--backlog', '4096']
+    return subprocess.Popen(cmd, env=env)
+
+
+async def http_get(port, path, timeout):
+    """发一个 GET（Connection: close），返回状态码"""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    try:
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n'.encode())
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        await asyncio.wait_for(reader.read(), timeout)
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+async def wait_ready(port, proc):
+    for _ in range(100):
+        if proc.poll() is not None:
+            raise SystemExit('服务启动失败（是否已安装 gunicorn / uvicorn？）')
+        try:
+            if await http_get(port, '/api/status', 1) == 200:
+                return
+        except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+            pass
+        await asyncio.sleep(0.1)
+    raise SystemExit('服务启动超时')
+
+
+async def open_slow(port, count):
+    """只发送一半请求头就停住的连接"""
+    conns = []
+    for _ in range(count):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), 2)
+            writer.write(b'GET /api/status HTTP/1.1\r\nHost: bench\r\n')
+            conns.append(writer)
+        except (OSError, asyncio.TimeoutError):
+            break
+    return conns
+
+
+async def open_sse(port, count):
+    conns = []
+    for _ in range(count):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), 2)
+            writer.write(b'GET /api/stream/status HTTP/1.1\r\nHost: bench\r\nAccept: text/event-stream\r\n\r\n')
+            conns.append(writer)
+        except (OSError, asyncio.TimeoutError):
+            break
+    return conns
+
+
+async def probe(port, concurrency, duration, timeout):
+    latencies, errors, timeouts = [], 0, 0
+    deadline = time.monotonic() + duration
+
+    async def client(i):
+        nonlocal errors, timeouts
+        n = 0
+        while time.monotonic() < deadline:
+            path = PROBE_PATHS[(i + n) % len(PROBE_PATHS)]
+            n += 1
+            t = time.perf_counter()
+            try:
+                status = await http_get(port, path, timeout)
+                if status == 200:
+                    latencies.append(time.perf_counter() - t)
+                else:
+                    errors += 1
+            except asyncio.TimeoutError:
+                timeouts += 1
+            except (OSError, IndexError, ValueError):
+                errors += 1
+
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    return latencies, errors, timeouts
+
+
+async def run_target(target, db, args):
+    port = _free_port()
+    proc = start_server(target, db, port, args)
+    try:
+        await wait_ready(port, proc)
+        slow = await open_slow(port, args.slow)
+        sse = await open_sse(port, args.sse) if args.sse else []
+        await asyncio.sleep(0.5)
+        t0 = time.perf_counter()
+        latencies, errors, timeouts = await probe(port, args.probe, args.duration, args.timeout)
+        elapsed = time.perf_counter() - t0
+        for writer in slow + sse:
+            writer.close()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else float('nan')
+    return {
+        'target': target, 'slow': len(slow), 'sse': len(sse),
+        'ok': len(latencies), 'rps': len(latencies) / elapsed,
+        'p50': pick(0.5), 'p99': pick(0.99), 'errors': errors, 'timeouts': timeouts,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='WSGI / ASGI 并发连接容量对比')
+    parser.add_argument('--target', choices=('wsgi', 'asgi', 'both'), default='both')
+    parser.add_argument('--workers', type=int, default=4, help='worker 进程数')
+    parser.add_argument('--wsgi-class', default='sync', help='gunicorn worker 类型')
+    parser.add_argument('--wsgi-threads', type=int, default=4, help='gthread worker 的线程数')
+    parser.add_argument('--slow', type=int, default=200, help='慢速连接数（请求头只发一半）')
+    parser.add_argument('--sse', type=int, default=0, help='状态推送长连接数（同时开启 STATUS_STREAM_ENABLED）')
+    parser.add_argument('--probe', type=int, default=20, help='并发探测客户端数')
+    parser.add_argument('--duration', type=float, default=5.0, help='探测时长（秒）')
+    parser.add_argument('--timeout', type=float, default=2.0, help='单个探测请求的超时（秒）')
+    parser.add_argument('--seats', type=int, default=1000, help='座位数')
+    args = parser.parse_args()
+
+    db = os.path.join(tempfile.mkdtemp(prefix='bench_conn_'), 'ticket.db')
+    seed_db(db, args.seats, 100)
+    targets = ('wsgi', 'asgi') if args.target == 'both' else (args.target,)
+    rows = [asyncio.run(run_target(t, db, args)) for t in targets]
+
+    print(f'{args.workers} 个 worker，{args.probe} 个探测客户端，{args.duration:g}s，单请求超时 {args.timeout:g}s')
+    print(f'{"部署":<8}{"慢连接":>8}{"SSE":>8}{"成功":>8}{"req/s":>9}{"p50(ms)":>10}{"p99(ms)":>10}{"超时":>8}{"错误":>8}')
+    for r in rows:
+        name = 'WSGI' if r['target'] == 'wsgi' else 'ASGI'
+        print(f'{name:<8}{r["slow"]:>8}{r["sse"]:>8}{r["ok"]:>8}{r["rps"]:>9.0f}{r["p50"]:>10.1f}{r["p99"]:>10.1f}'
+              f'{r["timeouts"]:>8}{r["errors"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+座位分片实验：每个座位集合一个 SQLite 文件能否让领票写入并行
+
+对比两种布局，领票事务使用与 app.py 相同的表结构和语句：
+- single：所有表在一个库里，一次 BEGIN IMMEDIATE 事务完成查重、占座、取号、写 users / ip_ticket_log（即现在的做法）
+- shard：每个集合的 seats 在单独的库里；两阶段领票——先在集合库里占座（各集合的写锁互不影响），
+  再在主库（学号 / IP 唯一性索引）里取号、写 users / ip_ticket_log；主库拒绝时把座位退回集合库
+
+    python bench_shards.py                                  # 8 进程，1 / 2 / 4 / 8 个集合
+    python bench_shards.py --groups 1,2,4 --procs 16 --synchronous FULL
+
+每次领票的座位预先分好（不测座位池的命中率），只比较写入路径；结束后校验每个座位最多一人、每人一张票。
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+
+# ------------ 建库 ------------
+def connect(path, synchronous):
+    conn = sqlite3.connect(path, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA synchronous = {synchronous}')
+    conn.execute('PRAGMA busy_timeout = 60000')
+    return conn
+
+
+def seed(tmpdir, layout, groups, seats_per_group):
+    """用 app.init_db 建主库；shard 布局再为每个集合建一个只有 seats 和座位计数的库"""
+    import app as appmod
+    main = os.path.join(tmpdir, 'ticket.db')
+    appmod.app.config['DATABASE'] = main
+    appmod.init_db()
+    conn = sqlite3.connect(main)
+    seats = [(g * seats_per_group + i + 1, f'第{i // 30 + 1}排 第{i % 30 + 1}列', g + 1, i // 30 + 1, i % 30 + 1)
+             for g in range(groups) for i in range(seats_per_group)]
+    if layout == 'single':
+        conn.executemany('INSERT INTO seats (seat_id, pos, group_id, row_num, col_num) VALUES (?, ?, ?, ?, ?)', seats)
+    else:
+        seats_sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'seats'").fetchone()[0]
+        for g in range(groups):
+            shard = sqlite3.connect(os.path.join(tmpdir, f'ticket.g{g + 1}.db'))
+            shard.execute(seats_sql)
+            for sql in appmod.COUNTER_SCHEMA:
+                if 'seat_counters' in sql:
+                    shard.execute(sql)
+            shard.executemany('INSERT INTO seats (seat_id, pos, group_id, row_num, col_num) VALUES (?, ?, ?, ?, ?)',
+                              [s for s in seats if s[2] == g + 1])
+            shard.commit()
+            shard.close()
+    conn.commit()
+    conn.close()
+    return main
+
+
+# ------------ 领票 ------------
+def _check_unique(cursor, student_id, ip):
+    cursor.execute('SELECT 1 FROM users WHERE student_id = ?', (student_id,))
+    if cursor.fetchone():
+        return 'exists'
+    cursor.execute('SELECT 1 FROM ip_ticket_log WHERE ip_address = ? AND student_id != ?', (ip, student_id))
+    if cursor.fetchone():
+        return 'ip_limited'
+    return None
+
+
+def _record_ticket(cursor, student_id, seat_id, pos, ip):
+    cursor.execute('UPDATE ticket_sequence SET last_seq = last_seq + 1 WHERE id = 1')
+    cursor.execute('SELECT last_seq FROM ticket_sequence WHERE id = 1')
+    ticket_seq = cursor.fetchone()['last_seq']
+    cursor.execute('INSERT INTO users (student_id, seat_id, student_name, pos, ticket_seq) VALUES (?, ?, ?, ?, ?)',
+                   (student_id, seat_id, '', pos, ticket_seq))
+    cursor.execute('INSERT INTO ip_ticket_log (ip_address, student_id) VALUES (?, ?)', (ip, student_id))
+
+
+def claim_single(main, student_id, seat_id, pos, ip):
+    cursor = main.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        outcome = _check_unique(cursor, student_id, ip)
+        if outcome is None:
+            cursor.execute('UPDATE seats SET occupied = 1, student_id = ? WHERE seat_id = ? AND occupied = 0',
+                           (student_id, seat_id))
+            _record_ticket(cursor, student_id, seat_id, pos, ip)
+            outcome = 'ok'
+        main.commit()
+        return outcome
+    except Exception:
+        main.rollback()
+        raise
+
+
+def claim_shard(main, shard, student_id, seat_id, pos, ip):
+    # 只读预检（WAL 下不拿锁），挡掉绝大多数重复提交，省掉占座再退回
+    outcome = _check_unique(main.cursor(), student_id, ip)
+    if outcome:
+        return outcome
+    # 第一阶段：集合库内占座
+    cursor = shard.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute('UPDATE seats SET occupied = 1, student_id = ? WHERE seat_id = ? AND occupied = 0',
+                   (student_id, seat_id))
+    shard.commit()
+    # 第二阶段：主库内确认唯一性并写票；被拒绝时退回座位
+    cursor = main.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        outcome = _check_unique(cursor, student_id, ip)
+        if outcome is None:
+            _record_ticket(cursor, student_id, seat_id, pos, ip)
+            outcome = 'ok'
+        main.commit()
+    except Exception:
+        main.rollback()
+        outcome = 'error'
+    if outcome != 'ok':
+        shard.execute('UPDATE seats SET occupied = 0, student_id = NULL WHERE seat_id = ? AND student_id = ?',
+                      (seat_id, student_id))
+        shard.commit()
+    return outcome
+
+
+def _worker(tmpdir, layout, groups, synchronous, jobs, start, out):
+    main = connect(os.path.join(tmpdir, 'ticket.db'), synchronous)
+    shards = {g: connect(os.path.join(tmpdir, f'ticket.g{g}.db'), synchronous)
+              for g in range(1, groups + 1)} if layout == 'shard' else {}
+    start.wait()
+    t = time.perf_counter()
+    ok = 0
+    for student_id, seat_id, group_id, pos, ip in jobs:
+        if layout == 'single':
+            outcome = claim_single(main, student_id, seat_id, pos, ip)
+        else:
+            outcome = claim_shard(main, shards[group_id], student_id, seat_id, pos, ip)
+        ok += outcome == 'ok'
+    out.put((ok, time.perf_counter() - t))
+
+
+# ------------ 校验 ------------
+def verify(tmpdir, layout, groups, claims):
+    main = sqlite3.connect(os.path.join(tmpdir, 'ticket.db'))
+    paths = [os.path.join(tmpdir, f'ticket.g{g}.db') for g in range(1, groups + 1)] if layout == 'shard' else [None]
+    occupied = {}
+    for path in paths:
+        conn = sqlite3.connect(path) if path else main
+        for seat_id, student_id in conn.execute('SELECT seat_id, student_id FROM seats WHERE occupied = 1'):
+            occupied[seat_id] = student_id
+    users = dict(main.execute('SELECT student_id, seat_id FROM users'))
+    problems = []
+    if len(users) != claims:
+        problems.append(f'users 有 {len(users)} 行，应为 {claims}')
+    if len(occupied) != claims:
+        problems.append(f'已占用座位 {len(occupied)} 个，应为 {claims}')
+    if any(occupied.get(seat_id) != student_id for student_id, seat_id in users.items()):
+        problems.append('users 与座位占用不一致')
+    return problems
+
+
+def run(layout, groups, args):
+    tmpdir = tempfile.mkdtemp(prefix='bench_shards_')
+    try:
+        seats_per_group = -(-args.claims // groups)
+        seed(tmpdir, layout, groups, seats_per_group)
+        # 第 i 次领票：学号 / IP 各不相同，座位轮流取自各集合
+        jobs = []
+        for i in range(args.claims):
+            g, k = i % groups, i // groups
+            jobs.append((f'S{i:06d}', g * seats_per_group + k + 1, g + 1, f'第{k // 30 + 1}排 第{k % 30 + 1}列',
+                         f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}'))
+        ctx = multiprocessing.get_context('spawn')
+        start, out = ctx.Event(), ctx.Queue()
+        procs = [ctx.Process(target=_worker, args=(tmpdir, layout, groups, args.synchronous,
+                                                   jobs[i::args.procs], start, out))
+                 for i in range(args.procs)]
+        for p in procs:
+            p.start()
+        time.sleep(1)       # 等待各进程完成 import 和连接
+        t0 = time.perf_counter()
+        start.set()
+        results = [out.get() for _ in procs]
+        elapsed = time.perf_counter() - t0
+        for p in procs:
+            p.join()
+        ok = sum(n for n, _ in results)
+        return ok / elapsed, verify(tmpdir, layout, groups, args.claims)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='座位分片实验')
+    parser.add_argument('--groups', default='1,2,4,8', help='逗号分隔的集合数')
+    parser.add_argument('--procs', type=int, default=8, help='并发领票进程数')
+    parser.add_argument('--claims', type=int, default=4000, help='领票次数')
+    parser.add_argument('--synchronous', default='NORMAL', choices=('OFF', 'NORMAL', 'FULL'))
+    args = parser.parse_args()
+
+    print(f'{args.procs} 进程，{args.claims} 次领票，synchronous={args.synchronous}，CPU {os.cpu_count()} 核')
+    print(f'{"布局":<8}{"集合数":>6}{"领票/s":>10}{"相对 single":>14}  校验')
+    baseline, failed = None, False
+    for layout, groups in [('single', 1)] + [('shard', int(g)) for g in args.groups.split(',')]:
+        rate, problems = run(layout, groups, args)
+        baseline = baseline or rate
+        failed = failed or bool(problems)
+        print(f'{layout:<8}{groups:>6}{rate:>10.0f}{rate / baseline:>13.2f}x  {"通过" if not problems else "; ".join(problems)}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+静态资源构建：把 pics/ 下的图片处理成带内容哈希的文件，供 app.py 以长期缓存方式提供
+
+    python build_assets.py                              # pics/ -> static_build/
+    python build_assets.py --max-width 1200 --quality 82
+    python build_assets.py --clean                      # 同时删除新清单里不再引用的旧文件
+
+- 文件名带内容哈希（poster.3f2a1b9c0d.jpg），内容变了 URL 就变，浏览器可以永久缓存（immutable）
+- 安装了 Pillow 时：宽度超过 --max-width 的图片等比缩小后重新压缩，并额外生成 WebP 版本
+  （比原格式小才保留）；app.py 对声明支持 WebP 的浏览器在同一 URL 上返回 WebP
+- 文本类资源（svg / css / js 等）额外生成 .gz，安装了 brotli 时再生成 .br；图片本身已压缩，不再压缩
+- 最后写入 manifest.json（原子替换），worker 启动后第一次用到时读取；替换图片后重新运行即可
+- 默认保留旧的带哈希文件，滚动发布期间还拿着旧页面的浏览器仍能取到图片
+
+Pillow / brotli 都是可选的：没有安装时只做哈希命名（和文本资源的 gzip）。
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import sys
+import tempfile
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MANIFEST = 'manifest.json'
+RASTER_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp'}
+COMPRESSIBLE_EXTS = {'.svg', '.css', '.js', '.json', '.txt', '.xml'}
+
+
+def sniff_type(name, data):
+    """按文件头判断图片类型（扩展名可能与内容不符，如 PNG 存成 .jpg），判断不了时按扩展名"""
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+def hashed_name(name, data, ext=None):
+    stem, orig_ext = os.path.splitext(name)
+    return f'{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext or orig_ext}'
+
+
+# ------------ 图片处理 ------------
+def optimize_image(data, content_type, max_width, quality):
+    """
+    缩小并重新压缩图片，返回 (主体字节, WebP 字节或 None)
+
+    只在缩小了尺寸或重新压缩后更小时替换原图；WebP 比主体小才返回
+    """
+    if Image is None or content_type not in RASTER_TYPES or content_type == 'image/gif':
+        return data, None
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    resized = img.width > max_width
+    if resized:
+        img = img.resize((max_width, round(img.height * max_width / img.width)), Image.LANCZOS)
+
+    out = io.BytesIO()
+    if content_type == 'image/jpeg':
+        img.convert('RGB').save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+    elif content_type == 'image/png':
+        img.save(out, 'PNG', optimize=True)
+    else:
+        img.save(out, 'WEBP', quality=quality, method=6)
+    body = out.getvalue() if resized or out.tell() < len(data) else data
+
+    if content_type == 'image/webp':
+        return body, None
+    out = io.BytesIO()
+    img.save(out, 'WEBP', quality=quality, method=6)
+    webp = out.getvalue()
+    return body, webp if len(webp) < len(body) else None
+
+
+def precompress(data):
+    """返回 {扩展名: 压缩后字节}，只保留比原文件小的"""
+    variants = {'.gz': gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(data, quality=11)
+    return {ext: body for ext, body in variants.items() if len(body) < len(data)}
+
+
+# ------------ 构建 ------------
+def write_file(path, data):
+    """内容相同的文件已存在时跳过（文件名带哈希，同名即同内容）"""
+    if os.path.exists(path) and os.path.getsize(path) == len(data):
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def build(src, out, max_width, quality):
+    """处理 src 下的所有文件，写入 out，返回清单 {原文件名: 条目}"""
+    os.makedirs(out, exist_ok=True)
+    assets = {}
+    for name in sorted(os.listdir(src)):
+        path = os.path.join(src, name)
+        if not os.path.isfile(path) or name.startswith('.'):
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        content_type = sniff_type(name, data)
+        body, webp = optimize_image(data, content_type, max_width, quality)
+
+        entry = {'file': hashed_name(name, body), 'content_type': content_type,
+                 'source_size': len(data), 'size': len(body)}
+        write_file(os.path.join(out, entry['file']), body)
+        if webp is not None:
+            entry['webp'] = hashed_name(name, webp, '.webp')
+            entry['webp_size'] = len(webp)
+            write_file(os.path.join(out, entry['webp']), webp)
+        if os.path.splitext(name)[1].lower() in COMPRESSIBLE_EXTS:
+            for ext, compressed in precompress(body).items():
+                write_file(os.path.join(out, entry['file'] + ext), compressed)
+        assets[name] = entry
+    return assets
+
+
+def write_manifest(out, assets):
+    fd, tmp = tempfile.mkstemp(dir=out, prefix='.manifest-')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump({'version': 1, 'assets': assets}, f, ensure_ascii=False, indent=2)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, os.path.join(out, MANIFEST))
+
+
+def clean(out, assets):
+    """删除清单里不再引用的带哈希文件，返回删除的文件数"""
+    keep = {MANIFEST}
+    for entry in assets.values():
+        keep.update(entry['file'] + ext for ext in ('', '.gz', '.br'))
+        if 'webp' in entry:
+            keep.add(entry['webp'])
+    removed = 0
+    for name in os.listdir(out):
+        if name not in keep and not name.startswith('.'):
+            os.remove(os.path.join(out, name))
+            removed += 1
+    return removed
+
+
+def _kb(n):
+    return f'{n / 1024:.0f} KB'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成带哈希的静态资源')
+    parser.add_argument('--src', default=os.path.join(ROOT, 'pics'), help='源目录')
+    parser.add_argument('--out', default=os.environ.get('ASSET_DIR', os.path.join(ROOT, 'static_build')),
+                        help='输出目录（与 app.py 的 ASSET_DIR 相同）')
+    parser.add_argument('--max-width', type=int, default=1200, help='图片最大宽度（像素），更宽的等比缩小')
+    parser.add_argument('--quality', type=int, default=82, help='JPEG / WebP 压缩质量')
+    parser.add_argument('--clean', action='store_true', help='删除清单里不再引用的旧文件')
+    args = parser.parse_args()
+
+    if Image is None:
+        print('未安装 Pillow：不缩放、不生成 WebP（pip install Pillow）')
+    assets = build(args.src, args.out, args.max_width, args.quality)
+    write_manifest(args.out, assets)
+
+    print(f'{"文件":<20}{"原始":>10}{"输出":>10}{"WebP":>10}  输出文件')
+    total_src = total_out = 0
+    for name, entry in assets.items():
+        smallest = min(entry['size'], entry.get('webp_size', entry['size']))
+        total_src += entry['source_size']
+        total_out += smallest
+        webp = _kb(entry['webp_size']) if 'webp' in entry else '-'
+        print(f'{name:<20}{_kb(entry["source_size"]):>10}{_kb(entry["size"]):>10}{webp:>10}  {entry["file"]}')
+    print(f'合计 {_kb(total_src)} -> {_kb(total_out)}（支持 WebP 的浏览器）')
+    if args.clean:
+        print(f'删除旧文件 {clean(args.out, assets)} 个')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
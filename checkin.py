@@ -0,0 +1,403 @@
+"""
+入场核验：从 users 表生成只读的核验索引文件，入口处按学号或票号查座位、登记检票
+
+    python checkin.py build --db ticket.db                  # 取票窗口关闭后生成 checkin.idx
+    python checkin.py lookup 42412107                        # 按学号或票号查询
+    python checkin.py scan NO.251221045 --gate 东门          # 检票，重复检票会提示首次检票的时间和入口
+    python checkin.py serve --port 5001                      # 只读核验服务（开发用）
+    CHECKIN_INDEX=checkin.idx gunicorn -w 2 -b 0.0.0.0:5001 checkin:app
+
+- 索引文件用 mmap 只读打开，按学号 / 票号各有一张开放寻址哈希表，查询 O(1)，不访问数据库；
+  入口处只需要索引文件，主服务器负载再高也不受影响
+- 检票记录追加写入日志文件（每行一条，TSV），启动时回放到位图里，重复检票 O(1) 判断；
+  多个进程共用同一日志时用 flock 互斥，登记前先读入其它进程新追加的记录
+- 索引文件被重新生成（原子替换）后，服务进程下一次请求时自动重新打开
+"""
+import argparse
+import fcntl
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from flask import Flask, request, jsonify, Response
+
+# ------------ 索引文件格式 ------------
+# 文件头：魔数、票数、哈希表槽数、生成时间、票号前缀（UTF-8，补 0，最多 PREFIX_MAX 字节）
+# 之后依次为：记录表（每票一条定长记录）、学号哈希表、票号哈希表（每槽 4 字节，记录下标 + 1，0 为空）、字符串区
+# 字符串区每条记录一段：学号 \0 姓名 \0 位置；所有整数均为小端
+MAGIC = b'TKCHK001'
+PREFIX_MAX = 48
+HEADER = struct.Struct(f'<8sIId{PREFIX_MAX}s')
+RECORD = struct.Struct('<iiiiiII')      # ticket_seq（无则 -1）、seat_id、row_num、col_num、group_id、字符串偏移、长度
+SLOT = struct.Struct('<I')
+
+
+def _hash_student(student_id):
+    return zlib.crc32(student_id.encode('utf-8'))
+
+
+def _hash_ticket(ticket_seq):
+    return (ticket_seq * 2654435761) & 0xffffffff
+
+
+def build_index(conn, path, prefix):
+    """
+    从 users / seats / valid_ids 生成核验索引，写入临时文件后原子替换 path，返回票数
+
+    conn 为 sqlite3 连接；prefix 为票号前缀（与 TICKET_PREFIX 相同），查询时据此把票号解析为序号；
+    前缀编码后超过 PREFIX_MAX 字节时抛出 ValueError（截断后票号会与主程序对不上）
+    """
+    encoded_prefix = prefix.encode('utf-8')
+    if len(encoded_prefix) > PREFIX_MAX:
+        raise ValueError(f'票号前缀过长：UTF-8 编码后 {len(encoded_prefix)} 字节，核验索引最多支持 {PREFIX_MAX} 字节')
+    rows = conn.execute('''
+        SELECT u.student_id, u.ticket_seq, u.seat_id, COALESCE(v.student_name, u.student_name, '') AS name,
+               COALESCE(s.pos, u.pos, '') AS pos, s.row_num, s.col_num, s.group_id
+        FROM users u
+        LEFT JOIN seats s ON s.seat_id = u.seat_id
+        LEFT JOIN valid_ids v ON v.student_id = u.student_id
+        ORDER BY u.student_id
+    ''').fetchall()
+    count = len(rows)
+    slots = 8
+    while slots < count * 2:
+        slots *= 2
+
+    records = bytearray(RECORD.size * count)
+    strings = bytearray()
+    by_student = [0] * slots
+    by_ticket = [0] * slots
+    mask = slots - 1
+    for i, (student_id, ticket_seq, seat_id, name, pos, row_num, col_num, group_id) in enumerate(rows):
+        text = '\0'.join((student_id, name, pos)).encode('utf-8')
+        RECORD.pack_into(records, i * RECORD.size, -1 if ticket_seq is None else ticket_seq, seat_id,
+                         row_num or 0, col_num or 0, group_id or 0, len(strings), len(text))
+        strings += text
+        slot = _hash_student(student_id) & mask
+        while by_student[slot]:
+            slot = (slot + 1) & mask
+        by_student[slot] = i + 1
+        if ticket_seq is not None:
+            slot = _hash_ticket(ticket_seq) & mask
+            while by_ticket[slot]:
+                slot = (slot + 1) & mask
+            by_ticket[slot] = i + 1
+
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, count, slots, time.time(), encoded_prefix))
+        f.write(records)
+        f.write(struct.pack(f'<{slots}I', *by_student))
+        f.write(struct.pack(f'<{slots}I', *by_ticket))
+        f.write(strings)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return count
+
+
+class CheckinIndex:
+    """mmap 打开的核验索引（只读）；按学号或票号查到的是记录下标，record(i) 取出内容"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.identity = (st.st_ino, st.st_mtime_ns, st.st_size)
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.slots, self.built_at, prefix = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f'不是核验索引文件: {path}')
+        self.prefix = prefix.rstrip(b'\0').decode('utf-8')
+        self._records = HEADER.size
+        self._by_student = self._records + RECORD.size * self.count
+        self._by_ticket = self._by_student + SLOT.size * self.slots
+        self._strings = self._by_ticket + SLOT.size * self.slots
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._mm.close()
+
+    def _text(self, i):
+        _, _, _, _, _, offset, length = RECORD.unpack_from(self._mm, self._records + i * RECORD.size)
+        start = self._strings + offset
+        return self._mm[start:start + length].decode('utf-8').split('\0')
+
+    def record(self, i):
+        ticket_seq, seat_id, row_num, col_num, group_id, _, _ = \
+            RECORD.unpack_from(self._mm, self._records + i * RECORD.size)
+        student_id, name, pos = self._text(i)
+        return {
+            'student_id': student_id,
+            'student_name': name,
+            'ticket_no': self.format_ticket_no(ticket_seq) if ticket_seq >= 0 else None,
+            'seat': seat_id,
+            'pos': pos,
+            'row_num': row_num,
+            'col_num': col_num,
+            'group_id': group_id,
+        }
+
+    def format_ticket_no(self, ticket_seq):
+        return f'{self.prefix}{ticket_seq:03d}'
+
+    def _probe(self, table, h, match):
+        mask = self.slots - 1
+        slot = h & mask
+        while True:
+            (value,) = SLOT.unpack_from(self._mm, table + slot * SLOT.size)
+            if not value:
+                return None
+            if match(value - 1):
+                return value - 1
+            slot = (slot + 1) & mask
+
+    def find_student(self, student_id):
+        return self._probe(self._by_student, _hash_student(student_id),
+                           lambda i: self._text(i)[0] == student_id)
+
+    def find_ticket(self, ticket_seq):
+        return self._probe(self._by_ticket, _hash_ticket(ticket_seq),
+                           lambda i: RECORD.unpack_from(self._mm, self._records + i * RECORD.size)[0] == ticket_seq)
+
+    def find(self, query):
+        """按学号查；查不到且形如 前缀+数字 的按票号查。返回记录下标或 None"""
+        query = query.strip()
+        i = self.find_student(query)
+        if i is None and query.startswith(self.prefix) and query[len(self.prefix):].isdigit():
+            i = self.find_ticket(int(query[len(self.prefix):]))
+        return i
+
+
+# ------------ 检票日志 ------------
+class ScanLog:
+    """
+    只追加的检票日志：每行 时间\\t学号\\t票号\\t入口
+
+    已检票的记录下标保存在位图里，重复检票判断 O(1)；登记时持有文件锁，
+    先读入其它进程追加的新行再判断，多个 gunicorn worker / 多个入口进程共用一个日志也不会重复放行。
+    """
+
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+b')
+        self._offset = 0
+        self._scanned = bytearray(len(index))
+        self._first = {}         # 记录下标 -> (时间, 入口)
+        self.scanned_count = 0
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        self._file.close()
+
+    def _sync(self):
+        """读入上次读到的位置之后的新行"""
+        self._file.seek(self._offset)
+        data = self._file.read()
+        end = data.rfind(b'\n') + 1       # 只处理完整的行
+        for line in data[:end].splitlines():
+            parts = line.decode('utf-8').split('\t')
+            if len(parts) < 4:
+                continue
+            i = self.index.find_student(parts[1])
+            if i is not None and not self._scanned[i]:
+                self._scanned[i] = 1
+                self._first[i] = (parts[0], parts[3])
+                self.scanned_count += 1
+        self._offset += end
+
+    def total(self):
+        """已检票人数（含其它进程登记的）"""
+        with self._lock:
+            self._sync()
+            return self.scanned_count
+
+    def first_scan(self, i):
+        """已检票返回 (时间, 入口)，否则 None"""
+        with self._lock:
+            self._sync()
+            return self._first.get(i)
+
+    def scan(self, i, gate):
+        """登记检票：首次返回 (True, (时间, 入口))，重复返回 (False, 首次检票的 (时间, 入口))"""
+        record = self.index.record(i)
+        with self._lock:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                self._sync()
+                if self._scanned[i]:
+                    return False, self._first[i]
+                at = time.strftime('%Y-%m-%d %H:%M:%S')
+                gate = gate.replace('\t', ' ').replace('\n', ' ')
+                line = '\t'.join((at, record['student_id'], record['ticket_no'] or '', gate)) + '\n'
+                self._file.seek(0, os.SEEK_END)
+                self._file.write(line.encode('utf-8'))
+                self._file.flush()
+                self._offset = self._file.tell()
+                self._scanned[i] = 1
+                self._first[i] = (at, gate)
+                self.scanned_count += 1
+                return True, (at, gate)
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+
+# ------------ 只读核验服务 ------------
+app = Flask(__name__)
+app.config['CHECKIN_INDEX'] = os.environ.get('CHECKIN_INDEX', 'checkin.idx')          # 核验索引文件
+app.config['CHECKIN_LOG'] = os.environ.get('CHECKIN_LOG', 'checkin_scans.log')        # 检票日志文件
+
+_state_lock = threading.Lock()
+_state = {'index': None, 'log': None}
+
+
+def get_checkin():
+    """当前进程的 (索引, 检票日志)；索引文件被替换后重新打开并重放日志"""
+    index, log = _state['index'], _state['log']
+    path = app.config['CHECKIN_INDEX']
+    st = os.stat(path)
+    if index is None or index.path != path or index.identity != (st.st_ino, st.st_mtime_ns, st.st_size):
+        with _state_lock:
+            index, log = _state['index'], _state['log']
+            if index is None or index.path != path or index.identity != (st.st_ino, st.st_mtime_ns, st.st_size):
+                index = CheckinIndex(path)
+                log = ScanLog(app.config['CHECKIN_LOG'], index)
+                # 旧的 mmap 可能仍被其它线程使用，交给垃圾回收关闭
+                _state['index'], _state['log'] = index, log
+    return index, log
+
+
+def check_auth():
+    auth = request.authorization
+    if not auth:
+        return False
+    return (auth.username == os.environ.get("ADMIN_USER", "admin")
+            and auth.password == os.environ.get("ADMIN_PASS", "password"))
+
+
+@app.before_request
+def require_auth():
+    if not check_auth():
+        return Response('需要认证', 401, {"WWW-Authenticate": 'Basic realm="Login"'})
+
+
+def _result(index, log, i):
+    body = index.record(i)
+    first = log.first_scan(i)
+    body['scanned'] = first is not None
+    body['scanned_at'], body['scanned_gate'] = first or (None, None)
+    return body
+
+
+@app.route('/checkin/lookup', methods=['GET'])
+def api_checkin_lookup():
+    """按学号或票号查座位：q=学号 / 票号"""
+    try:
+        index, log = get_checkin()
+        i = index.find(request.args.get('q', ''))
+        if i is None:
+            return jsonify({'status': 'fail', 'msg': '未领取或票号无效'}), 404
+        return jsonify(dict(_result(index, log, i), status='ok'))
+    except Exception as e:
+        return jsonify({'status': 'fail', 'msg': str(e)}), 500
+
+
+@app.route('/checkin/scan', methods=['POST'])
+def api_checkin_scan():
+    """登记检票：q=学号 / 票号，gate=入口名称；重复检票返回 409 和首次检票信息"""
+    try:
+        data = request.get_json(silent=True) or request.form
+        index, log = get_checkin()
+        i = index.find(data.get('q', ''))
+        if i is None:
+            return jsonify({'status': 'fail', 'msg': '未领取或票号无效'}), 404
+        first, (at, gate) = log.scan(i, data.get('gate', ''))
+        body = dict(index.record(i), scanned_at=at, scanned_gate=gate)
+        if not first:
+            return jsonify(dict(body, status='duplicate', msg='重复检票')), 409
+        return jsonify(dict(body, status='ok', msg='检票成功'))
+    except Exception as e:
+        return jsonify({'status': 'fail', 'msg': str(e)}), 500
+
+
+@app.route('/checkin/stats', methods=['GET'])
+def api_checkin_stats():
+    """索引票数、已检票数、索引生成时间"""
+    try:
+        index, log = get_checkin()
+        return jsonify({'tickets': len(index), 'scanned': log.total(),
+                        'built_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(index.built_at))})
+    except Exception as e:
+        return jsonify({'status': 'fail', 'msg': str(e)}), 500
+
+
+# ------------ 命令行 ------------
+def _print_record(body):
+    print(f"{body['student_id']} {body['student_name']}  票号 {body['ticket_no']}  "
+          f"座位 {body['seat']}（{body['pos']}，集合 {body['group_id']}）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='入场核验索引')
+    parser.add_argument('--index', default=app.config['CHECKIN_INDEX'], help='核验索引文件')
+    parser.add_argument('--log', default=app.config['CHECKIN_LOG'], help='检票日志文件')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('build', help='从数据库生成索引')
+    p.add_argument('--db', default=os.environ.get('TICKET_DB', 'ticket.db'))
+    p.add_argument('--prefix', default=os.environ.get('TICKET_PREFIX', 'NO.251221'), help='票号前缀')
+    p = sub.add_parser('lookup', help='按学号或票号查询')
+    p.add_argument('query')
+    p = sub.add_parser('scan', help='登记检票')
+    p.add_argument('query')
+    p.add_argument('--gate', default='', help='入口名称')
+    p = sub.add_parser('serve', help='启动核验服务')
+    p.add_argument('--host', default='0.0.0.0')
+    p.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        conn = sqlite3.connect(args.db)
+        try:
+            started = time.perf_counter()
+            count = build_index(conn, args.index, args.prefix)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        finally:
+            conn.close()
+        print(f'已生成 {args.index}：{count} 张票，{os.path.getsize(args.index) / 1024:.0f} KB，'
+              f'耗时 {time.perf_counter() - started:.2f}s')
+        return
+    if args.command == 'serve':
+        app.config['CHECKIN_INDEX'], app.config['CHECKIN_LOG'] = args.index, args.log
+        app.run(host=args.host, port=args.port, threaded=True)
+        return
+
+    index = CheckinIndex(args.index)
+    log = ScanLog(args.log, index)
+    i = index.find(args.query)
+    if i is None:
+        sys.exit('未领取或票号无效')
+    _print_record(index.record(i))
+    if args.command == 'lookup':
+        first = log.first_scan(i)
+        print(f'已检票：{first[0]} {first[1]}' if first else '未检票')
+        return
+    first, (at, gate) = log.scan(i, args.gate)
+    if not first:
+        print(f'重复检票！首次检票：{at} {gate}')
+        sys.exit(2)
+    print('检票成功')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""
+领票并发压力测试：多个进程同时向 POST /ticket 发起领票，校验没有任何座位被重复分配、票号没有重复
+
+每个进程各自加载 app（各自的座位池），共用同一个临时 SQLite 文件，
+模拟 gunicorn -w N 的多 worker 部署。部分请求故意制造冲突：
+同一学号从不同 IP 并发提交、同一 IP 为不同学号提交。
+
+用法：
+    python stress_claim.py                              # 4 进程 × 16 线程，4000 次领票，3000 个座位
+    python stress_claim.py --procs 8 --claims 6000 --seats 5000
+    python stress_claim.py --mode queue                 # 排队模式：入队后轮询 /ticket/result/<token>
+
+任何一项校验失败时退出码为 1。
+"""
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def seed_db(path, seats, students, groups=2, cols=30):
+    """创建一个已开放取票的测试数据库：seats 个座位（轮流分到各集合）和 students 个有效学号"""
+    import app as appmod
+    appmod.app.config['DATABASE'] = path
+    appmod.init_db()
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        'INSERT INTO seats (seat_id, pos, occupied, group_id, row_num, col_num) VALUES (?, ?, 0, ?, ?, ?)',
+        [(i, f'第{i // cols + 1}排 第{i % cols + 1}列', i % groups + 1, i // cols + 1, i % cols + 1)
+         for i in range(1, seats + 1)])
+    conn.executemany('INSERT INTO valid_ids (student_id, student_name) VALUES (?, ?)',
+                     [(f'S{i:06d}', f'学生{i}') for i in range(students)])
+    conn.execute('UPDATE ticket_status SET is_open = 1 WHERE id = 1')
+    conn.execute('UPDATE local_key_switch SET is_open = 0 WHERE id = 1')
+    conn.execute('UPDATE seat_groups SET is_open = 1')
+    conn.commit()
+    conn.close()
+
+
+def build_jobs(claims, conflict_every):
+    """生成 (student_id, student_name, ip) 列表，每 conflict_every 个请求插入一次学号冲突和 IP 冲突"""
+    jobs = []
+    for i in range(claims):
+        sid, ip = f'S{i:06d}', f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}'
+        if conflict_every and i % conflict_every == conflict_every - 1 and i > 0:
+            sid = f'S{i - 1:06d}'            # 同一学号，不同 IP
+        elif conflict_every and i % conflict_every == conflict_every // 2 and i > 0:
+            ip = jobs[-1][2]                  # 同一 IP，不同学号
+        jobs.append((sid, f'学生{int(sid[1:])}', ip))
+    return jobs
+
+
+def _worker(db, jobs, threads, start, out, mode='sync'):
+    import app as appmod
+    appmod.app.config['DATABASE'] = db
+    appmod.app.config['CLAIM_MODE'] = mode
+
+    outcomes = Counter()
+    granted = []
+    tokens = set()
+    lock = threading.Lock()
+
+    def run(chunk):
+        client = appmod.app.test_client()
+        for sid, name, ip in chunk:
+            r = client.post('/ticket', data={'student_id': sid, 'student_name': name},
+                            headers={'X-Forwarded-For': ip})
+            j = r.get_json(silent=True) or {}
+            token, url = j.get('token'), j.get('result_url')
+            while j.get('status') == 'queued':
+                r = client.get(url, query_string={'wait': 10})
+                j = r.get_json(silent=True) or {}
+            with lock:
+                outcomes[(r.status_code, j.get('msg'))] += 1
+                # 排队期间同一学号重复提交会拿到同一个凭证，结果只算一次
+                if j.get('msg') == '领取成功' and (token is None or token not in tokens):
+                    granted.append((sid, j['seat'], j['ticket_no']))
+                    tokens.add(token)
+
+    pool = [threading.Thread(target=run, args=(jobs[i::threads],)) for i in range(threads)]
+    start.wait()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    out.put((dict(outcomes), granted))
+
+
+def verify(db, granted):
+    """返回违反约束的描述列表（为空表示通过）"""
+    conn = sqlite3.connect(db)
+    problems = []
+    users, distinct = conn.execute('SELECT COUNT(*), COUNT(DISTINCT seat_id) FROM users').fetchone()
+    if users != distinct:
+        problems.append(f'users 表中有座位被重复分配：{users} 行 / {distinct} 个座位')
+    occupied = conn.execute('SELECT COUNT(*) FROM seats WHERE occupied = 1').fetchone()[0]
+    if occupied != users:
+        problems.append(f'已占用座位数 {occupied} 与用户数 {users} 不一致')
+    mismatched = conn.execute('''
+        SELECT COUNT(*) FROM users u JOIN seats s ON s.seat_id = u.seat_id
+        WHERE s.student_id IS NOT u.student_id OR s.occupied != 1
+    ''').fetchone()[0]
+    if mismatched:
+        problems.append(f'{mismatched} 个用户的座位记录与 seats 表不一致')
+    users_seq = conn.execute('SELECT COUNT(DISTINCT ticket_seq) FROM users').fetchone()[0]
+    if users_seq != users:
+        problems.append(f'users 表中有重复或缺失的票号：{users} 行 / {users_seq} 个票号')
+    shared_ips = conn.execute('''
+        SELECT COUNT(*) FROM (SELECT ip_address FROM ip_ticket_log
+                              GROUP BY ip_address HAVING COUNT(DISTINCT student_id) > 1)
+    ''').fetchone()[0]
+    if shared_ips:
+        problems.append(f'{shared_ips} 个 IP 领取了多张票')
+    conn.close()
+
+    seats = Counter(seat for _, seat, _ in granted)
+    dup_seats = [seat for seat, n in seats.items() if n > 1]
+    if dup_seats:
+        problems.append(f'{len(dup_seats)} 个座位在响应中被分给了多人，例如 {dup_seats[:5]}')
+    students = Counter(sid for sid, _, _ in granted)
+    dup_students = [sid for sid, n in students.items() if n > 1]
+    if dup_students:
+        problems.append(f'{len(dup_students)} 个学号领取成功了多次，例如 {dup_students[:5]}')
+    tickets = Counter(ticket_no for _, _, ticket_no in granted)
+    dup_tickets = [t for t, n in tickets.items() if n > 1]
+    if dup_tickets:
+        problems.append(f'{len(dup_tickets)} 个票号在响应中重复，例如 {dup_tickets[:5]}')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='多进程领票并发压力测试')
+    parser.add_argument('--procs', type=int, default=4, help='进程数（模拟 gunicorn worker）')
+    parser.add_argument('--threads', type=int, default=16, help='每个进程的并发线程数')
+    parser.add_argument('--claims', type=int, default=4000, help='领票请求总数')
+    parser.add_argument('--seats', type=int, default=3000, help='座位数')
+    parser.add_argument('--mode', choices=('sync', 'queue'), default='sync', help='领票模式（CLAIM_MODE）')
+    parser.add_argument('--conflict-every', type=int, default=10,
+                        help='每 N 个请求插入一次学号/IP 冲突（0 表示不插入）')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='stress_claim_')
+    db = os.path.join(tmpdir, 'ticket.db')
+    seed_db(db, args.seats, args.claims)
+    jobs = build_jobs(args.claims, args.conflict_every)
+
+    ctx = multiprocessing.get_context('spawn')
+    start, out = ctx.Event(), ctx.Queue()
+    procs = [ctx.Process(target=_worker, args=(db, jobs[i::args.procs], args.threads, start, out, args.mode))
+             for i in range(args.procs)]
+    for p in procs:
+        p.start()
+    time.sleep(1)       # 等待各进程完成 import
+    t0 = time.perf_counter()
+    start.set()
+
+    outcomes, granted = Counter(), []
+    for _ in procs:
+        o, g = out.get()
+        outcomes.update(o)
+        granted.extend(g)
+    elapsed = time.perf_counter() - t0
+    for p in procs:
+        p.join()
+
+    print(f'数据库：{db}')
+    print(f'{args.claims} 次领票（{args.mode}）/ {args.procs} 进程 × {args.threads} 线程，耗时 {elapsed:.2f}s'
+          f'（{args.claims / elapsed:.0f} req/s）')
+    for (code, msg), n in sorted(outcomes.items(), key=lambda kv: -kv[1]):
+        print(f'  {code} {msg}: {n}')
+
+    problems = verify(db, granted)
+    errors = sum(n for (code, _), n in outcomes.items() if code == 500)
+    if errors:
+        problems.append(f'{errors} 个请求返回 500')
+    if problems:
+        print('失败：')
+        for p in problems:
+            print('  - ' + p)
+        sys.exit(1)
+    print(f'通过：{len(granted)} 个座位分配，无重复分配，票号无重复')
+
+
+if __name__ == '__main__':
+    main()